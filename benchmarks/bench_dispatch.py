@@ -0,0 +1,97 @@
+"""
+Microbenchmark for element dispatch in Writer.
+
+Compares the type-keyed dispatch of Writer against the previous dispatch that
+looked up handlers by class name after a chain of isinstance checks.
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile  # noqa E402
+from cfile import core  # noqa E402
+
+
+class LegacyDispatchWriter(cfile.Writer):
+    """
+    Writer using the class-name based dispatch from cfile v0.4.0
+    """
+    def __init__(self, style: cfile.StyleOptions) -> None:
+        super().__init__(style)
+        # Functions rather than bound methods, writes can be made by copies of the writer
+        self.switcher_all = {elem_type.__name__: getattr(type(self), name)
+                             for elem_type, name in self._default_handlers.items()}
+
+    def _write_element(self, elem):
+        class_name = elem.__class__.__name__
+        write_method = self.switcher_all.get(class_name, None)
+        if write_method is not None:
+            write_method(self, elem)
+        else:
+            raise NotImplementedError(f"Found no writer for element {class_name}")
+
+    def _write_sequence(self, sequence):
+        for elem in sequence.elements:
+            if isinstance(elem, list):
+                self._start_line()
+                self._write_line_element(core.Line(elem))
+            elif isinstance(elem, core.Function):
+                self._start_line()
+                self._write_function_usage(elem)
+            elif isinstance(elem, core.Statement):
+                self._start_line()
+                self._write_statement(elem)
+                self._eol()
+            elif isinstance(elem, core.LineComment):
+                self._start_line()
+                self._write_line_comment(elem)
+                self._eol()
+            elif isinstance(elem, core.Block):
+                self._start_line()
+                self._write_block(elem)
+            elif isinstance(elem, core.Line):
+                self._start_line()
+                self._write_line_element(elem)
+            else:
+                self._start_line()
+                self._write_element(elem)
+                if isinstance(elem, core.Directive):
+                    self._eol()
+
+
+def make_sequence(num_statements: int) -> core.Sequence:
+    """
+    Sequence with a mix of statements, comments and directives
+    """
+    seq = core.Sequence()
+    for i in range(num_statements):
+        remainder = i % 4
+        if remainder == 0:
+            seq.append(core.Statement(core.Assignment(core.Variable(f"v{i}", "int"), i)))
+        elif remainder == 1:
+            seq.append(core.Statement(core.FunctionCall("f", [i, core.Variable("x", "int")])))
+        elif remainder == 2:
+            seq.append(core.LineComment(f" comment {i}"))
+        else:
+            seq.append(core.DefineDirective(f"X{i}", str(i)))
+    return seq
+
+
+def main(num_statements: int = 100_000, repeat: int = 5) -> None:
+    """
+    Runs benchmark and prints best time for each writer
+    """
+    seq = make_sequence(num_statements)
+    style = cfile.StyleOptions()
+    legacy = LegacyDispatchWriter(style)
+    writer = cfile.Writer(style)
+    assert legacy.write_str(seq) == writer.write_str(seq)
+    legacy_time = min(timeit.repeat(lambda: legacy.write_str(seq), number=1, repeat=repeat))
+    new_time = min(timeit.repeat(lambda: writer.write_str(seq), number=1, repeat=repeat))
+    print(f"{num_statements} statements, best of {repeat}")
+    print(f"  class-name dispatch: {legacy_time*1000:.1f} ms")
+    print(f"  type-keyed dispatch: {new_time*1000:.1f} ms ({legacy_time/new_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,88 @@
+"""
+Benchmark for recursive and iterative (explicit stack) traversal in Writer.
+
+deep: A chain of nested blocks. Recursive mode needs a raised recursion limit.
+wide: Many functions with a few levels of nested blocks.
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile  # noqa E402
+from cfile import core  # noqa E402
+
+
+def make_deep_sequence(depth: int) -> core.Sequence:
+    """
+    Sequence with one chain of nested blocks
+    """
+    seq = core.Sequence()
+    block = core.Block()
+    seq.append(block)
+    for i in range(depth - 1):
+        block.append(core.Statement(core.Assignment(core.Variable("x", "int"), i)))
+        inner = core.Block()
+        block.append(inner)
+        block = inner
+    block.append(core.Statement(core.FunctionReturn(0)))
+    return seq
+
+
+def make_wide_sequence(num_functions: int, depth: int = 4, width: int = 5) -> core.Sequence:
+    """
+    Sequence of function definitions, each having a tree of nested blocks
+    """
+    def make_block(level: int) -> core.Block:
+        block = core.Block()
+        for i in range(width):
+            block.append(core.Statement(core.FunctionCall("f", [i, level])))
+        if level < depth:
+            for _ in range(2):
+                block.append(make_block(level + 1))
+        return block
+
+    seq = core.Sequence()
+    for i in range(num_functions):
+        seq.append(core.Declaration(core.Function(f"func{i}", "void")))
+        seq.append(make_block(1))
+        seq.append(core.Blank())
+    return seq
+
+
+def measure(writer: cfile.Writer, seq: core.Sequence, repeat: int) -> float:
+    """
+    Best time in seconds
+    """
+    return min(timeit.repeat(lambda: writer.write_str(seq), number=1, repeat=repeat))
+
+
+def main(depth: int = 10_000, num_functions: int = 2_000, repeat: int = 5) -> None:
+    """
+    Runs the deep and wide benchmarks
+    """
+    # Zero indentation keeps the output of the deep benchmark linear in size
+    deep_style = cfile.StyleOptions(indent_width=0)
+    deep_seq = make_deep_sequence(depth)
+    iterative_time = measure(cfile.Writer(deep_style, iterative=True), deep_seq, repeat)
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, 4 * depth + 100))
+    try:
+        recursive_time = measure(cfile.Writer(deep_style), deep_seq, repeat)
+    finally:
+        sys.setrecursionlimit(old_limit)
+    print(f"deep: {depth} nesting levels, best of {repeat}")
+    print(f"  recursive (raised recursion limit): {recursive_time*1000:.1f} ms")
+    print(f"  iterative: {iterative_time*1000:.1f} ms")
+
+    wide_seq = make_wide_sequence(num_functions)
+    style = cfile.StyleOptions()
+    assert cfile.Writer(style).write_str(wide_seq) == cfile.Writer(style, iterative=True).write_str(wide_seq)
+    recursive_time = measure(cfile.Writer(style), wide_seq, repeat)
+    iterative_time = measure(cfile.Writer(style, iterative=True), wide_seq, repeat)
+    print(f"wide: {num_functions} functions, best of {repeat}")
+    print(f"  recursive: {recursive_time*1000:.1f} ms")
+    print(f"  iterative: {iterative_time*1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,91 @@
+"""
+Benchmark for Writer.write_files on a synthetic project.
+
+Writes a project of .c/.h files using 1, 2, 4 and 8 workers,
+with both thread pool and process pool.
+"""
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile  # noqa E402
+from cfile import core  # noqa E402
+
+
+def make_header(index: int, num_functions: int) -> core.Sequence:
+    """
+    Header with include guard, struct and function prototypes
+    """
+    guard = f"MODULE{index}_H"
+    seq = core.Sequence()
+    seq.append(core.IfndefDirective(guard))
+    seq.append(core.DefineDirective(guard))
+    seq.append(core.IncludeDirective("stdint.h", system=True))
+    seq.append(core.Blank())
+    struct = core.Struct(f"module{index}_tag", [core.StructMember(f"field{i}", "uint32_t") for i in range(10)])
+    seq.append(core.Statement(core.Declaration(core.TypeDef(f"module{index}_t", core.Declaration(struct)))))
+    for i in range(num_functions):
+        func = core.Function(f"module{index}_func{i}", "int",
+                             params=[core.Variable("self", core.Type(f"module{index}_t"), pointer=True),
+                                     core.Variable("value", "uint32_t")])
+        seq.append(core.Statement(core.Declaration(func)))
+    seq.append(core.EndifDirective())
+    return seq
+
+
+def make_source(index: int, num_functions: int) -> core.Sequence:
+    """
+    Source file with function definitions
+    """
+    seq = core.Sequence()
+    seq.append(core.IncludeDirective(f"module{index}.h"))
+    seq.append(core.Blank())
+    for i in range(num_functions):
+        func = core.Function(f"module{index}_func{i}", "int",
+                             params=[core.Variable("self", core.Type(f"module{index}_t"), pointer=True),
+                                     core.Variable("value", "uint32_t")])
+        seq.append(core.Declaration(func))
+        body = core.Block()
+        body.append(core.Statement(core.Assignment(f"self->field{i % 10}", "value")))
+        body.append(core.Statement(core.FunctionReturn(0)))
+        seq.append(body)
+        seq.append(core.Blank())
+    return seq
+
+
+def make_project(num_files: int, num_functions: int = 20) -> dict[str, core.Sequence]:
+    """
+    File names (relative) mapped to sequences. Half of the files are headers.
+    """
+    files = {}
+    for index in range(num_files // 2):
+        files[f"module{index}.h"] = make_header(index, num_functions)
+        files[f"module{index}.c"] = make_source(index, num_functions)
+    return files
+
+
+def main(num_files: int = 2_000) -> None:
+    """
+    Runs benchmark for different number of workers
+    """
+    project = make_project(num_files)
+    writer = cfile.Writer(cfile.StyleOptions())
+    print(f"{len(project)} files, {os.cpu_count()} CPUs available")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = {os.path.join(tmp_dir, name): seq for name, seq in project.items()}
+        for processes in (False, True):
+            kind = "processes" if processes else "threads"
+            base_time = None
+            for workers in (1, 2, 4, 8):
+                start = time.perf_counter()
+                results = writer.write_files(files, workers=workers, processes=processes)
+                elapsed = time.perf_counter() - start
+                assert all(result.ok for result in results)
+                if base_time is None:
+                    base_time = elapsed
+                print(f"  {kind:9} workers={workers}: {elapsed:.2f} s (speedup {base_time/elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
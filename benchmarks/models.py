@@ -0,0 +1,90 @@
+"""
+Synthetic C models for benchmarks, built using CFactory
+"""
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile  # noqa E402
+from cfile import core  # noqa E402
+
+C = cfile.CFactory()
+
+
+def structs(num_structs: int = 10_000, num_members: int = 50) -> core.Sequence:
+    """
+    Typedef'd structs with mixed member types
+    """
+    member_types = ["uint8_t", "uint16_t", "uint32_t", C.type("char", const=True, pointer=True), "double"]
+    code = C.sequence()
+    code.append(C.sysinclude("stdint.h"))
+    code.append(C.blank())
+    for i in range(num_structs):
+        members = [C.struct_member(f"member{j}",
+                                   member_types[j % len(member_types)],
+                                   pointer=(j % 7 == 0),
+                                   array=(4 if j % 11 == 0 else None))
+                   for j in range(num_members)]
+        struct = C.struct(f"struct{i}_tag", members)
+        code.append(C.statement(C.declaration(C.typedef(f"struct{i}_t", C.declaration(struct)))))
+        code.append(C.blank())
+    return code
+
+
+def extern_variables(num_variables: int = 100_000) -> core.Sequence:
+    """
+    Header with extern variable declarations
+    """
+    var_types = ["int", "uint32_t", C.type("char", const=True, pointer=True), C.struct("config_tag")]
+    code = C.sequence()
+    code.append(C.ifndef("VARIABLES_H"))
+    code.append(C.define("VARIABLES_H"))
+    for i in range(num_variables):
+        code.append(C.statement(C.declaration(C.variable(f"variable{i}",
+                                                         var_types[i % len(var_types)],
+                                                         extern=True,
+                                                         pointer=(i % 5 == 0)))))
+    code.append(C.endif())
+    return code
+
+
+def functions(num_functions: int = 5_000, num_statements: int = 10) -> core.Sequence:
+    """
+    Function definitions with bodies containing statements, comments and nested blocks
+    """
+    code = C.sequence()
+    code.append(C.include("functions.h"))
+    code.append(C.blank())
+    for i in range(num_functions):
+        code.append(C.declaration(C.function(f"function{i}", "int", static=(i % 2 == 0),
+                                             params=[C.variable("count", "int"),
+                                                     C.variable("data", C.type("uint8_t", const=True),
+                                                                pointer=True)])))
+        body = C.block()
+        body.append(C.statement(C.declaration(C.variable("result", "int"), 0)))
+        for j in range(num_statements):
+            body.append(C.statement(C.assignment("result", C.func_call("process", [j, "data", "count"]))))
+        inner = C.block()
+        inner.append(C.line_comment(" Nested block"))
+        inner.append(C.statement(C.func_call("printf", [C.str_literal(r"%d\n"), "result"])))
+        body.append(inner)
+        body.append(C.statement(C.func_return("result")))
+        code.append(body)
+        code.append(C.blank())
+    return code
+
+
+def deep_blocks(depth: int = 1_000) -> core.Sequence:
+    """
+    Chain of nested blocks
+    """
+    code = C.sequence()
+    code.append(C.declaration(C.function("deep", "void")))
+    block = C.block()
+    code.append(block)
+    for i in range(depth - 1):
+        block.append(C.statement(C.assignment("x", i)))
+        inner = C.block()
+        block.append(inner)
+        block = inner
+    block.append(C.statement(C.func_return(0)))
+    return code
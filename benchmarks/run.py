@@ -0,0 +1,237 @@
+"""
+Benchmark suite for Writer.
+
+Times Writer.write_str and Writer.write_file on synthetic models (see models.py)
+under several format styles. Runs entirely offline.
+In memory mode (--memory), uses tracemalloc to measure bytes per element type,
+memory used by each model and peak memory while rendering.
+
+Usage:
+    python benchmarks/run.py --record     Stores results as baseline
+    python benchmarks/run.py              Compares against baseline, fails on regression
+Options:
+    --memory          Runs memory benchmarks instead of timing benchmarks
+    --baseline PATH   Baseline file (default: benchmarks/baseline.json)
+    --threshold T     Allowed regression before failing, 0.25 means 25% (default)
+    --scale S         Scales model sizes, for example 0.1 for a quick run
+    --repeat N        Number of runs per benchmark, best time is used (default 3)
+    --filter TEXT     Only run benchmarks with TEXT in their name
+
+Baselines depend on the machine, record them on the machine used for checking.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile  # noqa E402
+from cfile import core  # noqa E402
+import models  # noqa E402
+
+ELEMENT_COUNT = 10_000  # Number of elements created per element type in memory mode
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+STYLES = {
+    "allman": cfile.StyleOptions(),
+    "attach_right": cfile.StyleOptions(break_before_braces=cfile.BreakBeforeBraces.ATTACH,
+                                       pointer_alignment=cfile.Alignment.RIGHT),
+    "linux_middle": cfile.StyleOptions(break_before_braces=cfile.BreakBeforeBraces.LINUX,
+                                       pointer_alignment=cfile.Alignment.MIDDLE,
+                                       indent_width=8),
+}
+
+
+# Model builders with default size and whether iterative mode is needed
+MODELS: dict[str, tuple[Callable[[int], core.Sequence], int, bool]] = {
+    "structs": (models.structs, 10_000, False),
+    "extern_variables": (models.extern_variables, 100_000, False),
+    "functions": (models.functions, 5_000, False),
+    "deep_blocks": (models.deep_blocks, 5_000, True),
+}
+
+
+def make_model(name: str, scale: float) -> core.Sequence:
+    """
+    Builds named model with size scaled by scale
+    """
+    builder, size, _ = MODELS[name]
+    return builder(max(1, int(size * scale)))
+
+
+def make_elements() -> dict[str, Callable[[str], object]]:
+    """
+    Functions creating one element from a name, by element type
+    """
+    shared_type = core.Type("int")
+    return {
+        "Type": lambda name: core.Type(name),
+        "Variable": lambda name: core.Variable(name, "int"),
+        "Variable(shared Type)": lambda name: core.Variable(name, shared_type),
+        "StructMember": lambda name: core.StructMember(name, "uint32_t"),
+        "Function": lambda name: core.Function(name, "int"),
+        "Declaration(Variable)": lambda name: core.Declaration(core.Variable(name, shared_type), 0),
+        "Statement(Assignment)": lambda name: core.Statement(core.Assignment(name, "value")),
+        "FunctionCall": lambda name: core.FunctionCall(name, ["arg"]),
+        "Block": lambda name: core.Block(),
+    }
+
+
+def traced_size(func: Callable[[], object]) -> tuple[int, int]:
+    """
+    Runs func under tracemalloc and returns (memory still in use, peak memory) in bytes.
+    Memory allocated before the call is not included.
+    """
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return current - base, peak - base
+
+
+def run_memory(scale: float, name_filter: str) -> dict[str, float]:
+    """
+    Runs memory benchmarks and returns sizes in bytes per benchmark name
+    """
+    results: dict[str, float] = {}
+    count = max(1, int(ELEMENT_COUNT * scale))
+    names = [f"name{i}" for i in range(count)]
+    for element_name, make_element in make_elements().items():
+        name = f"element/{element_name}"
+        if name_filter not in name:
+            continue
+        used, _ = traced_size(lambda: [make_element(x) for x in names])  # pylint: disable=cell-var-from-loop
+        results[name] = round(used / count, 1)
+        print(f"{name:45} {results[name]:10.1f} bytes/element")
+    style = STYLES["allman"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "output.c")
+        for model_name, (_, _, iterative) in MODELS.items():
+            name = f"model/{model_name}"
+            if name_filter in name:
+                results[name], _ = traced_size(lambda: make_model(model_name, scale))  # pylint: disable=W0640
+                print(f"{name:45} {results[name]/1024:10.1f} KiB")
+            sequence = make_model(model_name, scale)
+            writer = cfile.Writer(style, iterative=iterative)
+            for mode, func in (("write_str", lambda: writer.write_str(sequence)),
+                               ("write_file", lambda: writer.write_file(sequence, file_path))):
+                name = f"render_peak/{model_name}/{mode}"
+                if name_filter not in name:
+                    continue
+                _, results[name] = traced_size(func)
+                print(f"{name:45} {results[name]/1024:10.1f} KiB")
+    return results
+
+
+def best_time(func: Callable[[], object], repeat: int) -> float:
+    """
+    Best wall-clock time of func in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(scale: float, repeat: int, name_filter: str) -> dict[str, float]:
+    """
+    Runs benchmarks and returns best time per benchmark name
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "output.c")
+        for model_name, (_, _, iterative) in MODELS.items():
+            sequence = make_model(model_name, scale)
+            for style_name, style in STYLES.items():
+                writer = cfile.Writer(style, iterative=iterative)
+                for mode, func in (("write_str", lambda: writer.write_str(sequence)),
+                                   ("write_file", lambda: writer.write_file(sequence, file_path))):
+                    name = f"{model_name}/{style_name}/{mode}"
+                    if name_filter not in name:
+                        continue
+                    results[name] = best_time(func, repeat)
+                    print(f"{name:45} {results[name]*1000:10.1f} ms")
+    return results
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """
+    Returns names of benchmarks that regressed beyond threshold
+    """
+    regressions = []
+    for name, elapsed in results.items():
+        reference = baseline.get(name, None)
+        if reference is None:
+            print(f"{name:45} no baseline")
+            continue
+        change = elapsed / reference - 1.0
+        status = "REGRESSION" if change > threshold else "ok"
+        print(f"{name:45} {change:+8.1%}  {status}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def load_baseline(path: str) -> dict | None:
+    """
+    Loads baseline file, returns None if it doesn't exist
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as fh:  # pylint: disable=invalid-name
+        return json.load(fh)
+
+
+def main() -> int:
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="cfile benchmark suite")
+    parser.add_argument("--record", action="store_true", help="Store results as new baseline")
+    parser.add_argument("--memory", action="store_true", help="Run memory benchmarks instead of timings")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed regression (0.25 = 25%%)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Model size scale factor")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark")
+    parser.add_argument("--filter", default="", help="Only run benchmarks containing this text")
+    args = parser.parse_args()
+    section = "memory" if args.memory else "timings"
+    if args.memory:
+        results = run_memory(args.scale, args.filter)
+    else:
+        results = run(args.scale, args.repeat, args.filter)
+    data = load_baseline(args.baseline)
+    if args.record:
+        if data is None or data.get("scale") != args.scale:
+            data = {"scale": args.scale}
+        data[section] = results
+        with open(args.baseline, "w", encoding="utf-8") as fh:  # pylint: disable=invalid-name
+            json.dump(data, fh, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if data is None or section not in data:
+        print(f"No {section} baseline found in {args.baseline}, run with --record first")
+        return 1
+    if data.get("scale") != args.scale:
+        print(f"Baseline was recorded with scale {data.get('scale')}, not {args.scale}")
+        return 1
+    regressions = compare(results, data[section], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+cfile render cache
+"""
+import functools
+import hashlib
+import os
+import threading
+import types
+import uuid
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Callable, Iterable
+from cfile import core
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024  # Default size limit of RenderCache in bytes
+_DIGEST_SIZE = 16
+_FILE_READ_SIZE = 0x100000  # Bytes read at a time when hashing files
+
+_SCALAR_TYPES = frozenset([str, int, float, bool, type(None), bytes, bytearray])
+
+# Names of slot attributes per class, used when fingerprinting objects
+_slot_names: dict[type, tuple[str, ...]] = {}
+
+
+def fingerprint(obj: Any) -> str:
+    """
+    Structural fingerprint of a model object, for example an element, a sequence or StyleOptions.
+    Two objects have the same fingerprint when they are of the same classes and have equal
+    public attributes (attributes not starting with underscore), set in the same order.
+    Fingerprints of file initializers include the content of the file, fingerprints
+    of functions include their compiled code, default arguments and closure variables.
+    Raises TypeError for objects that can't be fingerprinted and ValueError for models
+    that are too deep or contain reference cycles.
+    """
+    tokens: list[str] = []
+    try:
+        _walk(obj, tokens.append)
+    except RecursionError as err:
+        raise ValueError("Model is too deep or contains a reference cycle") from err
+    return hashlib.blake2b("\x1f".join(tokens).encode("utf-8"), digest_size=_DIGEST_SIZE).hexdigest()
+
+
+def fingerprints(objects: Iterable[Any]) -> list[str]:
+    """
+    Fingerprint of each object
+    """
+    return [fingerprint(obj) for obj in objects]
+
+
+def combine(*parts: str) -> str:
+    """
+    Combines fingerprints (or other strings) into a new fingerprint
+    """
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=_DIGEST_SIZE).hexdigest()
+
+
+def _get_slot_names(cls: type) -> tuple[str, ...]:
+    names = _slot_names.get(cls, None)
+    if names is None:
+        slot_names: list[str] = []
+        for base in reversed(cls.__mro__):
+            slots = base.__dict__.get("__slots__", ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if isinstance(getattr(cls, name, None), property):
+                    continue  # Replaced by a computed property, for example elements of SequenceChain
+                if not name.startswith("_") and name not in slot_names:
+                    slot_names.append(name)
+        names = tuple(slot_names)
+        _slot_names[cls] = names
+    return names
+
+
+def _walk(obj: Any, out: Callable[[str], None]) -> None:
+    """
+    Writes tokens describing obj to out. Scalars are written using repr, which makes
+    them distinguishable from names and structure tokens.
+    """
+    cls = obj.__class__
+    if cls in _SCALAR_TYPES:
+        out(repr(obj))
+    elif cls is list or cls is tuple:
+        out("[")
+        for item in obj:
+            _walk(item, out)
+        out("]")
+    elif isinstance(obj, Enum):
+        out(f"<{cls.__module__}.{cls.__qualname__}.{obj.name}>")
+    elif isinstance(obj, core.LazySequence):
+        raise TypeError("Can't fingerprint LazySequence without consuming it")
+    elif isinstance(obj, type):
+        out(f"<class {obj.__module__}.{obj.__qualname__}>")
+    elif isinstance(obj, functools.partial):
+        out("<partial")
+        _walk(obj.func, out)
+        _walk(obj.args, out)
+        _walk(sorted(obj.keywords.items()), out)
+        out(">")
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        out(f"<function {obj.__module__}.{obj.__qualname__}>")
+        code = getattr(obj, "__code__", None)
+        if code is not None:
+            _walk_code(code, out)
+            _walk(getattr(obj, "__defaults__", None), out)
+            _walk(sorted((getattr(obj, "__kwdefaults__", None) or {}).items()), out)
+            for cell in getattr(obj, "__closure__", None) or ():
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    out("<empty cell>")
+                    continue
+                if value is obj or value is getattr(obj, "__func__", None):
+                    out("<self>")  # Recursive nested function
+                else:
+                    _walk(value, out)
+    elif hasattr(cls, "__next__"):
+        raise TypeError(f"Can't fingerprint iterator of type {cls.__name__} without consuming it")
+    else:
+        obj_dict = getattr(obj, "__dict__", None)
+        slot_names = _get_slot_names(cls)
+        if obj_dict is None and not slot_names:
+            raise TypeError(f"Can't fingerprint object of type {cls.__name__}")
+        out(f"<{cls.__module__}.{cls.__qualname__}")
+        for name in slot_names:
+            value = getattr(obj, name, _MISSING)
+            if value is not _MISSING:
+                out(name)
+                _walk(value, out)
+        if obj_dict is not None:
+            for name, value in obj_dict.items():
+                if name[0] != "_":
+                    out(name)
+                    _walk(value, out)
+        if isinstance(obj, core.FileInitializer):
+            out("content")
+            out(_file_digest(obj.path))
+        out(">")
+
+
+def _walk_code(code: types.CodeType, out: Callable[[str], Any]) -> None:
+    """
+    Tokens of compiled code and the code of nested functions
+    """
+    out(code.co_code.hex())
+    out(" ".join(code.co_names))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _walk_code(const, out)
+        elif isinstance(const, frozenset):  # Iteration order of sets of strings differs between processes
+            out(repr(sorted(map(repr, const))))
+        else:
+            out(repr(const))
+
+
+def _file_digest(path: str) -> str:
+    """
+    Hash of file content
+    """
+    digest = hashlib.blake2b(digest_size=_DIGEST_SIZE)
+    with open(path, "rb") as fh:  # pylint: disable=invalid-name
+        while True:
+            data = fh.read(_FILE_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+_MISSING = object()
+
+
+@dataclass
+class CacheStats:
+    """
+    RenderCache statistics
+    """
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size: int = 0  # Total size of cache entries in bytes
+    max_size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Share of lookups found in cache (0.0 - 1.0)
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self) -> str:
+        """
+        Statistics as human-readable text
+        """
+        return "\n".join([f"Lookups: {self.hits + self.misses} ({self.hits} hits, {self.misses} misses, "
+                          f"hit rate {self.hit_rate:.1%})",
+                          f"Writes: {self.writes}",
+                          f"Evictions: {self.evictions}",
+                          f"Entries: {self.entries}",
+                          f"Size: {self.size} / {self.max_size} bytes"])
+
+
+class RenderCache:
+    """
+    On-disk cache of rendered text, keyed by fingerprint.
+    Least recently used entries are removed when the total size exceeds max_size.
+    The directory can be shared between runs and between processes.
+    """
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._stats = CacheStats(max_size=max_size)
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".txt"):
+                self._stats.entries += 1
+                self._stats.size += entry.stat().st_size
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".txt")
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns cached text or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8", newline="") as fh:  # pylint: disable=invalid-name
+                text = fh.read()
+            os.utime(path)  # Marks entry as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self._stats.misses += 1
+            return None
+        with self._lock:
+            self._stats.hits += 1
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        """
+        Stores text in cache, then evicts least recently used entries if cache is too large
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:12]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as fh:  # pylint: disable=invalid-name
+            fh.write(text)
+        size = os.path.getsize(tmp_path)
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = None
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._stats.writes += 1
+            if old_size is None:
+                self._stats.entries += 1
+                self._stats.size += size
+            else:
+                self._stats.size += size - old_size
+            evict = self._stats.size > self.max_size
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".txt"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        count = len(entries)
+        evictions = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            count -= 1
+            evictions += 1
+        with self._lock:
+            self._stats.size = size
+            self._stats.entries = count
+            self._stats.evictions += evictions
+
+    def clear(self) -> None:
+        """
+        Removes all entries
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".txt"):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._stats.size = 0
+            self._stats.entries = 0
+
+    def stats(self) -> CacheStats:
+        """
+        Copy of current statistics
+        """
+        with self._lock:
+            return CacheStats(**vars(self._stats))
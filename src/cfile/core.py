@@ -1,19 +1,28 @@
 """
 cfile core
 """
-from typing import Union, Any
+import itertools
+import weakref
+from typing import Union, Any, Callable, Iterable, Iterator
+
+_versions = itertools.count(1)  # Source of sequence versions, shared so that versions increase across sequences
+_latest_version = 0  # Last version taken from _versions, computed sequence versions are valid until it changes
+_process_slots = frozenset(("_version", "_tree_version", "_tree_lazy", "_tree_stamp", "__weakref__"))  # Not pickled
 
 
 class Element:
     """
     A code element, for example an expression
     """
+    __slots__ = ()
 
 
 class Directive(Element):
     """
     Preprocessor directive
     """
+    __slots__ = ("adjust",)
+
     def __init__(self, adjust: int = 0) -> None:
         self.adjust = adjust
 
@@ -22,6 +31,8 @@ class IncludeDirective(Directive):
     """
     Include directive
     """
+    __slots__ = ("path_to_file", "system")
+
     def __init__(self, path_to_file: str, system: bool = False, adjust: int = 0) -> None:
         super().__init__(adjust)
         self.path_to_file = path_to_file
@@ -32,6 +43,8 @@ class IfdefDirective(Directive):
     """
     Ifdef preprocessor directive
     """
+    __slots__ = ("identifier",)
+
     def __init__(self, identifier: str, adjust: int = 0) -> None:
         super().__init__(adjust)
         self.identifier = identifier
@@ -41,6 +54,8 @@ class IfndefDirective(Directive):
     """
     Ifndef preprocessor directive
     """
+    __slots__ = ("identifier",)
+
     def __init__(self, identifier: str, adjust: int = 0) -> None:
         super().__init__(adjust)
         self.identifier = identifier
@@ -50,12 +65,15 @@ class EndifDirective(Directive):
     """
     Endif preprocessor directive
     """
+    __slots__ = ()
 
 
 class DefineDirective(Directive):
     """
     Preprocessor define directive
     """
+    __slots__ = ("left", "right")
+
     def __init__(self, left: str, right: str | None = None, adjust: int = 0) -> None:
         super().__init__(adjust)
         self.left = left
@@ -66,6 +84,8 @@ class Extern(Element):
     """
     Extern declaration
     """
+    __slots__ = ("language",)
+
     def __init__(self, language: str) -> None:
         self.language = language
 
@@ -75,6 +95,8 @@ class Comment(Element):
     Comment base
     adjust: Adds spaces before comment begins to allow right-adjustment
     """
+    __slots__ = ("text", "adjust")
+
     def __init__(self, text: str | list[str], adjust: int = 1) -> None:
         self.text = text
         self.adjust = adjust
@@ -88,6 +110,8 @@ class BlockComment(Comment):
     line_start: Combine with width > 0. Puts this string at beginning of each line
                 inside the comment
     """
+    __slots__ = ("width", "line_start")
+
     def __init__(self,
                  text: str | list[str],
                  adjust: int = 1, width: int = 0,
@@ -101,12 +125,15 @@ class LineComment(Comment):
     """
     Line Comment
     """
+    __slots__ = ()
 
 
 class Whitespace(Element):
     """
     Whitespace
     """
+    __slots__ = ("width",)
+
     def __init__(self, width) -> None:
         self.width = width
 
@@ -115,6 +142,8 @@ class Blank(Whitespace):
     """
     Blank line
     """
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__(0)
 
@@ -123,6 +152,8 @@ class Line(Element):
     """
     Adds a newline once all inner parts have been written
     """
+    __slots__ = ("parts",)
+
     def __init__(self, parts: str | Element | list) -> None:
         if isinstance(parts, (str, Element)):
             self.parts = [parts]
@@ -136,6 +167,8 @@ class DataType(Element):
     """
     Base class for all data types
     """
+    __slots__ = ("name",)
+
     def __init__(self, name: str | None) -> None:
         self.name = name
 
@@ -144,6 +177,8 @@ class Type(DataType):
     """
     Data type
     """
+    __slots__ = ("base_type", "const", "volatile", "pointer", "array", "__weakref__")
+
     def __init__(self,
                  base_type: Union[str, "Type"],
                  const: bool = False,
@@ -169,12 +204,43 @@ class Type(DataType):
             raise KeyError(name)
 
 
+class TypePool:
+    """
+    Pool of shared Type instances. Identical types are only created once and are
+    kept in the pool for as long as they are in use.
+    Types from the pool are shared, they must not be modified.
+    """
+    def __init__(self) -> None:
+        self._types: weakref.WeakValueDictionary[tuple, Type] = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def get(self,
+            base_type: Union[str, "Type"],
+            const: bool = False,
+            pointer: bool = False,
+            volatile: bool = False,
+            array: int | None = None) -> Type:
+        """
+        Returns shared type, creates it if needed
+        """
+        key = (base_type, const, volatile, pointer, array)
+        data_type = self._types.get(key, None)
+        if data_type is None:
+            data_type = Type(base_type, const, pointer, volatile, array)
+            self._types[key] = data_type
+        return data_type
+
+
 class StructMember(Element):
     """
     Struct element. This is similar to Variable
     but doesn't support type qualifier such as static
     or extern
     """
+    __slots__ = ("name", "const", "pointer", "array", "data_type")
+
     def __init__(self,
                  name: str,
                  data_type: DataType | str,
@@ -197,6 +263,8 @@ class Struct(DataType):
     """
     A struct definition
     """
+    __slots__ = ("members",)
+
     def __init__(self, name: str | None, members: StructMember | list[StructMember] | None = None) -> None:
         super().__init__(name)
         self.members: list[StructMember] = []
@@ -235,6 +303,8 @@ class TypeDef(DataType):
     """
     Type definition (typedef)
     """
+    __slots__ = ("const", "volatile", "pointer", "array", "base_type")
+
     def __init__(self,
                  name: str,
                  base_type: Union[str, "DataType", "Declaration"],
@@ -277,6 +347,8 @@ class Variable(Element):
     """
     Variable declaration
     """
+    __slots__ = ("name", "const", "pointer", "extern", "static", "array", "data_type")
+
     def __init__(self,
                  name: str,
                  data_type: str | DataType,
@@ -316,6 +388,8 @@ class Function(Element):
     """
     Function declaration
     """
+    __slots__ = ("name", "static", "const", "extern", "return_type", "params")
+
     def __init__(self,
                  name: str,
                  return_type: str | DataType | None = None,
@@ -373,6 +447,8 @@ class Declaration(Element):
     - DataType (including struct)
     - Function
     """
+    __slots__ = ("element", "init_value")
+
     def __init__(self,
                  element: Union[Variable, Function, DataType],
                  init_value: Any | None = None) -> None:
@@ -391,6 +467,8 @@ class FunctionCall(Element):
     """
     Function call expression
     """
+    __slots__ = ("name", "args")
+
     def __init__(self, name: str, args: list[int | float | str | Element] | None = None) -> None:
         self.name = name
         self.args: list[str | Element] = []
@@ -415,6 +493,8 @@ class FunctionReturn(Element):
     """
     Function return expression
     """
+    __slots__ = ("expression",)
+
     def __init__(self,
                  expression: int | float | bool | str | Element) -> None:
         self.expression: str | Element
@@ -432,6 +512,8 @@ class Assignment(Element):
     """
     Assignment has a left-hand-side and right-hand-side expressions
     """
+    __slots__ = ("lhs", "rhs")
+
     def __init__(self, lhs: Any, rhs: Any) -> None:
         self.lhs = self._check_and_convert(lhs)
         self.rhs = self._check_and_convert(rhs)
@@ -451,6 +533,8 @@ class Statement(Element):
     """
     A statement can contain one or more expressions
     """
+    __slots__ = ("parts",)
+
     def __init__(self, expression: Any) -> None:
         parts = []
         if isinstance(expression, (list, tuple)):
@@ -474,40 +558,385 @@ class Statement(Element):
 class StringLiteral(Element):
     """
     String literal
+    text: Text, or iterable of text chunks such as a text file or a generator.
+          An iterator can only be written once.
+    escape: Escape quotes, backslashes and control characters. Otherwise text is written as is.
+    max_bytes: When set, text is split into adjacent literals (one per line) of at most
+               max_bytes bytes (UTF-8) each, without splitting escape sequences or characters.
     """
-    def __init__(self, text: str) -> None:
+    __slots__ = ("text", "escape", "max_bytes")
+
+    def __init__(self, text: str | Iterable[str], escape: bool = False, max_bytes: int | None = None) -> None:
+        if max_bytes is not None and max_bytes < 10:
+            raise ValueError("max_bytes: Must be at least 10, the length of the longest escape sequence")
         self.text = text
+        self.escape = escape
+        self.max_bytes = max_bytes
+
+
+class ArrayInitializer(Element):
+    """
+    Initializer for an array of numbers
+    values: List or tuple of numbers, or object supporting the buffer protocol, for example
+            bytes, array.array, memoryview or a NumPy array, containing integers or floats
+    values_per_line: When > 0, values are written in rows of this length, one row per line
+    hex: Writes integers as hexadecimal numbers
+    hex_digits: Minimum number of hexadecimal digits. Default is two per byte of buffer items,
+                two for lists and tuples.
+    suffix: Suffix added to each value, for example "U"
+    """
+    __slots__ = ("values", "values_per_line", "hex", "hex_digits", "suffix")
+
+    def __init__(self,
+                 values: Any,
+                 values_per_line: int = 0,
+                 hex: bool = False,  # pylint: disable=redefined-builtin
+                 hex_digits: int | None = None,
+                 suffix: str = "") -> None:
+        if not isinstance(values, (list, tuple)):
+            with memoryview(values):  # Raises TypeError if values doesn't support the buffer protocol
+                pass
+        self.values = values
+        self.values_per_line = values_per_line
+        self.hex = hex
+        self.hex_digits = hex_digits
+        self.suffix = suffix
+
+
+class FileInitializer(Element):
+    """
+    Initializer for a byte array, containing bytes of a binary file.
+    The file is read (memory-mapped) while writing, bytes are written as hexadecimal numbers.
+    size: Expected size of file in bytes. Writing fails if the file has a different size.
+    values_per_line: Number of bytes per line
+    """
+    __slots__ = ("path", "size", "values_per_line")
+
+    def __init__(self, path: str, size: int | None = None, values_per_line: int = 12) -> None:
+        self.path = path
+        self.size = size
+        self.values_per_line = values_per_line
 
 
 class Sequence:
     """
     A sequence of statements, comments or whitespace
+
+    Changes are tracked by version: each change made through append, extend or item assignment
+    gives the sequence, and all sequences it's nested in, a new and higher version.
+    Call touch after modifying elements in place.
     """
+    __slots__ = ("elements", "_version", "_tree_version", "_tree_lazy", "_tree_stamp", "__weakref__")
+
     def __init__(self) -> None:
         self.elements: list[Union[Comment, Statement, "Sequence"]] = []
+        self._version = 0  # Version of changes made to this sequence
+        self._tree_version = 0  # Highest version of this and nested sequences, valid while _tree_stamp is current
+        self._tree_lazy = False  # This or a nested sequence is a LazySequence, valid while _tree_stamp is current
+        self._tree_stamp = -1
 
     def __len__(self) -> int:
         return len(self.elements)
 
+    def __setitem__(self, index: int | slice, value: Any) -> None:
+        self.elements[index] = value
+        self.touch()
+
+    def __getstate__(self) -> tuple[None, dict[str, Any]]:
+        # Versions are only comparable within a process, unpickled sequences get new ones
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name in _process_slots or isinstance(getattr(type(self), name, None), property):
+                    continue  # Slots replaced by a computed property, for example elements of SequenceChain
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return None, state
+
+    def __setstate__(self, state: tuple[None, dict[str, Any]]) -> None:
+        for name, value in state[1].items():
+            setattr(self, name, value)
+        self._tree_version = 0
+        self._tree_lazy = False
+        self._tree_stamp = -1
+        self.touch()
+
+    @property
+    def version(self) -> int:
+        """
+        Version of the sequence, increases on every change to it or to a sequence nested in it
+        """
+        if self._tree_stamp != _latest_version:
+            _compute_tree(self)
+        return self._tree_version
+
+    @property
+    def contains_lazy(self) -> bool:
+        """
+        True if this sequence, or a sequence nested in it, is a LazySequence.
+        Output of such sequences can change without a change of version.
+        """
+        if self._tree_stamp != _latest_version:
+            _compute_tree(self)
+        return self._tree_lazy
+
+    def touch(self) -> None:
+        """
+        Marks sequence, and all sequences it's nested in, as changed
+        """
+        global _latest_version  # pylint: disable=global-statement
+        self._version = _latest_version = next(_versions)
+
+    def _nested(self) -> Iterable["Sequence"]:
+        """
+        Sequences whose changes are part of the version of this sequence
+        """
+        return (elem for elem in self.elements if isinstance(elem, Sequence))
+
     def append(self, elem: Any) -> "Sequence":
         """
         Appends one element to this sequence
         """
         self.elements.append(elem)
+        self.touch()
         return self
 
     def extend(self, seq) -> "Sequence":
         """
         Extends this sequence with items from another sequence
         """
+        if isinstance(seq, LazySequence):
+            raise TypeError("seq: Can't copy elements of LazySequence, append it instead")
         if isinstance(seq, Sequence):
             self.elements.extend(seq.elements)
         else:
             raise TypeError("seq must be of type Sequence")
+        self.touch()
         return self
 
+    def view(self, start: int | None = None, stop: int | None = None) -> "SequenceView":
+        """
+        Returns a view of elements start to stop, elements are not copied
+        """
+        return SequenceView(self, start, stop)
+
 
 class Block(Sequence):
     """
     A sequence wrapped in braces
     """
+    __slots__ = ()
+
+
+class LazySequence(Sequence):
+    """
+    A sequence whose elements are produced while it's being written, they are never stored.
+    source: Iterable of elements, or function returning an iterable of elements.
+            A function is called each time the sequence is written. An iterator
+            (for example a generator) can only be written once.
+    length: Number of elements, if known. Required for len().
+    When a LazySequence is an element of another sequence, its elements are written in its place.
+    """
+    __slots__ = ("source", "length", "_consumed")
+
+    def __init__(self,
+                 source: Iterable[Any] | Callable[[], Iterable[Any]],
+                 length: int | None = None) -> None:  # pylint: disable=super-init-not-called
+        if not (callable(source) or isinstance(source, Iterable)):
+            raise TypeError(f"source: Expected an iterable or a callable, got {str(type(source))}")
+        self.source = source
+        self.length = length
+        self._consumed = False
+        self._version = 0
+        self._tree_version = 0
+        self._tree_lazy = False
+        self._tree_stamp = -1
+
+    @property  # type: ignore[override]
+    def elements(self) -> Iterator[Any]:  # pylint: disable=invalid-overridden-method
+        """
+        New iterator over the elements
+        """
+        source = self.source
+        if callable(source):
+            return iter(source())
+        elements = iter(source)
+        if elements is source:
+            if self._consumed:
+                raise RuntimeError("LazySequence has already been consumed")
+            self._consumed = True
+        return elements
+
+    def __len__(self) -> int:
+        if self.length is None:
+            raise TypeError("LazySequence has no length")
+        return self.length
+
+    def __bool__(self) -> bool:
+        return self.length is None or self.length > 0
+
+    def _nested(self) -> Iterable[Sequence]:
+        return ()
+
+    def __setitem__(self, index: int | slice, value: Any) -> None:
+        raise TypeError("Can't assign to LazySequence")
+
+    def append(self, elem: Any) -> "Sequence":
+        """
+        Not supported, elements are produced by source
+        """
+        raise TypeError("Can't append to LazySequence")
+
+    def extend(self, seq) -> "Sequence":
+        """
+        Not supported, elements are produced by source
+        """
+        raise TypeError("Can't extend LazySequence")
+
+
+class SequenceChain(Sequence):
+    """
+    Concatenation of sequences. Elements are not copied, changes to the sequences
+    are visible through the chain. The same sequence can be part of several chains.
+    """
+    __slots__ = ("sequences",)
+
+    def __init__(self, *sequences: Sequence) -> None:  # pylint: disable=super-init-not-called
+        self.sequences: list[Sequence] = []
+        self._version = 0
+        self._tree_version = 0
+        self._tree_lazy = False
+        self._tree_stamp = -1
+        for seq in sequences:
+            self.extend(seq)
+
+    @property  # type: ignore[override]
+    def elements(self) -> Iterator[Any]:  # pylint: disable=invalid-overridden-method
+        """
+        New iterator over the elements of all sequences
+        """
+        return itertools.chain.from_iterable(seq.elements for seq in self.sequences)
+
+    def __len__(self) -> int:
+        return sum(len(seq) for seq in self.sequences)
+
+    def __bool__(self) -> bool:
+        return any(self.sequences)
+
+    def _nested(self) -> Iterable[Sequence]:
+        return self.sequences
+
+    def __setitem__(self, index: int | slice, value: Any) -> None:
+        raise TypeError("Can't assign to SequenceChain, assign to one of its sequences")
+
+    def append(self, elem: Any) -> "Sequence":
+        """
+        Not supported, append elements to one of the sequences instead
+        """
+        raise TypeError("Can't append element to SequenceChain, append it to one of its sequences")
+
+    def extend(self, seq) -> "Sequence":
+        """
+        Adds sequence to end of chain without copying its elements
+        """
+        if not isinstance(seq, Sequence):
+            raise TypeError("seq must be of type Sequence")
+        self.sequences.append(seq)
+        self.touch()
+        return self
+
+
+class SequenceView(Sequence):
+    """
+    View of elements start to stop of a sequence. Elements are not copied, changes to the
+    sequence are visible through the view. Negative indices require len() of the sequence.
+    """
+    __slots__ = ("sequence", "start", "stop")
+
+    def __init__(self,
+                 sequence: Sequence,
+                 start: int | None = None,
+                 stop: int | None = None) -> None:  # pylint: disable=super-init-not-called
+        if not isinstance(sequence, Sequence):
+            raise TypeError("sequence must be of type Sequence")
+        self.sequence = sequence
+        self.start = start
+        self.stop = stop
+        self._version = 0
+        self._tree_version = 0
+        self._tree_lazy = False
+        self._tree_stamp = -1
+
+    def _range(self) -> range:
+        return range(*slice(self.start, self.stop).indices(len(self.sequence)))
+
+    @property  # type: ignore[override]
+    def elements(self) -> Iterator[Any]:  # pylint: disable=invalid-overridden-method
+        """
+        New iterator over the elements in view
+        """
+        elements = self.sequence.elements
+        if isinstance(elements, list):
+            return (elements[i] for i in self._range())
+        start, stop = self.start, self.stop
+        if (start or 0) < 0 or (stop or 0) < 0:
+            indices = self._range()
+            start, stop = indices.start, indices.stop
+        return itertools.islice(elements, start, stop)
+
+    def __len__(self) -> int:
+        return len(self._range())
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def _nested(self) -> Iterable[Sequence]:
+        return (self.sequence,)
+
+    def __setitem__(self, index: int | slice, value: Any) -> None:
+        raise TypeError("Can't assign to SequenceView")
+
+    def append(self, elem: Any) -> "Sequence":
+        """
+        Not supported, views are read-only
+        """
+        raise TypeError("Can't append to SequenceView")
+
+    def extend(self, seq) -> "Sequence":
+        """
+        Not supported, views are read-only
+        """
+        raise TypeError("Can't extend SequenceView")
+
+
+def _compute_tree(root: Sequence) -> None:
+    """
+    Computes version of root as the highest version of root and all sequences nested in it,
+    and whether any of them is a LazySequence. Results are kept in each sequence until the next
+    change to any sequence.
+    """
+    # pylint: disable=protected-access
+    stamp = _latest_version
+    root._tree_stamp = stamp
+    root._tree_version = root._version
+    root._tree_lazy = isinstance(root, LazySequence)
+    stack = [(root, iter(root._nested()))]
+    while stack:
+        seq, nested = stack[-1]
+        for child in nested:
+            if child._tree_stamp != stamp:  # Also ends reference cycles
+                child._tree_stamp = stamp
+                child._tree_version = child._version
+                child._tree_lazy = isinstance(child, LazySequence)
+                stack.append((child, iter(child._nested())))
+                break
+            if child._tree_version > seq._tree_version:
+                seq._tree_version = child._tree_version
+            seq._tree_lazy = seq._tree_lazy or child._tree_lazy
+        else:
+            stack.pop()
+            if stack:
+                parent = stack[-1][0]
+                if seq._tree_version > parent._tree_version:
+                    parent._tree_version = seq._tree_version
+                parent._tree_lazy = parent._tree_lazy or seq._tree_lazy
@@ -1,8 +1,9 @@
 """
 Factory classes
 """
+import os
 from collections import namedtuple
-from typing import Union, Any
+from typing import Union, Any, Callable, Iterable
 from cfile import core
 
 BuiltInTypes = namedtuple("BuiltInTypes", ["char",
@@ -24,8 +25,23 @@ types = BuiltInTypes(core.Type("char"),
 class CFactory:
     """
     Factory for the C programming language
+
+    intern_types: When True, types are taken from a TypePool, so identical types
+                  created by this factory (including types given by name) are shared.
+                  Shared types must not be modified.
     """
 
+    def __init__(self, intern_types: bool = False) -> None:
+        self.type_pool = core.TypePool() if intern_types else None
+
+    def _data_type(self, data_type: Any) -> Any:
+        """
+        Returns type from pool when data_type is a type name and types are interned
+        """
+        if self.type_pool is not None and isinstance(data_type, str):
+            return self.type_pool.get(data_type)
+        return data_type
+
     def blank(self) -> core.Blank:
         """
         Blank line
@@ -66,6 +82,20 @@ class CFactory:
         """
         return core.Sequence()
 
+    def lazy_sequence(self,
+                      source: Iterable[Any] | Callable[[], Iterable[Any]],
+                      length: int | None = None) -> core.LazySequence:
+        """
+        New lazy sequence, its elements are produced by source while writing
+        """
+        return core.LazySequence(source, length)
+
+    def sequence_chain(self, *sequences: core.Sequence) -> core.SequenceChain:
+        """
+        New chain of sequences, elements are not copied
+        """
+        return core.SequenceChain(*sequences)
+
     def include(self, path_to_file: str, adjust: int = 0) -> core.IncludeDirective:
         """
         New include directive
@@ -124,7 +154,9 @@ class CFactory:
         """
         New function
         """
-        return core.Function(name, return_type, static, const, extern, params)
+        if return_type is None and self.type_pool is not None:
+            return_type = "void"
+        return core.Function(name, self._data_type(return_type), static, const, extern, params)
 
     def type(self,
              type_ref: str | core.Type,
@@ -135,6 +167,8 @@ class CFactory:
         """
         New type
         """
+        if self.type_pool is not None:
+            return self.type_pool.get(type_ref, const, pointer, volatile, array)
         return core.Type(type_ref, const, pointer, volatile, array)
 
     def struct_member(self,
@@ -146,7 +180,7 @@ class CFactory:
         """
         New StructMember
         """
-        return core.StructMember(name, data_type, const, pointer, array)
+        return core.StructMember(name, self._data_type(data_type), const, pointer, array)
 
     def struct(self,
                name: str,
@@ -168,7 +202,7 @@ class CFactory:
         """
         New variable
         """
-        return core.Variable(name, data_type, const, pointer, extern, static, array)
+        return core.Variable(name, self._data_type(data_type), const, pointer, extern, static, array)
 
     def typedef(self,
                 name: str,
@@ -180,7 +214,7 @@ class CFactory:
         """
         New typedef
         """
-        return core.TypeDef(name, base_type, const, pointer, volatile, array)
+        return core.TypeDef(name, self._data_type(base_type), const, pointer, volatile, array)
 
     def statement(self, expression: Any) -> core.Statement:
         """
@@ -194,11 +228,49 @@ class CFactory:
         """
         return core.Assignment(lhs, rhs)
 
-    def str_literal(self, text: str) -> core.StringLiteral:
-        """
-        New function call
-        """
-        return core.StringLiteral(text)
+    def array_initializer(self,
+                          values: Any,
+                          values_per_line: int = 0,
+                          hex: bool = False,  # pylint: disable=redefined-builtin
+                          hex_digits: int | None = None,
+                          suffix: str = "") -> core.ArrayInitializer:
+        """
+        New array initializer
+        """
+        return core.ArrayInitializer(values, values_per_line, hex, hex_digits, suffix)
+
+    def byte_array_from_file(self,
+                             name: str,
+                             path: str,
+                             values_per_line: int = 12,
+                             static: bool = False,
+                             length_type: str = "size_t") -> core.Sequence:
+        """
+        Declarations of a const uint8_t array named name, initialized with contents of binary file,
+        and of a constant named name + "_length" holding the number of bytes.
+        The file is read when the declarations are written.
+        """
+        size = os.path.getsize(path)
+        code = core.Sequence()
+        code.append(core.Statement(core.Declaration(core.Variable(f"{name}_length",
+                                                                  self.type(length_type, const=True),
+                                                                  static=static),
+                                                    size)))
+        code.append(core.Statement(core.Declaration(core.Variable(name,
+                                                                  self.type("uint8_t", const=True),
+                                                                  static=static,
+                                                                  array=size),
+                                                    core.FileInitializer(path, size, values_per_line))))
+        return code
+
+    def str_literal(self,
+                    text: str | Iterable[str],
+                    escape: bool = False,
+                    max_bytes: int | None = None) -> core.StringLiteral:
+        """
+        New string literal
+        """
+        return core.StringLiteral(text, escape, max_bytes)
 
     arg_types = int | float | str | core.Element
 
@@ -0,0 +1,132 @@
+"""
+cfile source map
+"""
+import array
+import bisect
+import json
+from typing import Any, NamedTuple
+
+
+class SourceMapEntry(NamedTuple):
+    """
+    Position of one element in written output
+    """
+    kind: str  # Element class name
+    name: str  # Name of declared item, macro or included file. Empty for other elements.
+    line: int  # First line, 1-based
+    column: int  # Column on first line, 0-based
+    offset: int  # Offset of first character in output
+    length: int  # Number of characters written for the element
+    top_level: bool  # True for elements of the written sequence, False for nested declarations
+
+
+class SourceMap:
+    """
+    Positions of top-level elements and declarations in written output.
+    Entries are stored in parallel arrays, in order of offset.
+    """
+    _FIELDS = ("lines", "columns", "offsets", "lengths", "kinds", "top_level")
+
+    def __init__(self) -> None:
+        self.lines = array.array("q")
+        self.columns = array.array("q")
+        self.offsets = array.array("q")
+        self.lengths = array.array("q")
+        self.kinds = array.array("H")  # Index into kind_names
+        self.top_level = array.array("B")
+        self.kind_names: list[str] = []
+        self.names: list[str] = []
+        self._kind_index: dict[str, int] = {}
+        self._name_index: dict[str, list[int]] | None = None
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> SourceMapEntry:
+        return SourceMapEntry(self.kind_names[self.kinds[index]], self.names[index], self.lines[index],
+                              self.columns[index], self.offsets[index], self.lengths[index],
+                              bool(self.top_level[index]))
+
+    def add(self, kind: str, name: str, line: int, column: int, offset: int, length: int = 0,
+            top_level: bool = False) -> int:
+        """
+        Adds entry and returns its index
+        """
+        kind_index = self._kind_index.get(kind, None)
+        if kind_index is None:
+            kind_index = len(self.kind_names)
+            self.kind_names.append(kind)
+            self._kind_index[kind] = kind_index
+        self.lines.append(line)
+        self.columns.append(column)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.kinds.append(kind_index)
+        self.top_level.append(1 if top_level else 0)
+        self.names.append(name)
+        self._name_index = None
+        return len(self.names) - 1
+
+    def find(self, name: str) -> list[SourceMapEntry]:
+        """
+        Entries with name, in order of offset. The name index is built on first use.
+        """
+        if self._name_index is None:
+            name_index: dict[str, list[int]] = {}
+            for i, entry_name in enumerate(self.names):
+                if entry_name:
+                    name_index.setdefault(entry_name, []).append(i)
+            self._name_index = name_index
+        return [self[i] for i in self._name_index.get(name, [])]
+
+    def at_offset(self, offset: int) -> SourceMapEntry | None:
+        """
+        Innermost entry containing offset
+        """
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        while i >= 0:
+            if offset < self.offsets[i] + self.lengths[i]:
+                return self[i]
+            if self.top_level[i]:
+                break
+            i -= 1
+        return None
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Source map as dict of lists, suitable for JSON
+        """
+        data: dict[str, Any] = {"version": 1, "kind_names": list(self.kind_names), "names": list(self.names)}
+        for field in self._FIELDS:
+            data[field] = getattr(self, field).tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "SourceMap":
+        """
+        Creates source map from dict created by to_dict
+        """
+        if data.get("version", None) != 1:
+            raise ValueError(f"Unsupported source map version: {data.get('version', None)}")
+        source_map = cls()
+        source_map.kind_names = list(data["kind_names"])
+        source_map._kind_index = {name: i for i, name in enumerate(source_map.kind_names)}
+        source_map.names = list(data["names"])
+        for field in cls._FIELDS:
+            getattr(source_map, field).extend(data[field])
+        if any(len(getattr(source_map, field)) != len(source_map.names) for field in cls._FIELDS):
+            raise ValueError("Source map arrays have different lengths")
+        return source_map
+
+    def to_json(self) -> str:
+        """
+        Source map as JSON text
+        """
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text: str) -> "SourceMap":
+        """
+        Creates source map from JSON text created by to_json
+        """
+        return cls.from_dict(json.loads(text))
@@ -3,6 +3,7 @@ cfile style
 """
 from enum import Enum
 from dataclasses import dataclass
+from typing import Any
 
 
 class BreakBeforeBraces(Enum):
@@ -121,3 +122,56 @@ class StyleOptions:
         else:
             self.brace_wrapping = BraceWrapping.make(break_before_braces)
         self.short_functions_on_single_line = short_functions_on_single_line
+
+
+@dataclass(frozen=True)
+class CompiledStyle:
+    """
+    Lookup tables derived from StyleOptions. Holds the exact separator strings used by the writer.
+    Tables indexed by bool use whether the data type itself is a pointer type.
+    """
+    snapshot: tuple[Any, ...]  # Style settings the tables were compiled from
+    type_pointer: str  # Appended to name of pointer type
+    pointer: tuple[str, str]  # Between data type and declarator name when declaring pointer
+    const_pointer: str | None  # Same as pointer for const pointer, None when not supported
+    name_separator: tuple[str, str]  # Between data type and declarator name when not a pointer
+    wrap_after_function: bool  # Put opening brace of function body on its own line
+    wrap_after_struct: bool  # Put opening brace of struct on its own line
+    short_empty_block: bool  # Write closing brace of empty block right after opening brace
+
+    @staticmethod
+    def make_snapshot(style: StyleOptions) -> tuple[Any, ...]:
+        """
+        Settings that CompiledStyle depends on. Used for detecting changes in style.
+        """
+        return (tuple(style.type_qualifier_order),
+                style.pointer_alignment,
+                style.space_around_pointer_qualifiers,
+                style.brace_wrapping.after_function,
+                style.brace_wrapping.after_struct,
+                style.short_functions_on_single_line)
+
+    @classmethod
+    def compile(cls, style: StyleOptions) -> "CompiledStyle":
+        """
+        Compiles style options into lookup tables
+        """
+        if style.pointer_alignment == Alignment.LEFT:
+            type_pointer, pointer, const_pointer = "*", ("* ", "* "), "* const "
+        elif style.pointer_alignment == Alignment.RIGHT:
+            type_pointer, pointer, const_pointer = " *", (" *", "*"), "*const "
+        elif style.pointer_alignment == Alignment.MIDDLE:
+            type_pointer, pointer, const_pointer = " *", (" * ", " * "), " * const "
+        else:
+            raise ValueError(style.pointer_alignment)
+        if style.space_around_pointer_qualifiers != SpaceLocation.DEFAULT:
+            const_pointer = None
+        name_separator = (" ", "" if style.pointer_alignment == Alignment.RIGHT else " ")
+        return cls(cls.make_snapshot(style),
+                   type_pointer,
+                   pointer,
+                   const_pointer,
+                   name_separator,
+                   style.brace_wrapping.after_function,
+                   style.brace_wrapping.after_struct,
+                   style.short_functions_on_single_line in (ShortFunction.EMPTY, ShortFunction.INLINE))
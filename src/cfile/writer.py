@@ -2,12 +2,177 @@
 cfile writer
 """
 # pylint: disable=consider-using-with
-from io import StringIO
+import functools
+import importlib.metadata
+import mmap
+import os
+import re
+import shutil
+import threading
+import types
+import time
+import uuid
+import weakref
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
-from typing import TextIO, Any
+from typing import BinaryIO, TextIO, Any, Callable, Iterable, Iterator, Mapping
 from cfile import core
+from cfile.cache import RenderCache, combine, fingerprint
+from cfile.sourcemap import SourceMap
 import cfile.style as c_style
 
+DEFAULT_CHUNK_SIZE = 0x10000  # Default chunk size used by Writer.iter_chunks
+TYPE_CACHE_SIZE = 0x10000  # Max number of formatted types cached by Writer
+RENDER_CACHE_VERSION = "1"  # Change when writer output changes, invalidates render caches
+RENDER_CACHE_GROUP_SIZE = 16  # Average number of top-level elements per render cache entry
+INDENT_CACHE_LEVELS = 64  # Indentation strings are cached up to this level
+INITIALIZER_BATCH_SIZE = 0x4000  # Number of values formatted per batch in array initializers
+REGION_GROUP_SIZE = 8  # Average number of top-level elements per region, see Writer.write_file
+
+_HEX_BYTES = tuple(f"0x{i:02X}" for i in range(256))
+# Control characters without a short escape sequence, written as octal escapes in string literals
+_OCTAL_ESCAPED = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+_MAX_ESCAPE_LENGTH = 10  # Longest escape sequence, \Uhhhhhhhh
+_INT_FORMATS = frozenset("bBhHiIlLqQnN")
+_FLOAT_FORMATS = frozenset("efd")
+# Region markers written by Writer.write_file: begin marker with key, end marker with key,
+# last element type and CRC-32 of the text between the markers
+_REGION_MARKER = re.compile(rb"/\* cfile:(?:begin ([0-9a-f]+|-)|end ([0-9a-f]+|-) ([A-Z_]+) ([0-9a-f]{8})) \*/\r?\n")
+
+# Indentation strings per level, shared by formatters with same indentation char and width
+_indent_tables: dict[tuple[str, int], list[str]] = {}
+_indent_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4)
+def _hex_words(digits: int) -> tuple[str, ...]:
+    """
+    Hexadecimal text of all 16-bit values, built when first needed
+    """
+    return tuple(f"0x{i:0{digits}X}" for i in range(0x10000))
+
+
+def _escape_string(text: str) -> str:
+    """
+    Escapes text for use in a string literal. Replacing characters one kind at a time
+    is several times faster than str.translate, which maps characters one by one.
+    """
+    text = text.replace("\\", "\\\\").replace('"', '\\"')
+    text = text.replace("\n", "\\n").replace("\t", "\\t").replace("\r", "\\r")
+    if _OCTAL_ESCAPED.search(text):
+        text = _OCTAL_ESCAPED.sub(lambda match: f"\\{ord(match.group()):03o}", text)
+    return text
+
+
+def _escape_length(data: bytes, pos: int) -> int:
+    """
+    Length of escape sequence starting with the backslash at data[pos]
+    """
+    kind = data[pos + 1:pos + 2]
+    if not kind:
+        return 1
+    if kind in b"01234567":
+        length = 2
+        while length < 4 and pos + length < len(data) and data[pos + length] in b"01234567":
+            length += 1
+        return length
+    if kind == b"x":
+        length = 2
+        while pos + length < len(data) and data[pos + length] in b"0123456789abcdefABCDEF":
+            length += 1
+        return length
+    if kind == b"u":
+        return 6
+    if kind == b"U":
+        return 10
+    return 2
+
+
+def _literal_cut(data: bytes, start: int, cut: int) -> int:
+    """
+    Moves cut backwards (not beyond start) so it doesn't split a UTF-8 encoded character
+    or an escape sequence
+    """
+    while cut > start and data[cut] & 0xC0 == 0x80:
+        cut -= 1
+    pos = data.rfind(b"\\", max(start, cut - _MAX_ESCAPE_LENGTH), cut)
+    if pos >= 0:
+        run_start = pos
+        while run_start > start and data[run_start - 1] == 0x5C:
+            run_start -= 1
+        if (pos - run_start) % 2 == 0 and pos + _escape_length(data, pos) > cut:
+            cut = pos
+    if cut == start:
+        raise ValueError("String literal can't be split, max_bytes is too small")
+    return cut
+
+
+def _source_map_name(elem: Any) -> str:
+    """
+    Name of element in source map: name of declared item, macro or included file
+    """
+    if isinstance(elem, core.Statement) and elem.parts:
+        elem = elem.parts[0]
+    if isinstance(elem, core.Declaration):
+        elem = elem.element
+        if isinstance(elem, core.Type):
+            return elem.base_type if isinstance(elem.base_type, str) else ""
+    if isinstance(elem, (core.DataType, core.Variable, core.Function)):
+        return elem.name or ""
+    if isinstance(elem, core.DefineDirective):
+        return elem.left.partition("(")[0]
+    if isinstance(elem, core.IncludeDirective):
+        return elem.path_to_file
+    if isinstance(elem, (core.IfdefDirective, core.IfndefDirective)):
+        return elem.identifier
+    return ""
+
+
+@functools.cache
+def _package_version() -> str:
+    """
+    Version of installed cfile package, empty when running from source
+    """
+    try:
+        return importlib.metadata.version("cfile")
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+
+
+def _encode_output(text: str) -> bytes:
+    """
+    Text as written to file, with platform line endings
+    """
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode("utf-8")
+
+
+def _parse_regions(data: Any) -> list[tuple[str, int, int, str]] | None:
+    """
+    Regions of a file written using region markers, as (key, start, end, name of last element type).
+    Key is "-" for regions whose text has been changed since written. Returns None
+    unless data consists of regions only.
+    """
+    regions = []
+    pos = 0
+    markers = _REGION_MARKER.finditer(data)
+    for begin in markers:
+        end = next(markers, None)
+        if begin.start() != pos or begin[1] is None or end is None or end[2] != begin[1]:
+            return None
+        last_element = end[3].decode("ascii")
+        if last_element not in ElementType.__members__:
+            return None
+        key = begin[1].decode("ascii")
+        if zlib.crc32(data[begin.end():end.start()]) != int(end[4], 16):
+            key = "-"
+        regions.append((key, pos, end.end(), last_element))
+        pos = end.end()
+    return regions if pos == len(data) else None
+
 
 class ElementType(Enum):
     """
@@ -30,174 +195,1216 @@ class ElementType(Enum):
     BLOCK_END = 14
 
 
+@dataclass
+class FileResult:
+    """
+    Result of writing one file in Writer.write_files
+    """
+    path: str
+    changed: bool = False
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        """
+        True when the file was written without errors
+        """
+        return self.error is None
+
+
+@dataclass
+class WriterStats:
+    """
+    Writer statistics
+    """
+    type_cache_hits: int = 0
+    type_cache_misses: int = 0
+    fragment_hits: int = 0
+    fragment_misses: int = 0
+
+    @property
+    def type_cache_hit_rate(self) -> float:
+        """
+        Share of formatted types found in cache (0.0 - 1.0)
+        """
+        total = self.type_cache_hits + self.type_cache_misses
+        return self.type_cache_hits / total if total else 0.0
+
+
+@dataclass
+class ElementProfile:
+    """
+    Profile of one kind of element. Time and characters include nested elements.
+    """
+    calls: int = 0
+    time: float = 0.0  # Seconds
+    chars: int = 0  # Number of characters written
+
+
+@dataclass
+class WriterProfile:
+    """
+    Writer profile, by element class name. Initializers of declarations are listed as "Initializer".
+    """
+    elements: dict[str, ElementProfile]
+
+    def report(self) -> str:
+        """
+        Profile as human-readable text, slowest elements first
+        """
+        lines = [f"{'Element':30} {'Calls':>10} {'Time (ms)':>12} {'Chars':>12}"]
+        for name, profile in sorted(self.elements.items(), key=lambda item: item[1].time, reverse=True):
+            lines.append(f"{name:30} {profile.calls:10} {profile.time * 1000:12.1f} {profile.chars:12}")
+        return "\n".join(lines)
+
+
+def _type_key(elem: core.Type) -> tuple:
+    """
+    Cache key for formatted type, based on current values of the type and its base types
+    """
+    base_type = elem.base_type
+    if base_type.__class__ is not str:
+        base_type = _type_key(base_type)
+    return (base_type, elem.const, elem.volatile, elem.pointer)
+
+
 class Formatter:
     """
     Low-level generator
+
+    Written text is collected in an output buffer which is flushed to the output
+    in large chunks. The column is calculated from the buffer when needed.
     """
+    flush_threshold = 4096  # Number of buffered fragments that triggers a flush at end of line
+
     def __init__(self, indent_width: int,
                  indentation_char: str) -> None:
-        self.file_path: str | None = None
         self.fh: TextIO | None = None  # pylint: disable=invalid-name
         self.indentation_char: str = indentation_char
         self.white_space_char: str = " "
         self.indent_width = indent_width  # Number of characters (spaces) per indendation
         self.indentation_level: int = 0  # current indentation level
         self.indentation_str: str = ""
+        with _indent_lock:
+            self._indent_table = _indent_tables.setdefault((indentation_char, indent_width), [""])
         self.line_number: int = 0
-        self.column: int = 0
+        self._buf: list[str] = []  # Output buffer
+        self._sink: Callable[[str], Any] | None = None  # Receives flushed chunks
+        self._chunks: list[str] = []  # Flushed chunks when writing to string
+        self._flushed_column: int = 0  # Column at end of last flushed chunk
+        self._flushed_size: int = 0  # Number of characters flushed since output was opened
 
-    def _str_open(self):
-        self.fh = StringIO()
-        self.line_number = 1
-        self.indentation_level = 0
-        self.indentation_str = ""
+    @property
+    def column(self) -> int:
+        """
+        Zero-based current column, calculated from the output buffer
+        """
+        column = 0
+        for text in reversed(self._buf):
+            pos = text.rfind("\n")
+            if pos >= 0:
+                return column + len(text) - pos - 1
+            column += len(text)
+        return column + self._flushed_column
 
-    def _open(self, file_path: str):
-        self.fh = open(file_path, "w", encoding="utf-8")
-        self.file_path = file_path
+    def _reset(self, sink: Callable[[str], Any]):
+        self._buf = []
+        self._sink = sink
+        self._flushed_column = 0
+        self._flushed_size = 0
         self.line_number = 1
         self.indentation_level = 0
         self.indentation_str = ""
 
-    def _close(self):
-        self.fh.close()
+    def _str_open(self):
+        self.fh = None
+        self._chunks = []
+        self._reset(self._chunks.append)
+
+    def _str_close(self) -> str:
+        self._flush()
+        value = "".join(self._chunks)
+        self._chunks = []
+        return value
+
+    def _flush(self):
+        """
+        Moves buffered text to the output
+        """
+        if self._buf:
+            text = "".join(self._buf)
+            self._buf.clear()
+            pos = text.rfind("\n")
+            if pos >= 0:
+                self._flushed_column = len(text) - pos - 1
+            else:
+                self._flushed_column += len(text)
+            self._flushed_size += len(text)
+            self._sink(text)
 
     def _indent(self):
         self.indentation_level += 1
-        self.indentation_str = self.indentation_char * \
-            (self.indentation_level * self.indent_width)
+        self.indentation_str = self._indentation(self.indentation_level)
 
     def _dedent(self):
         self.indentation_level -= 1
-        if self.indentation_level == 0:
-            self.indentation_str = ""
-        else:
-            self.indentation_str = self.indentation_char * \
-                (self.indentation_level * self.indent_width)
+        self.indentation_str = self._indentation(self.indentation_level)
+
+    def _indentation(self, level: int) -> str:
+        """
+        Indentation string for level. Strings are cached per level up to INDENT_CACHE_LEVELS
+        in a table shared by all formatters using the same indentation.
+        """
+        table = self._indent_table
+        if level < len(table):
+            return table[level]
+        if level < INDENT_CACHE_LEVELS:
+            with _indent_lock:
+                while len(table) <= level:
+                    table.append(self.indentation_char * (len(table) * self.indent_width))
+            return table[level]
+        return self.indentation_char * (level * self.indent_width)
 
     def _start_line(self):
-        self.fh.write(self.indentation_str)
+        self._buf.append(self.indentation_str)
 
     def _write(self, text):
-        self.fh.write(text)
-        self.column += len(text)
+        self._buf.append(text)
 
     def _write_line(self, text):
-        self.fh.write(text)
+        self._buf.append(text)
         self._eol()
 
     def _eol(self):
-        self.fh.write("\n")
+        self._buf.append("\n")
         self.line_number += 1
-        self.column = 0
+        if len(self._buf) >= self.flush_threshold:
+            self._flush()
 
 
 class Writer(Formatter):
     """
     High level generator
+
+    A write that starts while the writer is already writing (in another thread, or from an
+    element handler) is made by a copy of the writer that holds its own render state (output buffer,
+    indentation, line number and last element), while style, handlers and caches are shared.
+    A writer can therefore be used by several threads at once, and element handlers can
+    use the writer for other output while writing.
     """
-    def __init__(self, style: c_style.StyleOptions) -> None:
+    # Default element handlers, looked up by method name so that subclasses can override them
+    _default_handlers: dict[type, str] = {
+        core.Type: "_write_base_type",
+        core.TypeDef: "_write_typedef_usage",
+        core.Struct: "_write_struct_usage",
+        core.Variable: "_write_variable_usage",
+        core.Function: "_write_function_usage",
+        core.Declaration: "_write_declaration",
+        core.Assignment: "_write_assignment",
+        core.StringLiteral: "_write_string_literal",
+        core.ArrayInitializer: "_write_array_initializer",
+        core.FileInitializer: "_write_file_initializer",
+        core.FunctionReturn: "_write_func_return",
+        core.FunctionCall: "_write_func_call",
+        core.Blank: "_write_blank",
+        core.Whitespace: "_write_whitespace",
+        core.LineComment: "_write_line_comment",
+        core.BlockComment: "_write_block_comment",
+        core.Block: "_write_block",
+        core.Statement: "_write_statement",
+        core.Line: "_write_line_element",
+        core.IncludeDirective: "_write_include_directive",
+        core.DefineDirective: "_write_define_directive",
+        core.IfdefDirective: "_write_ifdef_directive",
+        core.IfndefDirective: "_write_ifndef_directive",
+        core.EndifDirective: "_write_endif_directive",
+        core.Extern: "_write_extern",
+        core.Sequence: "_write_sequence",
+    }
+    # Elements that end their own line when written as part of a sequence
+    _eol_elements = (core.Statement, core.LineComment, core.Directive)
+    # Elements whose content is read while writing, changes to it aren't tracked by sequence versions
+    _volatile_elements = (core.LazySequence, core.FileInitializer)
+    # Set on writer copies made by _acquire_render, a copy makes a single write and is never reused
+    _is_render_copy = False
+
+    def __init__(self,
+                 style: c_style.StyleOptions,
+                 iterative: bool = False,
+                 render_cache: RenderCache | None = None,
+                 profiling: bool = False,
+                 source_map: bool = False,
+                 incremental: bool = False) -> None:
+        """
+        iterative: Use an explicit stack instead of recursion when writing nested blocks.
+                   Output is identical but nesting depth is no longer limited by the recursion limit.
+        render_cache: Reuse text of top-level elements rendered by earlier runs. Elements are
+                      grouped, and each group is looked up by the fingerprints of its elements and style.
+        profiling: Record calls, time and written characters per element class, see profile.
+                   Element handlers are only wrapped when enabled, otherwise there is no cost.
+        source_map: Record positions of top-level elements and declarations in the output
+                    of each write, available as source_map after writing. Render cache is not
+                    used while recording.
+        incremental: Keep text of nested blocks and sequences between writes and reuse it while their
+                     version (see core.Sequence) is unchanged. Only changed parts of a model are written again.
+                     Text is kept per indentation level and last element written before the sequence,
+                     which is all its output depends on. Not used while recording source maps.
+                     Fingerprints of top-level sequences are kept the same way when writing regions.
+        """
         super().__init__(style.indent_width, style.indent_char)
         self.style = style
-        self.switcher_all = {
-            "Type": self._write_base_type,
-            "TypeDef": self._write_typedef_usage,
-            "Struct": self._write_struct_usage,
-            "Variable": self._write_variable_usage,
-            "Function": self._write_function_usage,
-            "Declaration": self._write_declaration,
-            "Assignment": self._write_assignment,
-            "StringLiteral": self._write_string_literal,
-            "FunctionReturn": self._write_func_return,
-            "FunctionCall": self._write_func_call,
-            "Blank": self._write_blank,
-            "Whitespace": self._write_whitespace,
-            "LineComment": self._write_line_comment,
-            "BlockComment": self._write_block_comment,
-            "Block": self._write_block,
-            "Statement": self._write_statement,
-            "Line": self._write_line_element,
-            "IncludeDirective": self._write_include_directive,
-            "DefineDirective": self._write_define_directive,
-            "IfdefDirective": self._write_ifdef_directive,
-            "IfndefDirective": self._write_ifndef_directive,
-            "EndifDirective": self._write_endif_directive,
-            "Extern": self._write_extern,
-        }
+        self.iterative = iterative
+        self.render_cache = render_cache
+        self._handlers: dict[type, Callable[[Any, Any], None]] = {
+            elem_type: getattr(type(self), name) for elem_type, name in self._default_handlers.items()}
+        self._handlers[list] = type(self)._write_list_line
+        self._registered: dict[type, Callable[[Any, Any], None]] = {}  # Handlers added using register
+        self._element_dispatch: dict[type, Callable[[Any, Any], None]] = {}
+        # Handler, start line before element, end line after element, handler without profiling
+        self._sequence_dispatch: dict[type, tuple[Callable[[Any, Any], None], bool, bool,
+                                                  Callable[[Any, Any], None]]] = {}
+        self._type_cache: dict[tuple, str] = {}
+        self._type_cache_hits = 0
+        self._type_cache_misses = 0
+        self._compiled = c_style.CompiledStyle.compile(style)
+        self.last_element = ElementType.NONE
+        self._profile: dict[str, list[int]] | None = None  # Calls, nanoseconds, chars per element class
+        self._source_mapping = source_map
+        self.source_map: SourceMap | None = None  # Source map of last write
+        # Fragments by sequence, then by (indentation level, last element): version, text, lines, last element
+        self._fragments: weakref.WeakKeyDictionary[core.Sequence, dict[tuple[int, ElementType], tuple]] | None = None
+        self._fingerprints: weakref.WeakKeyDictionary[core.Sequence, tuple[int, str]] | None = None  # By version
+        if incremental and not source_map:
+            self._fragments = weakref.WeakKeyDictionary()
+            self._fingerprints = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()  # Protects style compilation and merging of statistics
+        self._render_lock = threading.Lock()  # Held while the writer itself is writing
+        self._merged_stats = [0, 0, 0, 0]  # Statistics of writer copies, same order as WriterStats
+        self._merged_profile: dict[str, list[int]] = {}  # Profile of writer copies
+        self._fragment_volatile = False  # Set when current fragment contains volatile elements
+        self._fragment_hits = 0
+        self._fragment_misses = 0
+        if profiling:
+            self._profile = {}
+            self._write_initializer = types.MethodType(  # type: ignore[method-assign]
+                self._profiled("Initializer", type(self)._write_initializer), self)
+
+    @property
+    def stats(self) -> WriterStats:
+        """
+        Statistics collected since the writer was created
+        """
+        with self._lock:
+            merged = list(self._merged_stats)
+        return WriterStats(self._type_cache_hits + merged[0], self._type_cache_misses + merged[1],
+                           self._fragment_hits + merged[2], self._fragment_misses + merged[3])
+
+    @property
+    def profile(self) -> WriterProfile | None:
+        """
+        Profile collected since the writer was created, None unless created with profiling=True
+        """
+        if self._profile is None:
+            return None
+        with self._lock:
+            records = {name: list(record) for name, record in self._merged_profile.items()}
+        for name, (calls, elapsed, chars) in list(self._profile.items()):
+            record = records.setdefault(name, [0, 0, 0])
+            record[0] += calls
+            record[1] += elapsed
+            record[2] += chars
+        return WriterProfile({name: ElementProfile(calls, elapsed / 1e9, chars)
+                              for name, (calls, elapsed, chars) in records.items() if calls})
+
+    def _profiled(self, name: str, handler: Callable[[Any, Any], None]) -> Callable[[Any, Any], None]:
+        """
+        Wraps handler to record calls, time and written characters under name, in the profile
+        of the writer (or writer copy) making the write. The output buffer is flushed before calling handler,
+        so that written characters can be counted from the flushed size and the (short) rest of the buffer.
+        """
+        perf_counter_ns = time.perf_counter_ns
+
+        def profiled_handler(writer: Writer, elem: Any) -> None:
+            writer._flush()  # pylint: disable=protected-access
+            size = writer._flushed_size  # pylint: disable=protected-access
+            start = perf_counter_ns()
+            try:
+                handler(writer, elem)
+            finally:
+                writer._record_profile(name, start, size)  # pylint: disable=protected-access
+        return profiled_handler
+
+    def _record_profile(self, name: str, start: int, size: int) -> None:
+        """
+        Records a call in the profile, started at time start (perf_counter_ns) when the flushed size was size
+        """
+        assert self._profile is not None
+        record = self._profile.get(name, None)
+        if record is None:
+            record = self._profile[name] = [0, 0, 0]
+        record[0] += 1
+        record[1] += time.perf_counter_ns() - start
+        record[2] += self._flushed_size - size + sum(map(len, self._buf))
+
+    def _acquire_render(self) -> "Writer":
+        """
+        Writer for making one write: the writer itself unless it's already writing, otherwise a copy with
+        its own render state, statistics and profile. Pass the result to _release_render when done.
+        Recompiles style and drops results derived from it if style has been modified (or replaced) since last use.
+        """
+        # pylint: disable=protected-access, consider-using-with
+        if c_style.CompiledStyle.make_snapshot(self.style) != self._compiled.snapshot:
+            with self._lock:
+                snapshot = c_style.CompiledStyle.make_snapshot(self.style)
+                if snapshot != self._compiled.snapshot:
+                    self._compiled = c_style.CompiledStyle.compile(self.style)
+                    self._type_cache.clear()
+                    if self._fragments is not None:
+                        self._fragments.clear()
+        if not self._is_render_copy and self._render_lock.acquire(blocking=False):
+            return self
+        render = object.__new__(type(self))
+        render.__dict__ = self.__dict__.copy()
+        render._is_render_copy = True
+        render._type_cache_hits = render._type_cache_misses = 0
+        render._fragment_hits = render._fragment_misses = 0
+        render.fh = None
+        render._buf = []
+        render._chunks = []
+        render._sink = None
+        if self._profile is not None:
+            render._profile = {}
+            render._write_initializer = types.MethodType(  # type: ignore[method-assign]
+                self._write_initializer.__func__, render)  # type: ignore[attr-defined]
+        return render
+
+    def _release_render(self, render: "Writer") -> None:
+        """
+        Ends a write started by _acquire_render. Statistics and profile of a writer copy are added
+        to this writer, which also takes over its source map.
+        """
+        # pylint: disable=protected-access
+        if render is self:
+            self._render_lock.release()
+            return
+        with self._lock:
+            merged = self._merged_stats
+            merged[0] += render._type_cache_hits
+            merged[1] += render._type_cache_misses
+            merged[2] += render._fragment_hits
+            merged[3] += render._fragment_misses
+            if render._profile is not None:
+                for name, (calls, elapsed, chars) in render._profile.items():
+                    record = self._merged_profile.setdefault(name, [0, 0, 0])
+                    record[0] += calls
+                    record[1] += elapsed
+                    record[2] += chars
+            if render.source_map is not None:
+                self.source_map = render.source_map
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Render state, locks, and caches holding wrapped handlers or weak references are created again
+        state = self.__dict__.copy()
+        for name in ("_lock", "_render_lock", "_is_render_copy", "_element_dispatch", "_sequence_dispatch",
+                     "_write_initializer", "_fragments", "_fingerprints", "_type_cache", "_indent_table", "_sink",
+                     "fh"):
+            state.pop(name, None)
+        state["_buf"] = []
+        state["_chunks"] = []
+        state["source_map"] = None
+        state["incremental"] = self._fragments is not None
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        incremental = state.pop("incremental")
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._element_dispatch = {}
+        self._sequence_dispatch = {}
+        self._type_cache = {}
+        self._sink = None
+        self.fh = None
+        with _indent_lock:
+            self._indent_table = _indent_tables.setdefault((self.indentation_char, self.indent_width), [""])
+        self._fragments = weakref.WeakKeyDictionary() if incremental else None
+        self._fingerprints = weakref.WeakKeyDictionary() if incremental else None
+        if self._profile is not None:
+            self._write_initializer = types.MethodType(  # type: ignore[method-assign]
+                self._profiled("Initializer", type(self)._write_initializer), self)
+
+    def _begin(self) -> None:
+        """
+        Prepares for writing new output
+        """
+        self._str_open()
         self.last_element = ElementType.NONE
+        self._fragment_volatile = False
+        self.source_map = SourceMap() if self._source_mapping else None
 
-    def write_file(self, sequence: core.Sequence, file_path: str):
+    def register(self, element_cls: type, handler: Callable[[Any, Any], None]) -> None:
         """
-        Writes the sequence to file using pre-selected format style
+        Registers handler for writing elements of type element_cls.
+        The handler is called as handler(writer, elem). Subclasses of element_cls
+        are also written using this handler unless they have a handler of their own.
         """
-        self._open(file_path)
-        self._write_sequence(sequence)
-        self._close()
+        if not isinstance(element_cls, type):
+            raise TypeError(f"element_cls: Expected a class, got {str(type(element_cls))}")
+        if not callable(handler):
+            raise TypeError(f"handler: Expected a callable, got {str(type(handler))}")
+        self._handlers[element_cls] = handler
+        self._registered[element_cls] = handler
+        self._element_dispatch.clear()
+        self._sequence_dispatch.clear()
+        if self._fragments is not None:
+            self._fragments.clear()
+
+    def _mapped(self, handler: Callable[[Any, Any], None]) -> Callable[[Any, Any], None]:
+        """
+        Wraps handler to add written elements to source map. The output buffer is flushed
+        before and after calling handler, which makes position and length of the text
+        written by handler available from the flushed size.
+        """
+        def mapped_handler(writer: Writer, elem: Any, top_level: bool = False) -> None:
+            source_map = writer.source_map
+            writer._flush()  # pylint: disable=protected-access
+            offset = writer._flushed_size  # pylint: disable=protected-access
+            index = source_map.add(type(elem).__qualname__, _source_map_name(elem), writer.line_number,
+                                   writer._flushed_column, offset, 0, top_level)  # pylint: disable=W0212
+            handler(writer, elem)
+            writer._flush()  # pylint: disable=protected-access
+            source_map.lengths[index] = writer._flushed_size - offset  # pylint: disable=protected-access
+        return mapped_handler
+
+    def _fragmented(self, elem_type: type, handler: Callable[[Any, Any], None]) -> Callable[[Any, Any], None]:
+        """
+        Wraps handler to mark output containing volatile elements, which prevents fragments and regions
+        containing them from being kept. When writing incrementally, blocks and sequences written by
+        the default handlers are written from fragments when unchanged. Other handlers are returned as they are.
+        """
+        if issubclass(elem_type, self._volatile_elements):
+            def volatile_handler(writer: Writer, elem: Any) -> None:
+                writer._fragment_volatile = True  # pylint: disable=protected-access
+                handler(writer, elem)
+            return volatile_handler
+        if self._fragments is None or (handler is not Writer._write_block and handler is not Writer._write_sequence):
+            return handler
+
+        def fragment_handler(writer: Writer, sequence: core.Sequence) -> None:
+            if not writer._write_fragment(sequence):  # pylint: disable=protected-access
+                fragment = writer._begin_fragment(sequence)  # pylint: disable=protected-access
+                handler(writer, sequence)
+                writer._end_fragment(fragment)  # pylint: disable=protected-access
+        return fragment_handler
+
+    def _write_fragment(self, sequence: core.Sequence) -> bool:
+        """
+        Writes text kept from an earlier write of sequence if it's still valid.
+        Returns False if sequence needs to be written.
+        """
+        assert self._fragments is not None
+        entries = self._fragments.get(sequence)
+        if entries is not None:
+            entry = entries.get((self.indentation_level, self.last_element))
+            if entry is not None and entry[0] == sequence.version:
+                self._buf.extend(entry[1])
+                self.line_number += entry[2]
+                self.last_element = entry[3]
+                self._fragment_hits += 1
+                if len(self._buf) >= self.flush_threshold:
+                    self._flush()
+                return True
+        self._fragment_misses += 1
+        return False
+
+    def _begin_fragment(self, sequence: core.Sequence) -> tuple:
+        """
+        Starts capturing text written for sequence. Returns state to pass to _end_fragment.
+        """
+        self._flush()
+        parts: list[str] = []
+        fragment = (sequence, (self.indentation_level, self.last_element), sequence.version, parts,
+                    self._sink, self.line_number, self._fragment_volatile)
+        self._sink = parts.append
+        self._fragment_volatile = sequence.contains_lazy  # Lazy elements of chains and views aren't seen by handlers
+        return fragment
+
+    def _end_fragment(self, fragment: tuple) -> None:
+        """
+        Passes text captured since _begin_fragment on to the output and keeps it unless volatile
+        """
+        assert self._fragments is not None
+        sequence, key, version, parts, sink, line_number, volatile = fragment
+        self._flush()
+        self._sink = sink
+        for text in parts:
+            sink(text)
+        if self._fragment_volatile:
+            return
+        self._fragment_volatile = volatile
+        entries = self._fragments.get(sequence)
+        if entries is None or next(iter(entries.values()))[0] != version:
+            entries = self._fragments[sequence] = {}
+        entries[key] = (version, tuple(parts), self.line_number - line_number, self.last_element)
+
+    def _find_handler(self, elem_type: type) -> Callable[[Any, Any], None]:
+        """
+        Finds handler for elem_type by walking its MRO
+        """
+        for base in elem_type.__mro__:
+            handler = self._handlers.get(base, None)
+            if handler is not None:
+                return handler
+        raise NotImplementedError(f"Found no writer for element {elem_type.__name__}")
+
+    def _resolve_handler(self, elem_type: type) -> Callable[[Any, Any], None]:
+        """
+        Same as _find_handler but adds profiling if enabled. The result is cached per type.
+        """
+        handler = self._fragmented(elem_type, self._find_handler(elem_type))
+        if self._source_mapping and issubclass(elem_type, core.Declaration):
+            handler = self._mapped(handler)
+        if self._profile is not None:
+            handler = self._profiled(elem_type.__qualname__, handler)
+        self._element_dispatch[elem_type] = handler
+        return handler
+
+    def _resolve_sequence_handler(self, elem_type: type) -> tuple[Callable[[Any, Any], None], bool, bool,
+                                                                  Callable[[Any, Any], None]]:
+        """
+        Same as _resolve_handler but also decides if a line needs to be started before the element
+        and ended after it. Nested sequences (other than blocks) are written inline and do neither.
+        """
+        inline = issubclass(elem_type, core.Sequence) and not issubclass(elem_type, core.Block)
+        handler = self._find_handler(elem_type)
+        profiled_handler = self._fragmented(elem_type, handler)
+        if self._source_mapping and issubclass(elem_type, core.Declaration):
+            profiled_handler = self._mapped(profiled_handler)
+        if self._profile is not None:
+            profiled_handler = self._profiled(elem_type.__qualname__, profiled_handler)
+        entry = (profiled_handler, not inline, issubclass(elem_type, self._eol_elements), handler)
+        self._sequence_dispatch[elem_type] = entry
+        return entry
+
+    def write_file(self,
+                   sequence: core.Sequence,
+                   file_path: str,
+                   only_if_changed: bool = False,
+                   regions: bool = False) -> bool:
+        """
+        Writes the sequence to file using pre-selected format style.
+        only_if_changed: Leave the file untouched (including its modification time) when it already
+                         has the same content. Otherwise the file is replaced atomically.
+        regions: Bracket groups of top-level elements (regions) with marker comments. Regions of the
+                 existing file are reused when their elements haven't changed, only the other regions
+                 are written. If the existing file has been edited outside of regions, or its markers
+                 are damaged, all regions are written. Implies only_if_changed.
+                 Can't be combined with source maps.
+        Returns True if the file was written.
+        """
+        # pylint: disable=protected-access
+        render = self._acquire_render()
+        try:
+            if regions:
+                return render._write_file_regions(sequence, file_path)
+            if only_if_changed:
+                return render._write_file_if_changed(sequence, file_path)
+            with open(file_path, "w", encoding="utf-8") as fh:  # pylint: disable=invalid-name
+                render._write_to_sink(sequence, fh.write)
+            return True
+        finally:
+            self._release_render(render)
+
+    def _write_to_sink(self, sequence: core.Sequence, sink: Callable[[str], Any]) -> None:
+        """
+        Writes the sequence, passing text to sink each time the output buffer is flushed.
+        Unlike iter_chunks, this lets large elements (such as embedded files) flush text while
+        they are being written.
+        """
+        assert isinstance(sequence, core.Sequence)
+        self._begin()
+        self._reset(sink)
+        for _ in self._iter_top_level(sequence):
+            pass
+        self._flush()
+
+    def _write_file_if_changed(self, sequence: core.Sequence, file_path: str) -> bool:
+        """
+        Compares output with the existing file while writing. Nothing is written until the first
+        difference, after which the matching part is copied from the existing file into a
+        temporary file that finally replaces the existing file.
+        """
+        try:
+            old_file: BinaryIO | None = open(file_path, "rb")
+        except FileNotFoundError:
+            old_file = None
+        tmp_path = None
+        tmp_file: BinaryIO | None = None
+        matched_size = 0
+
+        def compare(chunk: str) -> None:
+            nonlocal tmp_path, tmp_file, matched_size
+            data = _encode_output(chunk)
+            if tmp_file is None:
+                if old_file is not None and old_file.read(len(data)) == data:
+                    matched_size += len(data)
+                    return
+                tmp_path, tmp_file = self._open_replacement(file_path, old_file, matched_size)
+            tmp_file.write(data)
+
+        try:
+            self._write_to_sink(sequence, compare)
+            if tmp_file is None:
+                if old_file is not None and not old_file.read(1):
+                    return False
+                tmp_path, tmp_file = self._open_replacement(file_path, old_file, matched_size)
+            tmp_file.close()
+            if old_file is not None:
+                old_file.close()
+                shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+            tmp_path = None
+            return True
+        finally:
+            if old_file is not None:
+                old_file.close()
+            if tmp_file is not None:
+                tmp_file.close()
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+    def _write_file_regions(self, sequence: core.Sequence, file_path: str) -> bool:
+        """
+        Splits top-level elements into regions at content-defined boundaries, like render cache does,
+        and closes regions at the end of a line. Each region is keyed by the fingerprints of its elements
+        and is copied from the memory-mapped existing file if found there with the same key and
+        unchanged text. Otherwise it's written. Regions containing volatile elements, and a final
+        region not ending at the end of a line, are never copied. Output is compared with the existing
+        file region by region, a temporary file replacing the existing file is created at the first difference.
+        """
+        assert isinstance(sequence, core.Sequence)
+        if self._source_mapping:
+            raise ValueError("Source maps can't be recorded when writing regions")
+        try:
+            old_file: BinaryIO | None = open(file_path, "rb")
+        except FileNotFoundError:
+            old_file = None
+        old_size = 0
+        old_data: mmap.mmap | None = None
+        old_regions: list[tuple[str, int, int, str]] = []
+        tmp_path = None
+        tmp_file: BinaryIO | None = None
+        matched = 0  # Number of regions matching the existing file, until a difference is found
+
+        def output(data: bytes | None, region: tuple[str, int, int, str] | None = None) -> None:
+            nonlocal tmp_path, tmp_file, matched
+            if tmp_file is None:
+                if matched < len(old_regions):
+                    old_region = old_regions[matched]
+                    if (old_region[0] == region[0]) if region is not None else \
+                            (old_data[old_region[1]:old_region[2]] == data):
+                        matched += 1
+                        return
+                tmp_path, tmp_file = self._open_replacement(file_path, old_file,
+                                                            old_regions[matched - 1][2] if matched else 0)
+            if region is not None:
+                data = old_data[region[1]:region[2]]
+            tmp_file.write(data)
+
+        def output_text(key: str, text: str) -> None:
+            data = _encode_output(text)
+            end_marker = f"/* cfile:end {key} {self.last_element.name} {zlib.crc32(data):08x} */\n"
+            output(b"".join([_encode_output(f"/* cfile:begin {key} */\n"), data, _encode_output(end_marker)]))
+
+        try:
+            if old_file is not None:
+                old_size = os.fstat(old_file.fileno()).st_size
+            if old_size:
+                old_data = mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+                old_regions = _parse_regions(old_data) or []
+            reusable = {region[0]: region for region in old_regions if region[0] != "-"}
+            self._begin()
+            group_keys: list[str] | None = []
+            context: str | None
+            try:
+                context = self._render_context()
+            except (TypeError, ValueError):  # Handlers that can't be fingerprinted, written as a single region
+                context = None
+                group_keys = None
+            pending: list[Any] = []  # Elements of current region that haven't been written yet
+            text = ""  # Text written for current region so far
+            volatile = False  # Set when text contains volatile elements
+            start_element = self.last_element
+            prev_hash = 0
+
+            def end_region(final: bool) -> None:
+                nonlocal group_keys, pending, text, volatile, start_element
+                if group_keys is None or context is None:
+                    key = "-"
+                else:
+                    key = combine(context, start_element.name, *group_keys)
+                region = reusable.get(key) if not text else None
+                if region is not None:
+                    output(None, region)
+                    self.last_element = ElementType[region[3]]
+                else:
+                    self._fragment_volatile = False
+                    text += self._capture(pending)
+                    volatile = volatile or self._fragment_volatile
+                    pending = []
+                    if not text.endswith("\n"):
+                        if not final:
+                            return  # Regions end at end of line, continue with next elements
+                        volatile = True  # Elements added later would continue the line
+                    output_text("-" if volatile else key, text)
+                    text = ""
+                    volatile = False
+                pending = []
+                group_keys = []
+                start_element = self.last_element
+
+            for elem in sequence.elements:
+                pending.append(elem)
+                if context is None:
+                    continue
+                if group_keys is not None:
+                    try:
+                        elem_key = self._region_fingerprint(elem)
+                    except (TypeError, ValueError):
+                        group_keys = None
+                    else:
+                        group_keys.append(elem_key)
+                        # Boundaries depend on two elements, repeated elements (such as blanks) are rarely decisive
+                        elem_hash = int(elem_key[:8], 16)
+                        boundary = (prev_hash + elem_hash) % REGION_GROUP_SIZE == 0
+                        prev_hash = elem_hash
+                        if not boundary:
+                            continue
+                end_region(False)
+            if pending or text:
+                end_region(True)
+            if tmp_file is None:
+                if old_file is not None and matched == len(old_regions) and \
+                        old_size == (old_regions[-1][2] if old_regions else 0):
+                    return False
+                tmp_path, tmp_file = self._open_replacement(file_path, old_file,
+                                                            old_regions[matched - 1][2] if matched else 0)
+            tmp_file.close()
+            if old_data is not None:
+                old_data.close()
+            if old_file is not None:
+                old_file.close()
+                shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+            tmp_path = None
+            return True
+        finally:
+            if old_data is not None:
+                old_data.close()
+            if old_file is not None:
+                old_file.close()
+            if tmp_file is not None:
+                tmp_file.close()
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+    def _region_fingerprint(self, elem: Any) -> str:
+        """
+        Fingerprint of top-level element. When writing incrementally, fingerprints of
+        sequences are kept by version.
+        """
+        if self._fingerprints is None or not isinstance(elem, core.Sequence):
+            return fingerprint(elem)
+        entry = self._fingerprints.get(elem)
+        if entry is not None and entry[0] == elem.version:
+            return entry[1]
+        version = elem.version
+        key = fingerprint(elem)
+        self._fingerprints[elem] = (version, key)
+        return key
+
+    def _open_replacement(self,
+                          file_path: str,
+                          old_file: BinaryIO | None,
+                          size: int) -> tuple[str, BinaryIO]:
+        """
+        Creates temporary file next to file_path and copies first size bytes of old_file to it
+        """
+        tmp_path = f"{file_path}.{uuid.uuid4().hex[:12]}.tmp"
+        tmp_file = open(tmp_path, "xb")
+        if size:
+            assert old_file is not None
+            old_file.seek(0)
+            while size > 0:
+                data = old_file.read(min(size, DEFAULT_CHUNK_SIZE))
+                tmp_file.write(data)
+                size -= len(data)
+        return tmp_path, tmp_file
 
     def write_str(self, sequence: core.Sequence) -> str:
         """
         Writes the sequence to string using pre-selected format style
         """
+        # pylint: disable=protected-access
         assert isinstance(sequence, core.Sequence)
-        self._str_open()
-        self._write_sequence(sequence)
-        assert isinstance(self.fh, StringIO)
-        return self.fh.getvalue()
+        render = self._acquire_render()
+        try:
+            render._begin()
+            if render.render_cache is None and not render._source_mapping:
+                render._write_sequence(sequence)
+            else:
+                for _ in render._iter_top_level(sequence):
+                    pass
+            return render._str_close()
+        finally:
+            self._release_render(render)
+
+    def write_files(self,
+                    files: Mapping[str, core.Sequence],
+                    workers: int | None = None,
+                    processes: bool = False,
+                    only_if_changed: bool = False) -> list[FileResult]:
+        """
+        Writes each sequence to its file path using pre-selected format style.
+        workers: Number of parallel workers. None means one per CPU.
+        processes: Use a process pool instead of a thread pool. Sequences, style, registered handlers
+                   and attributes of writer subclasses must then be picklable.
+        only_if_changed: Same as for write_file.
+        Files are written by this writer, shared by all worker threads. Worker processes
+        use a copy of it, with the same settings, handlers and render cache directory.
+        Statistics and profile of worker processes aren't merged into this writer.
+        Errors are reported per file in the returned list, which has the same order as files.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError(f"workers: Expected a positive number, got {workers}")
+        paths = list(files.keys())
+        results = [FileResult(file_path) for file_path in paths]
+        if workers == 1:
+            outcomes = _write_files_task(self, only_if_changed, list(files.items()))
+        else:
+            # Several files per task amortizes the cost of sending work to the pool
+            batch_size = max(1, len(paths) // (workers * 8)) if processes else 1
+            items = list(files.items())
+            batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+            executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            outcomes = []
+            with executor_class(max_workers=workers) as executor:
+                futures = [executor.submit(_write_files_task, self, only_if_changed, batch) for batch in batches]
+                for batch, future in zip(batches, futures):
+                    try:
+                        outcomes.extend(future.result())
+                    except Exception as err:  # pylint: disable=broad-exception-caught
+                        outcomes.extend([(False, err)] * len(batch))
+        for result, (changed, error) in zip(results, outcomes):
+            result.changed = changed
+            result.error = error
+        return results
+
+    def iter_chunks(self, sequence: core.Sequence, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+        """
+        Generator that writes the sequence using pre-selected format style and yields
+        the text in chunks of approximately chunk_size characters.
+        Chunks are cut between elements, at any nesting level, once the output buffer has been flushed.
+        Chunks can therefore be larger than requested when flush_threshold is large compared to chunk_size,
+        or when a single element (such as an embedded file) writes more than chunk_size characters.
+        When using render cache or source maps, chunks are only cut between top-level elements.
+        """
+        # pylint: disable=protected-access
+        assert isinstance(sequence, core.Sequence)
+        render = self._acquire_render()
+        try:
+            render._begin()
+            chunks = render._chunks
+            yielded_size = 0
+            if render.render_cache is None and not render._source_mapping:
+                steps = render._iter_elements(sequence.elements)
+            else:
+                steps = render._iter_top_level(sequence)
+            for _ in steps:
+                if render._flushed_size - yielded_size >= chunk_size:
+                    yielded_size = render._flushed_size
+                    text = "".join(chunks)
+                    chunks.clear()
+                    yield text
+            text = render._str_close()
+        finally:
+            self._release_render(render)
+        if text:
+            yield text
+
+    def _iter_top_level(self, sequence: core.Sequence) -> Iterator[None]:
+        """
+        Writes top-level elements of sequence. Yields after each element, or after each
+        group of elements when using render cache.
+        """
+        if self._source_mapping:
+            write_mapped = self._mapped(lambda writer, elem: writer._write_elements((elem,)))
+            source_map = self.source_map
+            assert source_map is not None
+            for elem in sequence.elements:
+                if isinstance(elem, core.Declaration):  # Declarations are added by their handler
+                    index = len(source_map)
+                    self._write_elements((elem,))
+                    source_map.top_level[index] = 1
+                else:
+                    write_mapped(self, elem, True)
+                yield
+            return
+        if self.render_cache is not None:
+            yield from self._iter_cached_groups(sequence.elements)
+            return
+        for elem in sequence.elements:
+            self._write_elements((elem,))
+            yield
+
+    def _iter_cached_groups(self, elements: Iterable[Any]) -> Iterator[None]:
+        """
+        Splits elements into groups at content-defined boundaries, so that inserting or removing
+        an element only changes the group it belongs to. Each group is read from render cache
+        if possible, otherwise it's written and stored in render cache.
+        Cache entries start with a line containing name of last element type.
+        Once an element can't be fingerprinted, it and all following elements are written without cache.
+        """
+        assert self.render_cache is not None
+        elem_iter = iter(elements)
+        try:
+            context = self._render_context()
+        except (TypeError, ValueError):  # Handlers that can't be fingerprinted
+            for elem in elem_iter:
+                self._write_elements((elem,))
+                yield
+            return
+        group: list[Any] = []
+        group_keys: list[str] = []
+        for elem in elem_iter:
+            try:
+                elem_key = fingerprint(elem)
+            except (TypeError, ValueError):
+                group.append(elem)
+                self._write_elements(group)
+                yield
+                for elem in elem_iter:  # pylint: disable=redefined-loop-name
+                    self._write_elements((elem,))
+                    yield
+                return
+            group.append(elem)
+            group_keys.append(elem_key)
+            if int(elem_key[:8], 16) % RENDER_CACHE_GROUP_SIZE == 0:
+                self._write_cached_group(context, group, group_keys)
+                group = []
+                group_keys = []
+                yield
+        if group:
+            self._write_cached_group(context, group, group_keys)
+            yield
+
+    def _render_context(self) -> str:
+        """
+        Fingerprint of everything besides elements that output depends on: cfile version, style,
+        writer class, registered handlers and methods of writer subclasses, including their code
+        """
+        handlers = sorted(self._registered.items(), key=lambda item: item[0].__qualname__)
+        methods = [(cls, [(name, value) for name, value in vars(cls).items() if isinstance(value, types.FunctionType)])
+                   for cls in type(self).__mro__ if cls is not Writer and issubclass(cls, Writer)]
+        return combine(RENDER_CACHE_VERSION, _package_version(), fingerprint(self.style),
+                       fingerprint([type(self), handlers, methods]))
+
+    def _write_cached_group(self, context: str, group: list[Any], group_keys: list[str]) -> None:
+        """
+        Writes group of elements using text from render cache, if available
+        """
+        assert self.render_cache is not None
+        key = combine(context, self.last_element.name, *group_keys)
+        entry = self.render_cache.get(key)
+        if entry is None:
+            text = self._write_captured(group)
+            self.render_cache.put(key, f"{self.last_element.name}\n{text}")
+        else:
+            last_element, _, text = entry.partition("\n")
+            self._write(text)
+            self.line_number += text.count("\n")
+            self.last_element = ElementType[last_element]
+
+    def _write_captured(self, elements: list[Any]) -> str:
+        """
+        Writes elements and returns the text written by them
+        """
+        text = self._capture(elements)
+        self._sink(text)
+        return text
+
+    def _capture(self, elements: list[Any]) -> str:
+        """
+        Writes elements to a string instead of the output
+        """
+        self._flush()
+        sink = self._sink
+        parts: list[str] = []
+        self._sink = parts.append
+        try:
+            self._write_elements(elements)
+            self._flush()
+        finally:
+            self._sink = sink
+        return "".join(parts)
 
     def write_str_elem(self, elem: Any, trim_end: bool = True) -> str:
         """
         Writes single item to string using pre-selected format style
         """
-        self._str_open()
-        self._write_element(elem)
-        assert isinstance(self.fh, StringIO)
-        value = self.fh.getvalue()
+        # pylint: disable=protected-access
+        render = self._acquire_render()
+        try:
+            render._begin()
+            render._write_element(elem)
+            value = render._str_close()
+        finally:
+            self._release_render(render)
         return value.removesuffix("\n") if trim_end else value
 
+    def write_str_elems(self, elements: Iterable[Any], trim_end: bool = True) -> list[str]:
+        """
+        Writes each item to its own string, same as calling write_str_elem for each item
+        but with less overhead per item
+        """
+        return list(self.iter_str_elems(elements, trim_end))
+
+    def iter_str_elems(self, elements: Iterable[Any], trim_end: bool = True) -> Iterator[str]:
+        """
+        Generator version of write_str_elems. Items are written one at a time into the same
+        output buffer, and the text of each item is taken from the buffer once it's written.
+        """
+        # pylint: disable=protected-access
+        render = self._acquire_render()
+        try:
+            render._begin()
+            chunks = render._chunks
+            buf = render._buf
+            for elem in elements:
+                render._write_element(elem)
+                value = "".join(buf)
+                buf.clear()
+                if chunks:  # Large item, parts of it were flushed while writing
+                    chunks.append(value)
+                    value = "".join(chunks)
+                    chunks.clear()
+                    render._flushed_column = 0
+                render.last_element = ElementType.NONE
+                yield value.removesuffix("\n") if trim_end else value
+            render._str_close()
+        finally:
+            self._release_render(render)
+
     def _write_element(self, elem: Any) -> None:
-        class_name = elem.__class__.__name__
-        write_method = self.switcher_all.get(class_name, None)
-        if write_method is not None:
-            write_method(elem)
-        else:
-            raise NotImplementedError(f"Found no writer for element {class_name}")
+        handler = self._element_dispatch.get(elem.__class__, None)
+        if handler is None:
+            handler = self._resolve_handler(elem.__class__)
+        handler(self, elem)
 
     def _write_sequence(self, sequence: core.Sequence) -> None:
         """
         Writes a sequence
         """
-        for elem in sequence.elements:
-            if isinstance(elem, list):
-                tmp = core.Line(elem)
-                self._start_line()
-                self._write_line_element(tmp)
-            elif isinstance(elem, core.Function):
-                self._start_line()
-                self._write_function_usage(elem)
-            elif isinstance(elem, core.Statement):
-                self._start_line()
-                self._write_statement(elem)
-                self._eol()
-            elif isinstance(elem, core.LineComment):
+        self._write_elements(sequence.elements)
+
+    def _write_elements(self, elements: Iterable[Any]) -> None:
+        """
+        Writes elements of a sequence
+        """
+        if self.iterative:
+            self._write_elements_iterative(elements)
+            return
+        dispatch = self._sequence_dispatch
+        for elem in elements:
+            entry = dispatch.get(elem.__class__, None)
+            if entry is None:
+                entry = self._resolve_sequence_handler(elem.__class__)
+            if entry[1]:
                 self._start_line()
-                self._write_line_comment(elem)
+            entry[0](self, elem)
+            if entry[2]:
                 self._eol()
-            elif isinstance(elem, core.Block):
-                self._start_line()
-                self._write_block(elem)
-            elif isinstance(elem, core.Line):
-                self._start_line()
-                self._write_line_element(elem)
-            else:
-                self._start_line()
-                class_name = elem.__class__.__name__
-                write_method = self.switcher_all.get(class_name, None)
-                if write_method is not None:
-                    write_method(elem)
-                else:
-                    raise NotImplementedError(f"Found no writer for element {class_name}")
-                if isinstance(elem, core.Directive):
+
+    def _write_elements_iterative(self, elements: Iterable[Any]) -> None:
+        """
+        Same as _write_elements but keeps iterators of enclosing blocks and nested sequences
+        on an explicit stack, see _iter_elements
+        """
+        for _ in self._iter_elements(elements):
+            pass
+
+    def _iter_elements(self, elements: Iterable[Any]) -> Iterator[None]:
+        """
+        Writes elements of a sequence, yielding after each element at any nesting level.
+        Iterators of enclosing blocks and nested sequences are kept on an explicit stack.
+        They are only expanded in place when they use the default handlers. When profiling, expanded
+        elements are recorded when their iterator is exhausted, the same way as by the wrapped handlers.
+        """
+        dispatch = self._sequence_dispatch
+        block_handler = Writer._write_block
+        sequence_handler = Writer._write_sequence
+        perf_counter_ns = time.perf_counter_ns
+        # Enclosing iterators, if current one is a block, its fragment when writing incrementally
+        # and its profile start (name, time, flushed size) when profiling
+        stack: list[tuple[Iterator[Any], bool, tuple | None, tuple | None]] = []
+        elem_iter = iter(elements)
+        in_block = False
+        fragment = None
+        profile_start = None
+        while True:
+            for elem in elem_iter:
+                entry = dispatch.get(elem.__class__, None)
+                if entry is None:
+                    entry = self._resolve_sequence_handler(elem.__class__)
+                if entry[1]:
+                    self._start_line()
+                if entry[3] is sequence_handler or (entry[3] is block_handler and elem.elements):
+                    elem_profile_start = None
+                    if self._profile is not None:
+                        self._flush()
+                        elem_profile_start = (elem.__class__.__qualname__, perf_counter_ns(), self._flushed_size)
+                    elem_fragment = None
+                    if isinstance(elem, self._volatile_elements):
+                        self._fragment_volatile = True
+                    elif self._fragments is not None:
+                        if self._write_fragment(elem):
+                            if elem_profile_start is not None:
+                                self._record_profile(*elem_profile_start)
+                            yield
+                            continue
+                        elem_fragment = self._begin_fragment(elem)
+                    stack.append((elem_iter, in_block, fragment, profile_start))
+                    fragment = elem_fragment
+                    profile_start = elem_profile_start
+                    in_block = entry[3] is block_handler
+                    if in_block:
+                        self._write_starting_brace()
+                        self._indent()
+                    elem_iter = iter(elem.elements)
+                    break
+                entry[0](self, elem)
+                if entry[2]:
                     self._eol()
+                yield
+            else:
+                if in_block:
+                    self._dedent()
+                    self._write_ending_brace()
+                if fragment is not None:
+                    self._end_fragment(fragment)
+                if profile_start is not None:
+                    self._record_profile(*profile_start)
+                if not stack:
+                    return
+                elem_iter, in_block, fragment, profile_start = stack.pop()
+
+    def _write_list_line(self, elem: list) -> None:
+        """
+        Writes python list as a line element
+        """
+        self._write_line_element(core.Line(elem))
 
     def _write_line_element(self, elem: core.Line) -> None:
         for i, part in enumerate(elem.parts):
@@ -211,12 +1418,7 @@ class Writer(Formatter):
 
     def _write_line_part(self, elem: str | core.Element) -> None:
         if isinstance(elem, core.Element):
-            class_name = elem.__class__.__name__
-            write_method = self.switcher_all.get(class_name, None)
-            if write_method is not None:
-                write_method(elem)
-            else:
-                raise NotImplementedError(f"Found no writer for element {class_name}")
+            self._write_element(elem)
         elif isinstance(elem, str):
             self._write(elem)
         else:
@@ -303,8 +1505,135 @@ class Writer(Formatter):
                     self._write(", ")
                 self._write_initializer_member(member)
             self._write("}")
-        else:
+        elif isinstance(value, (int, str)):
             self._write_initializer_member(value)
+        elif isinstance(value, core.Element):
+            self._write_element(value)
+        else:
+            try:
+                elem = core.ArrayInitializer(value)  # Tuples and objects supporting the buffer protocol
+            except TypeError:
+                raise NotImplementedError(str(type(value))) from None
+            self._write_array_initializer(elem)
+
+    def _write_array_initializer(self, elem: core.ArrayInitializer) -> None:
+        """
+        Writes array initializer. Values are converted to text in batches.
+        """
+        values = elem.values
+        if isinstance(values, (list, tuple)):
+            self._write_array_values(elem, values, len(values), 0)
+            return
+        with memoryview(values) as view:
+            item_format = view.format[-1:]
+            if item_format not in _INT_FORMATS and item_format not in _FLOAT_FORMATS:
+                raise NotImplementedError(f"Unsupported buffer format '{view.format}'")
+            if view.ndim == 1:
+                self._write_array_values(elem, view, len(view), view.itemsize)
+            else:
+                with view.cast("B") as raw, raw.cast(view.format) as flat:  # Multi-dimensional arrays are flattened
+                    self._write_array_values(elem, flat, len(flat), flat.itemsize)
+
+    def _write_file_initializer(self, elem: core.FileInitializer) -> None:
+        """
+        Writes contents of a binary file as byte array initializer. The file is memory-mapped
+        and the output buffer is flushed after each batch, so memory use doesn't grow with file size.
+        """
+        with open(elem.path, "rb") as fh:  # pylint: disable=invalid-name
+            size = os.fstat(fh.fileno()).st_size
+            if elem.size is not None and size != elem.size:
+                raise ValueError(f"{elem.path}: Expected {elem.size} bytes, file has {size} bytes")
+            if not size:
+                self._write("{}")
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                options = core.ArrayInitializer(view, elem.values_per_line, hex=True)
+                self._write_array_values(options, view, size, 1)
+
+    def _write_array_values(self, elem: core.ArrayInitializer, values: Any, count: int, item_size: int) -> None:
+        """
+        Writes values of array initializer. values is a list, a tuple or a one-dimensional memoryview.
+        """
+        format_batch = self._array_value_formatter(elem, values, item_size)
+        values_per_line = elem.values_per_line
+        separator = elem.suffix + ", "
+        if values_per_line <= 0:
+            self._write("{")
+            for begin in range(0, count, INITIALIZER_BATCH_SIZE):
+                if begin:
+                    self._write(separator)
+                self._write(separator.join(format_batch(values[begin:begin + INITIALIZER_BATCH_SIZE])) + elem.suffix)
+            self._write("}")
+            return
+        if not count:
+            self._write("{}")
+            return
+        self._write("{")
+        self._eol()
+        self._indent()
+        indentation = self.indentation_str
+        row_separator = ",\n" + indentation
+        batch_size = max(1, INITIALIZER_BATCH_SIZE // values_per_line) * values_per_line
+        for begin in range(0, count, batch_size):
+            texts = format_batch(values[begin:begin + batch_size])
+            if not isinstance(texts, list):
+                texts = list(texts)
+            rows = [separator.join(texts[i:i + values_per_line]) + elem.suffix
+                    for i in range(0, len(texts), values_per_line)]
+            self._write((row_separator if begin else indentation) + row_separator.join(rows))
+            self.line_number += len(rows) - (0 if begin else 1)
+            self._flush()
+        self._eol()
+        self._dedent()
+        self._start_line()
+        self._write("}")
+
+    def _array_value_formatter(self,
+                               elem: core.ArrayInitializer,
+                               values: Any,
+                               item_size: int) -> Callable[[Any], Iterable[str]]:
+        """
+        Returns function converting a batch (slice) of values to text
+        """
+        is_view = isinstance(values, memoryview)
+        if is_view and values.format[-1] in _FLOAT_FORMATS:
+            if elem.hex:
+                raise ValueError("Floating point values can't be written as hexadecimal numbers")
+            return lambda batch: map(str, batch.tolist())
+        if not elem.hex:
+            if is_view:
+                return lambda batch: map(str, batch.tolist())
+            return self._format_int_values
+        digits = elem.hex_digits if elem.hex_digits is not None else 2 * (item_size or 1)
+        if is_view and values.format[-1] == "B" and digits == 2:
+            return lambda batch: map(_HEX_BYTES.__getitem__, batch)
+        if is_view and values.format[-1] == "H" and digits <= 4:
+            hex_words = _hex_words(digits)
+            return lambda batch: map(hex_words.__getitem__, batch)
+        hex_format = f"0x%0{digits}X".__mod__
+        unsigned = is_view and values.format[-1].isupper()
+
+        def format_hex(batch: Any) -> Iterable[str]:
+            if is_view:
+                numbers = batch.tolist()
+            else:
+                numbers = batch
+                for value in numbers:
+                    if value.__class__ is not int:
+                        raise NotImplementedError(str(type(value)))
+            if not unsigned and numbers and min(numbers) < 0:
+                return [hex_format(value) if value >= 0 else "-" + hex_format(-value) for value in numbers]
+            return map(hex_format, numbers)
+        return format_hex
+
+    def _format_int_values(self, values: list[Any] | tuple[Any, ...]) -> Iterable[str]:
+        """
+        Converts list of ints to text, same as the list initializer
+        """
+        for value in values:
+            if not isinstance(value, int):
+                raise NotImplementedError(str(type(value)))
+        return map(str, values)
 
     def _write_initializer_member(self, value: Any) -> None:
         """
@@ -331,6 +1660,26 @@ class Writer(Formatter):
         self.last_element = ElementType.TYPE_DECLARATION
 
     def _format_type(self, elem: core.Type) -> str:
+        """
+        Formats type with qualifiers. Results are cached on the current value of the type,
+        so a type that is modified after use is not affected by earlier results.
+        """
+        base_type = elem.base_type
+        if base_type.__class__ is not str:
+            base_type = _type_key(base_type)
+        key = (base_type, elem.const, elem.volatile, elem.pointer)
+        text = self._type_cache.get(key, None)
+        if text is None:
+            text = self._format_type_uncached(elem)
+            if len(self._type_cache) >= TYPE_CACHE_SIZE:
+                self._type_cache.clear()
+            self._type_cache[key] = text
+            self._type_cache_misses += 1
+        else:
+            self._type_cache_hits += 1
+        return text
+
+    def _format_type_uncached(self, elem: core.Type) -> str:
         parts = []
         handled = {"const": False,
                    "volatile": False,
@@ -358,12 +1707,7 @@ class Writer(Formatter):
         else:
             result += self._format_type(elem.base_type)
         if elem.pointer:
-            if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                result += "*"
-            elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                result += " *"
-            elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                result += " *"
+            result += self._compiled.type_pointer
         return result
 
     def _write_variable_usage(self, elem: core.Variable) -> None:
@@ -391,42 +1735,32 @@ class Writer(Formatter):
             self._write_typedef_usage(elem.data_type)
         else:
             raise NotImplementedError(str(type(elem.data_type)))
-        result = ""
-        if elem.pointer:
-            if elem.const:
-                if self.style.space_around_pointer_qualifiers == c_style.SpaceLocation.DEFAULT:
-                    if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                        result += "* const "
-                    elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                        result += "*const "
-                    elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                        result += " * const "
-                    else:
-                        raise ValueError(self.style.pointer_alignment)
-                else:
+        self._write(self._format_declarator(elem.data_type, elem.pointer, elem.const, elem.name, elem.array))
+        self.last_element = ElementType.VARIABLE_DECLARATION
+
+    def _format_declarator(self,
+                           data_type: Any,
+                           pointer: bool,
+                           const: bool,
+                           name: str,
+                           array: int | None) -> str:
+        """
+        Formats the part of a declaration that follows the data type
+        """
+        compiled = self._compiled
+        type_is_pointer = isinstance(data_type, core.Type) and data_type.pointer
+        if pointer:
+            if const:
+                result = compiled.const_pointer
+                if result is None:
                     raise NotImplementedError("Only default space location supported for pointer qualifiers")
             else:
-                if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                    result += "* "
-                elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                    if isinstance(elem.data_type, core.Type) and elem.data_type.pointer:
-                        result += "*"
-                    else:
-                        result += " *"
-                elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                    result += " * "
-                else:
-                    raise ValueError(self.style.pointer_alignment)
-        elif isinstance(elem.data_type, core.Type):
-            if not (elem.data_type.pointer and self.style.pointer_alignment == c_style.Alignment.RIGHT):
-                result += " "
+                result = compiled.pointer[type_is_pointer]
         else:
-            result += " "
-        result += elem.name
-        if elem.array is not None:
-            result += f"[{elem.array}]"
-        self._write(result)
-        self.last_element = ElementType.VARIABLE_DECLARATION
+            result = compiled.name_separator[type_is_pointer]
+        if array is None:
+            return result + name
+        return f"{result}{name}[{array}]"
 
     def _write_typedef_usage(self, elem: core.TypeDef):
         """
@@ -452,41 +1786,8 @@ class Writer(Formatter):
             self._write_declaration(elem.base_type)
         else:
             raise NotImplementedError(str(type(elem.base_type)))
-        result = ""
-        if elem.pointer:
-            if elem.const:
-                if self.style.space_around_pointer_qualifiers == c_style.SpaceLocation.DEFAULT:
-                    if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                        result += "* const "
-                    elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                        result += "*const "
-                    elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                        result += " * const "
-                    else:
-                        raise ValueError(self.style.pointer_alignment)
-                else:
-                    raise NotImplementedError("Only default space location supported for pointer qualifiers")
-            else:
-                if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                    result += "* "
-                elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                    if isinstance(elem.base_type, core.Type) and elem.base_type.pointer:
-                        result += "*"
-                    else:
-                        result += " *"
-                elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                    result += " * "
-                else:
-                    raise ValueError(self.style.pointer_alignment)
-        else:
-            if not ((isinstance(elem.base_type, core.Type) and elem.base_type.pointer) and (
-                    self.style.pointer_alignment == c_style.Alignment.RIGHT)):
-                result += " "
         assert elem.name is not None
-        result += elem.name
-        if elem.array is not None:
-            result += f"[{elem.array}]"
-        self._write(result)
+        self._write(self._format_declarator(elem.base_type, elem.pointer, elem.const, elem.name, elem.array))
         self.last_element = ElementType.TYPEDEF
 
     def _write_function_usage(self, elem: core.Function) -> None:
@@ -533,8 +1834,7 @@ class Writer(Formatter):
             self._dedent()
             self._write_ending_brace()
         else:
-            if self.style.short_functions_on_single_line in (c_style.ShortFunction.EMPTY,
-                                                             c_style.ShortFunction.INLINE):
+            if self._compiled.short_empty_block:
                 self._write("}")
                 self._eol()
             else:
@@ -544,7 +1844,7 @@ class Writer(Formatter):
         handled = False
         if self.last_element == ElementType.FUNCTION_DECLARATION:
             handled = True
-            if self.style.brace_wrapping.after_function:
+            if self._compiled.wrap_after_function:
                 self._eol()
                 self._start_line()
                 self._write("{")
@@ -585,7 +1885,52 @@ class Writer(Formatter):
         self._write_expression(elem.rhs)
 
     def _write_string_literal(self, elem: core.StringLiteral) -> None:
-        self._write(f'"{elem.text}"')
+        text = elem.text
+        if text.__class__ is str and not elem.escape and elem.max_bytes is None:
+            self._write(f'"{text}"')
+            return
+        chunks: Iterable[str] = (text,) if isinstance(text, str) else text
+        if elem.escape:
+            chunks = map(_escape_string, chunks)
+        if elem.max_bytes is None:
+            self._write('"')
+            for chunk in chunks:
+                self._write(chunk)
+                if len(self._buf) >= self.flush_threshold:
+                    self._flush()
+            self._write('"')
+        else:
+            self._write_split_string_literal(chunks, elem.max_bytes)
+
+    def _write_split_string_literal(self, chunks: Iterable[str], max_bytes: int) -> None:
+        """
+        Writes text as adjacent string literals of at most max_bytes bytes each.
+        Literals after the first are written on lines of their own, indented one level.
+        """
+        self._indent()
+        continuation = "\n" + self.indentation_str + '"'
+        self._dedent()
+        pending = b""
+        first = True
+        for chunk in chunks:
+            pending += chunk.encode("utf-8")
+            start = 0
+            while len(pending) - start > max_bytes:
+                end = _literal_cut(pending, start, start + max_bytes)
+                self._write('"' if first else continuation)
+                self._write(pending[start:end].decode("utf-8"))
+                self._write('"')
+                if not first:
+                    self.line_number += 1
+                first = False
+                start = end
+            pending = pending[start:]
+            self._flush()
+        self._write('"' if first else continuation)
+        self._write(pending.decode("utf-8"))
+        self._write('"')
+        if not first:
+            self.line_number += 1
 
     def _write_func_return(self, elem: core.FunctionReturn) -> None:
         self._write("return ")
@@ -612,7 +1957,7 @@ class Writer(Formatter):
         Writes struct declaration
         """
         self._write(f"struct {elem.name}")
-        if self.style.brace_wrapping.after_struct:
+        if self._compiled.wrap_after_struct:
             self._eol()
             self._start_line()
             self._write("{")
@@ -643,40 +1988,7 @@ class Writer(Formatter):
             self._write_struct_usage(elem.data_type)
         else:
             raise NotImplementedError(str(type(elem.data_type)))
-        result = ""
-        if elem.pointer:
-            if elem.const:
-                if self.style.space_around_pointer_qualifiers == c_style.SpaceLocation.DEFAULT:
-                    if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                        result += "* const "
-                    elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                        result += "*const "
-                    elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                        result += " * const "
-                    else:
-                        raise ValueError(self.style.pointer_alignment)
-                else:
-                    raise NotImplementedError("Only default space location supported for pointer qualifiers")
-            else:
-                if self.style.pointer_alignment == c_style.Alignment.LEFT:
-                    result += "* "
-                elif self.style.pointer_alignment == c_style.Alignment.RIGHT:
-                    if isinstance(elem.data_type, core.Type) and elem.data_type.pointer:
-                        result += "*"
-                    else:
-                        result += " *"
-                elif self.style.pointer_alignment == c_style.Alignment.MIDDLE:
-                    result += " * "
-                else:
-                    raise ValueError(self.style.pointer_alignment)
-        else:
-            if not (isinstance(elem.data_type, core.Type) and elem.data_type.pointer and (
-                    self.style.pointer_alignment == c_style.Alignment.RIGHT)):
-                result += " "
-        result += elem.name
-        if elem.array is not None:
-            result += f"[{elem.array}]"
-        self._write(result)
+        self._write(self._format_declarator(elem.data_type, elem.pointer, elem.const, elem.name, elem.array))
 
 # Preprocessor directives
 
@@ -709,3 +2021,19 @@ class Writer(Formatter):
     def _write_extern(self, elem: core.Extern) -> None:
         self._write(f'extern "{elem.language}"')
         self.last_element = ElementType.DIRECTIVE
+
+
+def _write_files_task(writer: Writer,
+                      only_if_changed: bool,
+                      items: list[tuple[str, core.Sequence]]) -> list[tuple[bool, BaseException | None]]:
+    """
+    Writes a batch of files for Writer.write_files.
+    Runs in worker threads and processes. Returns (changed, error) for each file.
+    """
+    outcomes: list[tuple[bool, BaseException | None]] = []
+    for file_path, sequence in items:
+        try:
+            outcomes.append((writer.write_file(sequence, file_path, only_if_changed), None))
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            outcomes.append((False, err))
+    return outcomes
@@ -0,0 +1,275 @@
+"""Unit tests for render cache"""
+
+# noqa D101
+# pylint: disable=missing-class-docstring, missing-function-docstring
+import functools
+import io
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile.core as core # noqa E402
+import cfile.cache as cache # noqa E402
+import cfile # noqa E402
+
+
+def _make_struct(name: str, num_members: int) -> core.Statement:
+    struct = core.Struct(name, [core.StructMember(f"m{i}", "int") for i in range(num_members)])
+    return core.Statement(core.Declaration(core.TypeDef(f"{name}_t", core.Declaration(struct))))
+
+
+def _make_struct_sequence(num_structs: int) -> core.Sequence:
+    seq = core.Sequence()
+    for i in range(num_structs):
+        seq.append(_make_struct(f"s{i}", 5))
+        seq.append(core.Declaration(core.Function(f"f{i}", "int")))
+        body = core.Block()
+        body.append(core.Statement(core.FunctionReturn(i)))
+        seq.append(body)
+        seq.append(core.Blank())
+    return seq
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_equal_models_have_equal_fingerprints(self):
+        self.assertEqual(cache.fingerprint(_make_struct("a", 3)), cache.fingerprint(_make_struct("a", 3)))
+        self.assertEqual(cache.fingerprint(cfile.StyleOptions()), cache.fingerprint(cfile.StyleOptions()))
+
+    def test_different_models_have_different_fingerprints(self):
+        base = cache.fingerprint(_make_struct("a", 3))
+        self.assertNotEqual(base, cache.fingerprint(_make_struct("b", 3)))
+        self.assertNotEqual(base, cache.fingerprint(_make_struct("a", 4)))
+        self.assertNotEqual(cache.fingerprint(core.Type("int")), cache.fingerprint(core.Type("int", const=True)))
+        self.assertNotEqual(cache.fingerprint(core.LineComment("x")), cache.fingerprint(core.BlockComment("x")))
+        self.assertNotEqual(cache.fingerprint(cfile.StyleOptions()),
+                            cache.fingerprint(cfile.StyleOptions(pointer_alignment=cfile.Alignment.RIGHT)))
+
+    def test_unsupported_object_raises_type_error(self):
+        with self.assertRaises(TypeError):
+            cache.fingerprint(core.Line([object()]))
+
+    def test_lazy_sequence_can_not_be_fingerprinted(self):
+        with self.assertRaises(TypeError):
+            cache.fingerprint(core.LazySequence(iter([core.Blank()])))
+
+    def test_chain_fingerprint_follows_its_sequences(self):
+        seq = core.Sequence()
+        seq.append(core.Statement("a"))
+        chain = core.SequenceChain(seq, seq)
+        before = cache.fingerprint(chain)
+        self.assertEqual(before, cache.fingerprint(core.SequenceChain(seq, seq)))
+        self.assertNotEqual(cache.fingerprint(seq.view(1)), cache.fingerprint(seq.view(0)))
+        seq.append(core.Statement("b"))
+        self.assertNotEqual(before, cache.fingerprint(chain))
+        with self.assertRaises(TypeError):
+            cache.fingerprint(core.SequenceChain(core.LazySequence(iter([core.Blank()]))))
+
+    def test_iterators_can_not_be_fingerprinted(self):
+        with self.assertRaises(TypeError):
+            cache.fingerprint(core.StringLiteral(io.StringIO("text")))
+        with self.assertRaises(TypeError):
+            cache.fingerprint(core.StringLiteral(iter(["text"])))
+
+    def test_fingerprint_follows_modification(self):
+        variable = core.Variable("a", "int")
+        before = cache.fingerprint(variable)
+        variable.data_type.pointer = True
+        self.assertNotEqual(before, cache.fingerprint(variable))
+
+    def test_fingerprint_follows_file_content(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "blob.bin")
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"abc")
+            initializer = core.FileInitializer(file_path)
+            before = cache.fingerprint(initializer)
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"abd")
+            self.assertNotEqual(before, cache.fingerprint(initializer))
+
+    def test_fingerprint_follows_function_code(self):
+        first, second = (lambda: 1), (lambda: 2)
+        self.assertEqual(first.__qualname__, second.__qualname__)
+        self.assertEqual(cache.fingerprint(first), cache.fingerprint(first))
+        self.assertNotEqual(cache.fingerprint(first), cache.fingerprint(second))
+
+    def test_fingerprint_follows_closure_defaults_and_partial_arguments(self):
+        def make_function(text):
+            return lambda: text
+
+        def function(text, suffix="a", *, prefix="b"):
+            return prefix + text + suffix
+        fingerprints = [cache.fingerprint(make_function("a")), cache.fingerprint(make_function("b")),
+                        cache.fingerprint(functools.partial(function, "a")),
+                        cache.fingerprint(functools.partial(function, "b")),
+                        cache.fingerprint(functools.partial(function, "a", prefix="c"))]
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+        self.assertEqual(fingerprints[0], cache.fingerprint(make_function("a")))
+        function.__defaults__ = ("b",)
+        self.assertNotEqual(fingerprints[2], cache.fingerprint(functools.partial(function, "a")))
+        with self.assertRaises(TypeError):
+            cache.fingerprint(make_function(object()))
+
+    def test_reference_cycle_raises_value_error(self):
+        seq = core.Sequence()
+        seq.append(seq)
+        with self.assertRaises(ValueError):
+            cache.fingerprint(seq)
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            self.assertIsNone(render_cache.get("key"))
+            render_cache.put("key", "int a;\n")
+            self.assertEqual("int a;\n", render_cache.get("key"))
+            stats = render_cache.stats()
+            self.assertEqual((1, 1, 1, 1), (stats.hits, stats.misses, stats.writes, stats.entries))
+            self.assertIn("hit rate 50.0%", stats.report())
+            self.assertEqual(1, cache.RenderCache(tmp_dir).stats().entries)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir, max_size=350)
+            for i in range(3):
+                render_cache.put(f"key{i}", "x" * 100)
+                os.utime(render_cache._path(f"key{i}"), (i, i))  # pylint: disable=protected-access
+            render_cache.get("key0")  # key1 is now least recently used
+            render_cache.put("key3", "x" * 100)
+            self.assertIsNone(render_cache.get("key1"))
+            self.assertIsNotNone(render_cache.get("key0"))
+            self.assertIsNotNone(render_cache.get("key2"))
+            stats = render_cache.stats()
+            self.assertEqual(1, stats.evictions)
+            self.assertEqual(300, stats.size)
+
+
+class TestWriterWithRenderCache(unittest.TestCase):
+
+    def test_output_is_identical_with_and_without_cache(self):
+        seq = _make_struct_sequence(50)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            self.assertEqual(expected, cfile.Writer(cfile.StyleOptions(), render_cache=render_cache).write_str(seq))
+            misses = render_cache.stats().misses
+            self.assertGreater(misses, 0)
+            writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+            self.assertEqual(expected, writer.write_str(seq))
+            self.assertEqual(expected, "".join(writer.iter_chunks(seq)))
+            stats = render_cache.stats()
+            self.assertEqual(misses, stats.misses)
+            self.assertEqual(2 * misses, stats.hits)
+
+    def test_only_changed_groups_are_rendered_again(self):
+        seq = _make_struct_sequence(200)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+            writer.write_str(seq)
+            groups = render_cache.stats().misses
+            seq.elements[100] = _make_struct("changed", 5)
+            expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+            self.assertEqual(expected, writer.write_str(seq))
+            stats = render_cache.stats()
+            self.assertEqual(groups + 1, stats.misses)
+            self.assertEqual(groups - 1, stats.hits)
+
+    def test_style_is_part_of_key(self):
+        seq = _make_struct_sequence(5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            for options in (cfile.StyleOptions(),
+                            cfile.StyleOptions(break_before_braces=cfile.BreakBeforeBraces.ATTACH)):
+                expected = cfile.Writer(options).write_str(seq)
+                self.assertEqual(expected, cfile.Writer(options, render_cache=render_cache).write_str(seq))
+
+    def test_handler_code_is_part_of_key(self):
+        seq = _make_struct_sequence(5)
+        seq.append(core.Statement(core.FunctionCall("puts", [core.StringLiteral("abc")])))
+        handlers = (lambda writer, elem: writer._write('"a"'),  # pylint: disable=protected-access
+                    lambda writer, elem: writer._write('"b"'))  # pylint: disable=protected-access
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            for handler, expected in zip(handlers, ('puts("a");', 'puts("b");')):
+                writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+                writer.register(core.StringLiteral, handler)
+                self.assertIn(expected, writer.write_str(seq))
+
+    def test_handler_closure_and_partial_arguments_are_part_of_key(self):
+        def write_text(writer, elem, text):  # pylint: disable=unused-argument
+            writer._write(f'"{text}"')  # pylint: disable=protected-access
+
+        def make_handler(text):
+            return lambda writer, elem: write_text(writer, elem, text)
+        seq = _make_struct_sequence(5)
+        seq.append(core.Statement(core.FunctionCall("puts", [core.StringLiteral("abc")])))
+        handlers = [(make_handler("A"), 'puts("A");'), (make_handler("B"), 'puts("B");'),
+                    (functools.partial(write_text, text="X"), 'puts("X");'),
+                    (functools.partial(write_text, text="Y"), 'puts("Y");'),
+                    (make_handler(type("Text", (), {"__str__": lambda self: "Z", "__slots__": ()})()), 'puts("Z");')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            for handler, expected in handlers:
+                with self.subTest(expected=expected):
+                    writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+                    writer.register(core.StringLiteral, handler)
+                    self.assertIn(expected, writer.write_str(seq))
+                    file_path = os.path.join(tmp_dir, "out.c")
+                    writer.write_file(seq, file_path, regions=True)
+                    writer.write_file(seq, file_path, regions=True)
+                    with open(file_path, encoding="utf-8") as fh:  # pylint: disable=invalid-name
+                        self.assertIn(expected, fh.read())
+
+    def test_methods_of_writer_subclass_are_part_of_key(self):
+        class FirstWriter(cfile.Writer):
+            def _write_func_return(self, elem: core.FunctionReturn) -> None:
+                self._write("return 1")
+
+        class SecondWriter(cfile.Writer):
+            def _write_func_return(self, elem: core.FunctionReturn) -> None:
+                self._write("return 2")
+        SecondWriter.__qualname__ = FirstWriter.__qualname__  # Same class, with modified code
+        SecondWriter._write_func_return.__qualname__ = FirstWriter._write_func_return.__qualname__
+        seq = _make_struct_sequence(5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            for writer_class, expected in ((FirstWriter, "return 1;"), (SecondWriter, "return 2;")):
+                self.assertIn(expected, writer_class(cfile.StyleOptions(), render_cache=render_cache).write_str(seq))
+
+    def test_lazy_sequences_are_written_without_consuming_them_twice(self):
+        seq = _make_struct_sequence(50)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        lazy_seq = core.LazySequence(iter(seq.elements))
+        nested_seq = _make_struct_sequence(50)
+        nested_seq.elements[60:] = [core.LazySequence(iter(nested_seq.elements[60:]))]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(tmp_dir)
+            writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+            self.assertEqual(expected, writer.write_str(lazy_seq))
+            self.assertEqual(expected, writer.write_str(nested_seq))
+
+    def test_modified_file_is_rendered_again(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "blob.bin")
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x03")
+            seq = _make_struct_sequence(5)
+            seq.append(core.Statement(core.Declaration(core.Variable("blob", "uint8_t", array=3),
+                                                       core.FileInitializer(file_path))))
+            render_cache = cache.RenderCache(os.path.join(tmp_dir, "cache"))
+            writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+            self.assertIn("0x03", writer.write_str(seq))
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x04")
+            text = writer.write_str(seq)
+            self.assertIn("0x04", text)
+            self.assertEqual(cfile.Writer(cfile.StyleOptions()).write_str(seq), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+"""Unit tests for core elements"""
+
+# noqa D101
+# pylint: disable=missing-class-docstring, missing-function-docstring
+import gc
+import inspect
+import os
+import pickle
+import subprocess
+import sys
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile.core as core # noqa E402
+import cfile # noqa E402
+
+
+def _make_statements() -> list[core.Statement]:
+    """
+    Source of lazy sequences, module level so that it can be pickled
+    """
+    return [core.Statement("a"), core.Statement("b")]
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_core_classes_have_no_instance_dict(self):
+        for name, cls in inspect.getmembers(core, inspect.isclass):
+            if issubclass(cls, (core.Element, core.Sequence)):
+                with self.subTest(cls=name):
+                    self.assertNotIn("__dict__", dir(cls))
+
+    def test_attributes_can_be_modified(self):
+        variable = core.Variable("var", "int")
+        variable.name = "other"
+        variable.static = True
+        self.assertEqual(variable.name, "other")
+        self.assertTrue(variable.qualifier("static"))
+        with self.assertRaises(AttributeError):
+            variable.unknown = 1  # pylint: disable=assigning-non-slot
+
+    def test_user_subclass_can_add_attributes(self):
+        class TaggedStatement(core.Statement):
+            pass
+        statement = TaggedStatement("x = 0")
+        statement.tag = "init"
+        self.assertEqual(statement.tag, "init")
+        self.assertEqual(statement.parts, ("x = 0",))
+
+
+class TestTypePool(unittest.TestCase):
+
+    def test_identical_types_are_shared(self):
+        pool = core.TypePool()
+        int_type = pool.get("int")
+        self.assertIs(pool.get("int"), int_type)
+        self.assertIsNot(pool.get("int", const=True), int_type)
+        self.assertIsNot(pool.get("int", pointer=True), int_type)
+        self.assertIsNot(pool.get("int", volatile=True), int_type)
+        self.assertIsNot(pool.get("int", array=4), int_type)
+        self.assertIs(pool.get(int_type, const=True), pool.get(int_type, const=True))
+
+    def test_unused_types_are_freed(self):
+        pool = core.TypePool()
+        int_type = pool.get("int")
+        pool.get("char")
+        gc.collect()
+        self.assertEqual(len(pool), 1)
+        self.assertIs(pool.get("int"), int_type)
+
+    def test_factory_does_not_intern_by_default(self):
+        factory = cfile.CFactory()
+        self.assertIsNone(factory.type_pool)
+        self.assertIsNot(factory.variable("a", "int").data_type, factory.variable("b", "int").data_type)
+
+    def test_factory_interns_types(self):
+        factory = cfile.CFactory(intern_types=True)
+        int_type = factory.type("int")
+        self.assertIs(factory.variable("a", "int").data_type, int_type)
+        self.assertIs(factory.struct_member("b", "int").data_type, int_type)
+        self.assertIs(factory.typedef("int_t", "int").base_type, int_type)
+        self.assertIs(factory.function("f", "int").return_type, int_type)
+        self.assertIs(factory.function("g").return_type, factory.type("void"))
+        self.assertIs(factory.type("int", const=True), factory.type("int", const=True))
+
+    def test_interned_types_give_same_output(self):
+        results = []
+        for intern_types in (False, True):
+            factory = cfile.CFactory(intern_types=intern_types)
+            code = factory.sequence()
+            code.append(factory.statement(factory.declaration(factory.variable("a", "int", pointer=True))))
+            code.append(factory.statement(factory.declaration(factory.variable("b", factory.type("char", const=True)))))
+            code.append(factory.declaration(factory.function("f", "int", params=[factory.variable("x", "int")])))
+            results.append(cfile.Writer(cfile.StyleOptions()).write_str(code))
+        self.assertEqual(results[0], results[1])
+
+
+class TestLazySequence(unittest.TestCase):
+
+    def test_iterator_source_can_only_be_consumed_once(self):
+        seq = core.LazySequence(core.Statement(f"x = {i}") for i in range(3))
+        self.assertEqual(3, len(list(seq.elements)))
+        with self.assertRaises(RuntimeError):
+            seq.elements  # pylint: disable=pointless-statement
+
+    def test_callable_source_is_called_each_time(self):
+        seq = core.LazySequence(lambda: (core.Statement(f"x = {i}") for i in range(3)))
+        self.assertEqual(3, len(list(seq.elements)))
+        self.assertEqual(3, len(list(seq.elements)))
+
+    def test_length_is_optional(self):
+        self.assertEqual(5, len(core.LazySequence(range(5), length=5)))
+        with self.assertRaises(TypeError):
+            len(core.LazySequence(range(5)))
+        self.assertTrue(core.LazySequence(range(5)))
+        self.assertFalse(core.LazySequence([], length=0))
+
+    def test_elements_can_not_be_copied(self):
+        seq = core.LazySequence(range(5))
+        with self.assertRaises(TypeError):
+            core.Sequence().extend(seq)
+        with self.assertRaises(TypeError):
+            seq.append(core.Blank())
+        with self.assertRaises(TypeError):
+            core.LazySequence(5)
+
+    def test_pickle(self):
+        seq = core.LazySequence(_make_statements, length=2)
+        copy = pickle.loads(pickle.dumps(seq))
+        self.assertEqual(2, len(copy))
+        self.assertEqual(["a", "b"], [elem.parts[0] for elem in copy.elements])
+
+
+class TestSequenceChain(unittest.TestCase):
+
+    def make_sequence(self, *names: str) -> core.Sequence:
+        seq = core.Sequence()
+        for name in names:
+            seq.append(core.Statement(name))
+        return seq
+
+    def test_chain_links_sequences_without_copying(self):
+        prologue = self.make_sequence("a", "b")
+        body = self.make_sequence("c")
+        chain = core.SequenceChain(prologue, body)
+        chain.extend(prologue)
+        self.assertEqual(5, len(chain))
+        self.assertEqual(["a", "b", "c", "a", "b"], [elem.parts[0] for elem in chain.elements])
+        body.append(core.Statement("d"))
+        self.assertEqual(6, len(chain))
+        self.assertIs(chain.sequences[0], chain.sequences[2])
+        with self.assertRaises(TypeError):
+            chain.append(core.Statement("e"))
+        with self.assertRaises(TypeError):
+            chain.extend([core.Statement("e")])
+
+    def test_view(self):
+        seq = self.make_sequence("a", "b", "c", "d")
+        self.assertEqual(["b", "c"], [elem.parts[0] for elem in seq.view(1, 3).elements])
+        self.assertEqual(["c", "d"], [elem.parts[0] for elem in seq.view(-2).elements])
+        self.assertEqual(2, len(seq.view(-2)))
+        self.assertFalse(seq.view(4))
+        seq.append(core.Statement("e"))
+        self.assertEqual(["d", "e"], [elem.parts[0] for elem in seq.view(-2).elements])
+
+    def test_view_of_chain(self):
+        chain = core.SequenceChain(self.make_sequence("a", "b"), self.make_sequence("c", "d"))
+        self.assertEqual(["b", "c"], [elem.parts[0] for elem in chain.view(1, 3).elements])
+        self.assertEqual(["d"], [elem.parts[0] for elem in chain.view(-1).elements])
+
+    def test_pickle(self):
+        chain = core.SequenceChain(self.make_sequence("a", "b"), core.LazySequence(_make_statements))
+        copy = pickle.loads(pickle.dumps(chain))
+        self.assertEqual(["a", "b", "a", "b"], [elem.parts[0] for elem in copy.elements])
+        copy = pickle.loads(pickle.dumps(chain.view(1, 3)))
+        self.assertEqual(["b", "a"], [elem.parts[0] for elem in copy.elements])
+        copy.sequence.sequences[0].append(core.Statement("c"))
+        self.assertEqual(["b", "c"], [elem.parts[0] for elem in copy.elements])
+
+
+class TestVersions(unittest.TestCase):
+
+    def test_changes_increase_version(self):
+        seq = core.Sequence()
+        versions = [seq.version]
+        seq.append(core.Statement("a"))
+        versions.append(seq.version)
+        seq.extend(core.Sequence().append(core.Statement("b")))
+        versions.append(seq.version)
+        seq[0] = core.Statement("c")
+        versions.append(seq.version)
+        seq.touch()
+        versions.append(seq.version)
+        self.assertEqual(sorted(set(versions)), versions)
+
+    def test_changes_propagate_to_enclosing_sequences(self):
+        outer = core.Sequence()
+        inner = core.Sequence()
+        block = core.Block()
+        outer.append(inner)
+        inner.append(block)
+        chain = core.SequenceChain(inner)
+        view = outer.view(0, 1)
+        sibling = core.Block()
+        outer.append(sibling)
+        versions = (outer.version, inner.version, chain.version, view.version, sibling.version)
+        block.append(core.Statement("a"))
+        self.assertGreater(outer.version, versions[0])
+        self.assertGreater(inner.version, versions[1])
+        self.assertGreater(chain.version, versions[2])
+        self.assertGreater(view.version, versions[3])
+        self.assertEqual(sibling.version, versions[4])
+        self.assertEqual(block.version, outer.version)
+
+    def test_nested_sequence_added_by_extend_or_assignment(self):
+        outer = core.Sequence()
+        outer.extend(core.Sequence().append(core.Block()))
+        outer[0:0] = [core.Block()]
+        for block in outer.elements:
+            version = outer.version
+            block.append(core.Statement("a"))
+            self.assertGreater(outer.version, version)
+
+    def test_sequence_shared_by_several_sequences(self):
+        prologue = core.Sequence()
+        chains = [core.SequenceChain(prologue, core.Sequence()) for _ in range(3)]
+        outer = core.Sequence()
+        outer.extend(core.Sequence().append(chains[0]).append(chains[1]))
+        versions = [seq.version for seq in [outer] + chains]
+        prologue.append(core.Statement("a"))
+        for version, seq in zip(versions, [outer] + chains):
+            self.assertGreater(seq.version, version)
+        versions = [seq.version for seq in [outer] + chains]
+        chains[2].sequences[1].append(core.Statement("b"))
+        self.assertEqual(versions[:3], [seq.version for seq in [outer] + chains[:2]])
+        self.assertGreater(chains[2].version, versions[3])
+
+    def test_reference_cycle(self):
+        outer = core.Sequence()
+        inner = core.Block()
+        outer.append(inner)
+        inner.append(outer)
+        inner.touch()
+        self.assertEqual(inner.version, outer.version)
+
+    def test_contains_lazy(self):
+        lazy = core.LazySequence(list)
+        block = core.Block()
+        outer = core.Sequence().append(block)
+        self.assertFalse(outer.contains_lazy)
+        block.append(core.SequenceView(core.SequenceChain(lazy)))
+        self.assertTrue(outer.contains_lazy)
+        self.assertTrue(block.contains_lazy)
+        self.assertTrue(lazy.contains_lazy)
+        block.elements.clear()
+        block.touch()
+        self.assertFalse(outer.contains_lazy)
+
+    def test_pickle_in_other_process(self):
+        block = core.Block().append(core.Block().append(core.Statement(core.FunctionReturn(0))))
+        for _ in range(100):
+            block.touch()  # Higher version than sequences in the new process
+        outer = core.Sequence().append(block)
+        script = (
+            "import pickle, sys\n"
+            "sys.path.insert(0, sys.argv[1])\n"
+            "import cfile\n"
+            "import cfile.core as core\n"
+            "outer = pickle.loads(sys.stdin.buffer.read())\n"
+            "writer = cfile.Writer(cfile.StyleOptions(), incremental=True)\n"
+            "writer.write_str(outer)\n"
+            "outer.elements[0].elements[0].append(core.Statement(core.FunctionReturn(1)))\n"
+            "sys.stdout.write(writer.write_str(outer))\n")
+        src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+        result = subprocess.run([sys.executable, "-c", script, src_dir], input=pickle.dumps(outer),
+                                capture_output=True, check=True)
+        self.assertEqual(b"{\n    {\n        return 0;\n        return 1;\n    }\n}\n", result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Unit tests for source map"""
+
+# noqa D101
+# pylint: disable=missing-class-docstring, missing-function-docstring
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cfile.core as core # noqa E402
+import cfile.sourcemap as sourcemap # noqa E402
+import cfile # noqa E402
+
+
+def _make_sequence() -> core.Sequence:
+    seq = core.Sequence()
+    seq.append(core.IncludeDirective("stdint.h", system=True))
+    seq.append(core.DefineDirective("MAX(a, b)", "((a) > (b) ? (a) : (b))"))
+    seq.append(core.Blank())
+    seq.append(core.Statement(core.Declaration(core.Variable("counter", "int", static=True), 0)))
+    seq.append(core.Declaration(core.Function("update", "void", params=[core.Variable("value", "int")])))
+    body = core.Block()
+    body.append(core.Statement(core.Declaration(core.Variable("previous", "int"), core.Variable("counter", "int"))))
+    body.append(core.Statement(core.Assignment("counter", "value")))
+    seq.append(body)
+    return seq
+
+
+class TestSourceMap(unittest.TestCase):
+
+    def test_add_and_find(self):
+        source_map = sourcemap.SourceMap()
+        source_map.add("Statement", "a", 1, 0, 0, 10, True)
+        source_map.add("Declaration", "a", 1, 0, 0, 9)
+        source_map.add("Statement", "b", 2, 0, 11, 10, True)
+        self.assertEqual(3, len(source_map))
+        self.assertEqual(sourcemap.SourceMapEntry("Declaration", "a", 1, 0, 0, 9, False), source_map[1])
+        self.assertEqual([source_map[0], source_map[1]], source_map.find("a"))
+        self.assertEqual([], source_map.find("c"))
+        self.assertEqual(source_map[1], source_map.at_offset(5))
+        self.assertEqual(source_map[0], source_map.at_offset(9))
+        self.assertIsNone(source_map.at_offset(10))
+        self.assertEqual(source_map[2], source_map.at_offset(11))
+
+    def test_json_round_trip(self):
+        source_map = sourcemap.SourceMap()
+        source_map.add("Statement", "a", 1, 0, 0, 10, True)
+        source_map.add("Declaration", "a", 1, 0, 0, 9)
+        copy = sourcemap.SourceMap.from_json(source_map.to_json())
+        self.assertEqual([source_map[0], source_map[1]], [copy[0], copy[1]])
+        self.assertEqual([copy[0], copy[1]], copy.find("a"))
+        with self.assertRaises(ValueError):
+            sourcemap.SourceMap.from_dict({"version": 2})
+
+
+class TestWriterSourceMap(unittest.TestCase):
+
+    def test_source_map_is_off_by_default(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.write_str(_make_sequence())
+        self.assertIsNone(writer.source_map)
+
+    def test_positions_match_output(self):
+        seq = _make_sequence()
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        for iterative in (False, True):
+            with self.subTest(iterative=iterative):
+                writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative, source_map=True)
+                output = writer.write_str(seq)
+                self.assertEqual(expected, output)
+                source_map = writer.source_map
+                lines = output.splitlines(keepends=True)
+                for i in range(len(source_map)):
+                    entry = source_map[i]
+                    line_offset = sum(len(line) for line in lines[:entry.line - 1])
+                    self.assertEqual(line_offset + entry.column, entry.offset)
+                self.assertEqual(6, sum(source_map.top_level))
+                self.assertEqual(len(output), sum(source_map[i].length for i in range(len(source_map))
+                                                  if source_map[i].top_level))
+                entries = {entry.name: entry for entry in (source_map[i] for i in range(len(source_map)))}
+                self.assertEqual("#include <stdint.h>", output[0:entries["stdint.h"].length].rstrip())
+                self.assertIn("MAX", entries)
+                counter = source_map.find("counter")
+                self.assertEqual(["Statement", "Declaration"], [entry.kind for entry in counter])
+                self.assertEqual("static int counter = 0;\n",
+                                 output[counter[0].offset:counter[0].offset + counter[0].length])
+                self.assertEqual("static int counter = 0",
+                                 output[counter[1].offset:counter[1].offset + counter[1].length])
+                update = source_map.find("update")
+                self.assertEqual(1, len(update))
+                self.assertTrue(update[0].top_level)
+                previous = source_map.find("previous")[0]
+                self.assertEqual((7, 4, False), (previous.line, previous.column, previous.top_level))
+                self.assertEqual(previous, source_map.at_offset(previous.offset + 1))
+
+    def test_source_map_of_write_file(self):
+        seq = _make_sequence()
+        writer = cfile.Writer(cfile.StyleOptions(), source_map=True)
+        output = writer.write_str(seq)
+        expected = writer.source_map.to_dict()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer.write_file(seq, os.path.join(tmp_dir, "output.c"))
+        self.assertEqual(expected, writer.source_map.to_dict())
+        last = [entry for entry in (writer.source_map[i] for i in range(len(writer.source_map))) if entry.top_level][-1]
+        self.assertEqual("Block", last.kind)
+        self.assertEqual(len(output), last.offset + last.length)
+
+
+if __name__ == '__main__':
+    unittest.main()
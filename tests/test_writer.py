@@ -2,15 +2,58 @@
 
 # noqa D101
 # pylint: disable=missing-class-docstring, missing-function-docstring
+import array
+import io
 import os
 import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
 import cfile.core as core # noqa E402
 import cfile.style as style # noqa E402
+import cfile.cache as cache # noqa E402
 import cfile # noqa E402
 
 
+def _make_file_sequence(index: int) -> core.Sequence:
+    seq = core.Sequence()
+    seq.append(core.IncludeDirective(f"file{index}.h"))
+    seq.append(core.Statement(core.Declaration(core.Variable(f"var{index}", "int"), index)))
+    return seq
+
+
+def _make_variable_sequence(num_variables: int, blanks: bool = False) -> core.Sequence:
+    seq = core.Sequence()
+    for i in range(num_variables):
+        seq.append(core.Statement(core.Declaration(core.Variable(f"var{i}", "int"), i)))
+        if blanks:
+            seq.append(core.Blank())
+    return seq
+
+
+def _make_function_sequence(num_functions: int, prefix: str = "f") -> core.Sequence:
+    """
+    Functions declaring a variable and returning it from a nested block, followed by a blank line
+    """
+    seq = core.Sequence()
+    for i in range(num_functions):
+        seq.append(core.Declaration(core.Function(f"{prefix}{i}", "int")))
+        body = core.Block()
+        body.append(core.Statement(core.Declaration(core.Variable("a", "int"), i)))
+        inner = core.Block()
+        inner.append(core.Statement(core.FunctionReturn("a")))
+        body.append(inner)
+        seq.append(body)
+        seq.append(core.Blank())
+    return seq
+
+
+def _read_text(file_path: str) -> str:
+    with open(file_path, encoding="utf-8") as fh:  # pylint: disable=invalid-name
+        return fh.read()
+
+
 class TestWhitespace(unittest.TestCase):
 
     def test_write_blank(self):
@@ -537,6 +580,49 @@ class TestStringLiteral(unittest.TestCase):
         output = writer.write_str_elem(element)
         self.assertEqual(output, r'"Row1\nRow2\n"')
 
+    def test_escaped_string(self):
+        element = core.StringLiteral('Say "hi"\n\tC:\\dir\x01\x7f\u00e4', escape=True)
+        writer = cfile.Writer(cfile.StyleOptions())
+        output = writer.write_str_elem(element)
+        self.assertEqual(output, '"Say \\"hi\\"\\n\\tC:\\\\dir\\001\\177\u00e4"')
+
+    def test_streamed_string(self):
+        element = core.StringLiteral(io.StringIO("Row1\nRow2\n"), escape=True)
+        writer = cfile.Writer(cfile.StyleOptions())
+        output = writer.write_str_elem(element)
+        self.assertEqual(output, r'"Row1\nRow2\n"')
+
+    def test_split_string(self):
+        expected = """{
+    s = "0123456789"
+        "abc\\n";
+}"""
+        block = core.Block()
+        block.append(core.Statement(core.Assignment("s", core.StringLiteral("0123456789abc\n", True, 10))))
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual(expected, writer.write_str_elem(block))
+
+    def test_split_string_keeps_escapes_and_characters(self):
+        text = "".join(chr(i) for i in range(128)) + "\u00e4\u20ac\U0001f600" + "\\" * 7
+        writer = cfile.Writer(cfile.StyleOptions())
+        expected = writer.write_str_elem(core.StringLiteral(text, escape=True))[1:-1]
+        raw_text = r"\x41\x4142\u00e4\U0001F600\12\0\\\\\\x\"" * 3
+        for max_bytes in range(10, 24):
+            with self.subTest(max_bytes=max_bytes):
+                chunks = (text[i:i + 7] for i in range(0, len(text), 7))
+                output = writer.write_str_elem(core.StringLiteral(chunks, escape=True, max_bytes=max_bytes))
+                pieces = [line.strip()[1:-1] for line in output.splitlines()]
+                self.assertTrue(all(len(piece.encode("utf-8")) <= max_bytes for piece in pieces))
+                self.assertEqual(expected, "".join(pieces))
+                for piece in pieces:
+                    self.assertFalse(piece.endswith("\\") and not piece.endswith("\\\\"))
+                output = writer.write_str_elem(core.StringLiteral(raw_text, max_bytes=max_bytes))
+                pieces = [line.strip()[1:-1] for line in output.splitlines()]
+                self.assertEqual(raw_text, "".join(pieces))
+                for piece in pieces:
+                    self.assertNotRegex(piece, r"(^|[^\\])(\\\\)*\\"
+                                               r"(x[0-9A-Fa-f]?|u[0-9A-Fa-f]{0,3}|U[0-9A-Fa-f]{0,7})$")
+
 
 class TestFunctionCall(unittest.TestCase):
 
@@ -751,5 +837,985 @@ class TestStructReference(unittest.TestCase):
         self.assertEqual('struct os_task_tag;', writer.write_str_elem(struct))
 
 
+class TestDispatch(unittest.TestCase):
+
+    def test_subclass_of_core_element_uses_handler_of_base_class(self):
+        class MyStatement(core.Statement):
+            pass
+
+        seq = core.Sequence()
+        seq.append(MyStatement("return 0"))
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual("return 0;\n", writer.write_str(seq))
+
+    def test_register_handler_for_user_defined_element(self):
+        class Pragma(core.Directive):
+            def __init__(self, text: str) -> None:
+                super().__init__()
+                self.text = text
+
+        def write_pragma(writer: cfile.Writer, elem: Pragma) -> None:
+            writer._write(f"#pragma {elem.text}")  # pylint: disable=protected-access
+
+        seq = core.Sequence()
+        seq.append(Pragma("once"))
+        seq.append(core.Line([core.Statement("x = 1"), Pragma("inline")]))
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.register(Pragma, write_pragma)
+        self.assertEqual("#pragma once\nx = 1; #pragma inline\n", writer.write_str(seq))
+
+    def test_register_overrides_handler_of_core_element(self):
+        def write_upper_literal(writer: cfile.Writer, elem: core.StringLiteral) -> None:
+            writer._write(f'"{elem.text.upper()}"')  # pylint: disable=protected-access
+
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual('"abc"', writer.write_str_elem(core.StringLiteral("abc")))
+        writer.register(core.StringLiteral, write_upper_literal)
+        self.assertEqual('"ABC"', writer.write_str_elem(core.StringLiteral("abc")))
+
+    def test_unknown_element_raises_not_implemented_error(self):
+        class Unknown:
+            pass
+
+        seq = core.Sequence()
+        seq.append(Unknown())
+        writer = cfile.Writer(cfile.StyleOptions())
+        with self.assertRaises(NotImplementedError):
+            writer.write_str(seq)
+
+
+class TestOutputBuffer(unittest.TestCase):
+
+    def test_small_flush_threshold_gives_identical_output(self):
+        seq = _make_function_sequence(20)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.flush_threshold = 3
+        self.assertEqual(expected, writer.write_str(seq))
+
+    def test_write_file_gives_same_output_as_write_str(self):
+        seq = _make_function_sequence(20)
+        writer = cfile.Writer(cfile.StyleOptions())
+        expected = writer.write_str(seq)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "main.c")
+            writer.write_file(seq, file_path)
+            with open(file_path, encoding="utf-8", newline="") as fh:
+                self.assertEqual(expected, fh.read())
+
+    def test_column_is_calculated_from_buffer(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer._str_open()  # pylint: disable=protected-access
+        writer._write("int a;")  # pylint: disable=protected-access
+        self.assertEqual(6, writer.column)
+        writer._eol()  # pylint: disable=protected-access
+        writer._write("ab")  # pylint: disable=protected-access
+        writer._flush()  # pylint: disable=protected-access
+        writer._write("c")  # pylint: disable=protected-access
+        self.assertEqual(3, writer.column)
+        self.assertEqual(2, writer.line_number)
+
+
+class TestIterChunks(unittest.TestCase):
+
+    def test_joined_chunks_equal_write_str(self):
+        seq = _make_variable_sequence(200)
+        writer = cfile.Writer(cfile.StyleOptions())
+        expected = writer.write_str(seq)
+        self.assertEqual(expected, "".join(writer.iter_chunks(seq)))
+
+    def test_chunks_are_at_least_chunk_size_except_last(self):
+        seq = _make_variable_sequence(200)
+        writer = cfile.Writer(cfile.StyleOptions())
+        expected = writer.write_str(seq)
+        writer.flush_threshold = 8
+        chunks = list(writer.iter_chunks(seq, chunk_size=100))
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 100)
+            self.assertTrue(chunk.endswith("\n"))
+        self.assertEqual(expected, "".join(chunks))
+
+    def test_chunks_are_cut_inside_nested_sequences(self):
+        seq = core.Sequence()
+        seq.append(core.Declaration(core.Function("f", "void")))
+        body = core.Block()
+        body.append(core.LazySequence(lambda: _make_variable_sequence(200).elements))
+        body.extend(_make_variable_sequence(200))
+        seq.append(body)
+        for iterative in (False, True):
+            writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative)
+            expected = writer.write_str(seq)
+            writer.flush_threshold = 8
+            chunks = list(writer.iter_chunks(seq, chunk_size=100))
+            self.assertGreater(len(chunks), 50)
+            self.assertLess(max(map(len, chunks)), 200)
+            self.assertEqual(expected, "".join(chunks))
+
+    def test_empty_sequence_yields_nothing(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual([], list(writer.iter_chunks(core.Sequence())))
+
+
+class TestIterativeMode(unittest.TestCase):
+
+    def test_iterative_output_is_identical_to_recursive_output(self):
+        seq = core.Sequence()
+        seq.append(core.Declaration(core.Function("f", "int")))
+        body = core.Block()
+        inner = core.Block()
+        inner.append(core.Statement(core.Assignment(core.Variable("a", "int"), 1)))
+        inner.append(core.LineComment(" Comment"))
+        body.append(inner)
+        body.append(core.Block())
+        body.append([core.Statement("b = 2"), core.BlockComment(" Comment ")])
+        body.append(core.Statement(core.FunctionReturn(0)))
+        seq.append(body)
+        seq.append(core.Blank())
+        seq.append(core.Block())
+        for options in (cfile.StyleOptions(),
+                        cfile.StyleOptions(break_before_braces=cfile.BreakBeforeBraces.ATTACH),
+                        cfile.StyleOptions(short_functions_on_single_line=style.ShortFunction.EMPTY)):
+            expected = cfile.Writer(options).write_str(seq)
+            self.assertEqual(expected, cfile.Writer(options, iterative=True).write_str(seq))
+
+    def test_nesting_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        seq = core.Sequence()
+        block = core.Block()
+        seq.append(block)
+        for _ in range(depth - 1):
+            inner = core.Block()
+            block.append(inner)
+            block = inner
+        block.append(core.Statement("return"))
+        writer = cfile.Writer(cfile.StyleOptions(indent_width=1), iterative=True)
+        output = writer.write_str(seq)
+        lines = output.splitlines()
+        self.assertEqual(2 * depth + 1, len(lines))
+        self.assertEqual(" " * depth + "return;", lines[depth])
+        self.assertEqual(" " * (depth - 1) + "}", lines[depth + 1])
+        self.assertEqual("}", lines[-1])
+
+
+class _CommentWriter(cfile.Writer):
+    """
+    Writer subclass with its own constructor, module level so that it can be pickled
+    """
+    def __init__(self, comment: str, **kwargs) -> None:
+        super().__init__(cfile.StyleOptions(), **kwargs)
+        self.comment = comment
+
+    def _write_include_directive(self, elem: core.IncludeDirective) -> None:
+        super()._write_include_directive(elem)
+        self._write(f" /* {self.comment} */")
+
+
+class TestLazySequence(unittest.TestCase):
+
+    def make_statements(self, count: int):
+        return (core.Statement(core.Assignment(f"x{i}", i)) for i in range(count))
+
+    def test_lazy_sequence_output_is_identical_to_sequence_output(self):
+        expected_seq = core.Sequence()
+        for elem in self.make_statements(5):
+            expected_seq.append(elem)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(expected_seq)
+        for iterative in (False, True):
+            writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative)
+            self.assertEqual(expected, writer.write_str(core.LazySequence(self.make_statements(5))))
+
+    def test_nested_sequences_are_written_inline(self):
+        expected = """int f(void)
+{
+    x0 = 0;
+    x1 = 1;
+    y = 0;
+}
+x0 = 0;
+"""
+        for iterative in (False, True):
+            with self.subTest(iterative=iterative):
+                body = core.Block()
+                body.append(core.LazySequence(self.make_statements(2)))
+                inner = core.Sequence()
+                inner.append(core.Statement("y = 0"))
+                body.append(inner)
+                body.append(core.Sequence())
+                seq = core.Sequence()
+                seq.append(core.Declaration(core.Function("f", "int")))
+                seq.append(body)
+                seq.append(core.LazySequence(lambda: self.make_statements(1)))
+                writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative)
+                self.assertEqual(expected, writer.write_str(seq))
+
+    def test_write_file_streams_lazy_sequence(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "output.c")
+            writer = cfile.Writer(cfile.StyleOptions())
+            writer.write_file(core.LazySequence(self.make_statements(10000)), file_path)
+            lines = _read_text(file_path).splitlines()
+        self.assertEqual(10000, len(lines))
+        self.assertEqual("x9999 = 9999;", lines[-1])
+
+
+class TestSequenceChain(unittest.TestCase):
+
+    def test_chain_and_view_output_is_identical_to_copied_output(self):
+        prologue = core.Sequence()
+        prologue.append(core.IfndefDirective("HEADER_H"))
+        prologue.append(core.DefineDirective("HEADER_H"))
+        body = core.Sequence()
+        for i in range(4):
+            body.append(core.Statement(core.Declaration(core.Variable(f"var{i}", "int", extern=True))))
+        epilogue = core.Sequence()
+        epilogue.append(core.EndifDirective())
+        expected_seq = core.Sequence()
+        expected_seq.extend(prologue).extend(body).extend(epilogue)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(expected_seq)
+        for iterative in (False, True):
+            writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative)
+            chain = core.SequenceChain(prologue, body.view(0, 2), body.view(2), epilogue)
+            self.assertEqual(expected, writer.write_str(chain))
+            nested = core.Sequence()
+            nested.append(prologue).append(core.SequenceChain(body.view(0, 2), body.view(2))).append(epilogue)
+            self.assertEqual(expected, writer.write_str(nested))
+
+
+class TestArrayInitializer(unittest.TestCase):
+
+    def write_declaration(self, init_value, data_type: str = "int") -> str:
+        element = core.Statement(core.Declaration(core.Variable("table", data_type, array=4), init_value))
+        return cfile.Writer(cfile.StyleOptions()).write_str_elem(element)
+
+    def test_buffer_output_is_identical_to_list_output(self):
+        values = [0, 1, -2, 32767, -32768]
+        expected = self.write_declaration(values)
+        for type_code in "hilq":
+            with self.subTest(type_code=type_code):
+                self.assertEqual(expected, self.write_declaration(array.array(type_code, values)))
+        self.assertEqual(expected, self.write_declaration(memoryview(array.array("i", values))))
+        self.assertEqual(expected, self.write_declaration(core.ArrayInitializer(tuple(values))))
+        self.assertEqual("int table[4] = {};", self.write_declaration(array.array("i")))
+
+    def test_large_buffer_output_is_identical_to_list_output(self):
+        values = list(range(3 * 0x4000 + 5))
+        self.assertEqual(self.write_declaration(values), self.write_declaration(array.array("I", values)))
+
+    def test_values_per_line(self):
+        expected = """uint8_t table[4] = {
+    0x00, 0x01, 0x02,
+    0x0A, 0xFF
+};"""
+        init_value = core.ArrayInitializer(bytes([0, 1, 2, 10, 255]), values_per_line=3, hex=True)
+        self.assertEqual(expected, self.write_declaration(init_value, "uint8_t"))
+
+    def test_rows_span_batches(self):
+        values = bytes(i & 0xFF for i in range(0x4000 * 2 + 3))
+        output = self.write_declaration(core.ArrayInitializer(values, values_per_line=5), "uint8_t")
+        lines = output.splitlines()
+        self.assertEqual(2 + (len(values) + 4) // 5, len(lines))
+        self.assertEqual("    0, 1, 2, 3, 4,", lines[1])
+        rows = [line.strip().rstrip(",").split(", ") for line in lines[1:-1]]
+        self.assertEqual({5}, {len(row) for row in rows[:-1]})
+        self.assertEqual(list(values), [int(value) for row in rows for value in row])
+
+    def test_hex_digits_and_suffix(self):
+        values = array.array("I", [1, 0xFFFFFFFF])
+        self.assertEqual("uint32_t table[4] = {0x00000001U, 0xFFFFFFFFU};",
+                         self.write_declaration(core.ArrayInitializer(values, hex=True, suffix="U"), "uint32_t"))
+        self.assertEqual("uint16_t table[4] = {0x0001, 0xFFFF};",
+                         self.write_declaration(core.ArrayInitializer(array.array("H", [1, 0xFFFF]), hex=True),
+                                                "uint16_t"))
+        self.assertEqual("int table[4] = {0x001, -0x0FF};",
+                         self.write_declaration(core.ArrayInitializer([1, -255], hex=True, hex_digits=3)))
+
+    def test_floats_and_multidimensional_buffers(self):
+        self.assertEqual("float table[4] = {1.5f, 2.0f};",
+                         self.write_declaration(core.ArrayInitializer(array.array("d", [1.5, 2]), suffix="f"),
+                                                "float"))
+        matrix = memoryview(bytes(range(6))).cast("B", (2, 3))
+        self.assertEqual("int table[4] = {0, 1, 2, 3, 4, 5};", self.write_declaration(matrix))
+
+    def test_invalid_values(self):
+        with self.assertRaises(TypeError):
+            core.ArrayInitializer(5)
+        with self.assertRaises(NotImplementedError):
+            self.write_declaration(core.ArrayInitializer([1.5]))
+        for value in (1.5, {"a": 1}):
+            with self.subTest(value=value):
+                with self.assertRaises(NotImplementedError):
+                    self.write_declaration(value)
+        with self.assertRaises(ValueError):
+            self.write_declaration(core.ArrayInitializer(array.array("d", [1.5]), hex=True))
+
+
+class TestByteArrayFromFile(unittest.TestCase):
+
+    def test_byte_array_from_file(self):
+        expected = """const size_t blob_length = 5;
+const uint8_t blob[5] = {
+    0x00, 0x01, 0x7F,
+    0x80, 0xFF
+};
+"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "blob.bin")
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(bytes([0, 1, 127, 128, 255]))
+            code = cfile.CFactory().byte_array_from_file("blob", file_path, values_per_line=3)
+            writer = cfile.Writer(cfile.StyleOptions())
+            self.assertEqual(expected, writer.write_str(code))
+            output_path = os.path.join(tmp_dir, "blob.c")
+            writer.write_file(code, output_path)
+            self.assertEqual(expected, _read_text(output_path))
+
+    def test_output_is_identical_to_array_initializer(self):
+        data = bytes(i * 7 & 0xFF for i in range(0x4000 * 3 + 1))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "blob.bin")
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(data)
+            writer = cfile.Writer(cfile.StyleOptions())
+            self.assertEqual(writer.write_str_elem(core.ArrayInitializer(data, 12, hex=True)),
+                             writer.write_str_elem(core.FileInitializer(file_path)))
+
+    def test_empty_and_modified_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "blob.bin")
+            with open(file_path, "wb"):
+                pass
+            writer = cfile.Writer(cfile.StyleOptions())
+            code = cfile.CFactory().byte_array_from_file("blob", file_path)
+            self.assertIn("blob[0] = {};", writer.write_str(code))
+            with open(file_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"x")
+            with self.assertRaises(ValueError):
+                writer.write_str(code)
+
+
+class TestWriteStrElems(unittest.TestCase):
+
+    def test_output_is_identical_to_write_str_elem(self):
+        block = core.Block()
+        block.append(core.Statement(core.FunctionReturn(0)))
+        elements = [core.Statement(core.Declaration(core.Variable("a", "int"), 0)),
+                    core.Declaration(core.Function("f", "int")),
+                    block,
+                    core.LineComment(" Comment"),
+                    core.Statement(core.Declaration(core.Variable("table", "int", array=2), [1, 2]))]
+        writer = cfile.Writer(cfile.StyleOptions())
+        for trim_end in (True, False):
+            with self.subTest(trim_end=trim_end):
+                expected = [writer.write_str_elem(elem, trim_end) for elem in elements]
+                self.assertEqual(expected, writer.write_str_elems(elements, trim_end))
+                self.assertEqual(expected, list(writer.iter_str_elems(iter(elements), trim_end)))
+
+    def test_large_elements(self):
+        body = core.Block()
+        for i in range(10000):
+            body.append(core.Statement(core.Assignment(f"x{i}", i)))
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual([writer.write_str_elem(body), "int a"],
+                         writer.write_str_elems([body, core.Declaration(core.Variable("a", "int"))]))
+        self.assertEqual([], writer.write_str_elems([]))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def make_sequence(self) -> core.Sequence:
+        seq = core.Sequence()
+        seq.append(core.IncludeDirective("stdio.h", system=True))
+        seq.append(core.LineComment(" Table"))
+        seq.append(core.Statement(core.Declaration(core.Variable("table", "int", array=3), [1, 2, 3])))
+        seq.append(core.Declaration(core.Function("f", "void")))
+        body = core.Block()
+        body.append(core.Statement(core.FunctionCall("printf", [core.StringLiteral("x")])))
+        seq.append(body)
+        return seq
+
+    def test_profile_is_off_by_default(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.write_str(self.make_sequence())
+        self.assertIsNone(writer.profile)
+
+    def test_profile(self):
+        seq = self.make_sequence()
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        writer = cfile.Writer(cfile.StyleOptions(), profiling=True)
+        self.assertEqual(expected, writer.write_str(seq))
+        profile = writer.profile
+        for name in ("IncludeDirective", "LineComment", "Statement", "Declaration", "Block", "FunctionCall",
+                     "StringLiteral", "Initializer"):
+            with self.subTest(name=name):
+                self.assertIn(name, profile.elements)
+                self.assertGreater(profile.elements[name].calls, 0)
+                self.assertGreaterEqual(profile.elements[name].time, 0.0)
+        self.assertEqual(2, profile.elements["Statement"].calls)
+        self.assertEqual(len("#include <stdio.h>"), profile.elements["IncludeDirective"].chars)
+        self.assertEqual(len("{1, 2, 3}"), profile.elements["Initializer"].chars)
+        self.assertEqual(len(expected.split("void f(void)")[1]), profile.elements["Block"].chars)
+        writer.write_str(seq)
+        self.assertEqual(4, writer.profile.elements["Statement"].calls)
+        self.assertIn("Statement", writer.profile.report())
+
+    def test_profile_in_iterative_mode_and_with_registered_handler(self):
+        seq = self.make_sequence()
+        writer = cfile.Writer(cfile.StyleOptions(), iterative=True, profiling=True)
+        writer.register(core.StringLiteral, lambda writer, elem: writer._write("'x'"))  # pylint: disable=W0212
+        self.assertIn("printf('x');", writer.write_str(seq))
+        self.assertEqual(3, writer.profile.elements["StringLiteral"].chars)
+        recursive = cfile.Writer(cfile.StyleOptions(), profiling=True)
+        recursive.register(core.StringLiteral, lambda writer, elem: writer._write("'x'"))  # pylint: disable=W0212
+        recursive.write_str(seq)
+        for name, stats in recursive.profile.elements.items():
+            with self.subTest(name=name):
+                self.assertEqual(stats.calls, writer.profile.elements[name].calls)
+                self.assertEqual(stats.chars, writer.profile.elements[name].chars)
+        self.assertEqual(1, writer.profile.elements["Block"].calls)
+
+
+class TestWriteFiles(unittest.TestCase):
+
+    def _check_files(self, writer: cfile.Writer, files: dict[str, core.Sequence]) -> None:
+        for file_path, seq in files.items():
+            self.assertEqual(writer.write_str(seq), _read_text(file_path))
+
+    def test_write_files_using_threads(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = {os.path.join(tmp_dir, f"file{i}.c"): _make_file_sequence(i) for i in range(20)}
+            results = writer.write_files(files, workers=4)
+            self.assertEqual(list(files.keys()), [result.path for result in results])
+            self.assertTrue(all(result.ok for result in results))
+            self._check_files(writer, files)
+
+    def test_write_files_using_processes(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = {os.path.join(tmp_dir, f"file{i}.c"): _make_file_sequence(i) for i in range(4)}
+            results = writer.write_files(files, workers=2, processes=True)
+            self.assertTrue(all(result.ok for result in results))
+            self._check_files(writer, files)
+
+    def test_chains_and_views_are_written_by_processes(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = {os.path.join(tmp_dir, "chain.c"): core.SequenceChain(_make_file_sequence(0),
+                                                                           _make_file_sequence(1)),
+                     os.path.join(tmp_dir, "view.c"): _make_file_sequence(2).view(1)}
+            results = writer.write_files(files, workers=2, processes=True)
+            self.assertTrue(all(result.ok for result in results))
+            self._check_files(writer, files)
+
+    def test_errors_are_reported_per_file(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        bad_seq = core.Sequence()
+        bad_seq.append(object())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = {os.path.join(tmp_dir, "good.c"): _make_file_sequence(0),
+                     os.path.join(tmp_dir, "bad.c"): bad_seq,
+                     os.path.join(tmp_dir, "missing", "file.c"): _make_file_sequence(1)}
+            for workers in (1, 2):
+                results = writer.write_files(files, workers=workers)
+                self.assertIsNone(results[0].error)
+                self.assertIsInstance(results[1].error, NotImplementedError)
+                self.assertIsInstance(results[2].error, FileNotFoundError)
+
+    def test_render_cache_is_used_by_workers(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(os.path.join(tmp_dir, "cache"))
+            writer = cfile.Writer(cfile.StyleOptions(), render_cache=render_cache)
+            files = {os.path.join(tmp_dir, f"file{i}.c"): _make_file_sequence(i) for i in range(8)}
+            writer.write_files(files, workers=4)
+            misses = render_cache.stats().misses
+            self.assertGreater(misses, 0)
+            results = writer.write_files(files, workers=4)
+            self.assertTrue(all(result.ok for result in results))
+            self.assertEqual(misses, render_cache.stats().misses)
+            self.assertEqual(misses, render_cache.stats().hits)
+            self._check_files(cfile.Writer(cfile.StyleOptions()), files)
+
+    def test_writer_subclass_and_settings_are_used_by_processes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            render_cache = cache.RenderCache(os.path.join(tmp_dir, "cache"))
+            writer = _CommentWriter("generated", render_cache=render_cache, profiling=True, incremental=True)
+            files = {os.path.join(tmp_dir, f"file{i}.c"): _make_file_sequence(i) for i in range(4)}
+            results = writer.write_files(files, workers=2, processes=True)
+            self.assertTrue(all(result.ok for result in results))
+            self._check_files(writer, files)
+            self.assertTrue(_read_text(next(iter(files))).startswith('#include "file0.h" /* generated */\n'))
+            self.assertEqual(len(files), cache.RenderCache(render_cache.directory).stats().entries)
+
+    def test_registered_handlers_are_used_by_workers(self):
+        def write_upper_literal(writer: cfile.Writer, elem: core.StringLiteral) -> None:
+            writer._write(f'"{elem.text.upper()}"')  # pylint: disable=protected-access
+
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.register(core.StringLiteral, write_upper_literal)
+        seq = core.Sequence()
+        seq.append(core.Statement(core.FunctionCall("puts", [core.StringLiteral("abc")])))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            results = writer.write_files({file_path: seq}, workers=2)
+            self.assertTrue(results[0].ok)
+            self.assertEqual('puts("ABC");\n', _read_text(file_path))
+
+
+class TestTypeCache(unittest.TestCase):
+
+    def test_hit_rate_is_reported_in_stats(self):
+        seq = core.Sequence()
+        for i in range(4):
+            seq.append(core.Statement(core.Declaration(core.Variable(f"a{i}", "int"))))
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.write_str(seq)
+        self.assertEqual(1, writer.stats.type_cache_misses)
+        self.assertEqual(3, writer.stats.type_cache_hits)
+        self.assertAlmostEqual(0.75, writer.stats.type_cache_hit_rate)
+
+    def test_modified_type_is_formatted_again(self):
+        data_type = core.Type("int")
+        decl = core.Declaration(core.Variable("a", data_type))
+        writer = cfile.Writer(cfile.StyleOptions())
+        self.assertEqual("int a", writer.write_str_elem(decl))
+        data_type.const = True
+        data_type.pointer = True
+        self.assertEqual("const int* a", writer.write_str_elem(decl))
+
+    def test_modified_style_is_used_on_next_write(self):
+        decl = core.Declaration(core.Variable("a", core.Type("int", const=True, pointer=True)))
+        options = cfile.StyleOptions()
+        writer = cfile.Writer(options)
+        self.assertEqual("const int* a", writer.write_str_elem(decl))
+        options.pointer_alignment = cfile.Alignment.RIGHT
+        self.assertEqual("const int *a", writer.write_str_elem(decl))
+        decl.element.data_type.pointer = False
+        writer.style = cfile.StyleOptions(type_qualifier_order=["type", "const", "volatile"])
+        self.assertEqual("int const a", writer.write_str_elem(decl))
+
+
+class TestCompiledStyle(unittest.TestCase):
+
+    def test_pointer_tables(self):
+        left = style.CompiledStyle.compile(cfile.StyleOptions(pointer_alignment=cfile.Alignment.LEFT))
+        self.assertEqual(("*", ("* ", "* "), "* const ", (" ", " ")),
+                         (left.type_pointer, left.pointer, left.const_pointer, left.name_separator))
+        right = style.CompiledStyle.compile(cfile.StyleOptions(pointer_alignment=cfile.Alignment.RIGHT))
+        self.assertEqual((" *", (" *", "*"), "*const ", (" ", "")),
+                         (right.type_pointer, right.pointer, right.const_pointer, right.name_separator))
+        middle = style.CompiledStyle.compile(cfile.StyleOptions(pointer_alignment=cfile.Alignment.MIDDLE))
+        self.assertEqual((" *", (" * ", " * "), " * const ", (" ", " ")),
+                         (middle.type_pointer, middle.pointer, middle.const_pointer, middle.name_separator))
+
+    def test_const_pointer_with_non_default_space_location_is_not_supported(self):
+        options = cfile.StyleOptions(space_around_pointer_qualifiers=style.SpaceLocation.BOTH)
+        self.assertIsNone(style.CompiledStyle.compile(options).const_pointer)
+        writer = cfile.Writer(options)
+        self.assertEqual("int* a", writer.write_str_elem(core.Declaration(core.Variable("a", "int", pointer=True))))
+        with self.assertRaises(NotImplementedError):
+            writer.write_str_elem(core.Declaration(core.Variable("a", "int", pointer=True, const=True)))
+
+    def test_declarators_are_consistent_across_variable_typedef_and_struct_member(self):
+        for alignment in (cfile.Alignment.LEFT, cfile.Alignment.RIGHT, cfile.Alignment.MIDDLE):
+            writer = cfile.Writer(cfile.StyleOptions(pointer_alignment=alignment))
+            for pointer, const in ((False, False), (True, False), (True, True)):
+                data_type = core.Type("char", pointer=True)
+                variable = writer.write_str_elem(core.Declaration(
+                    core.Variable("x", data_type, pointer=pointer, const=const)))
+                typedef = writer.write_str_elem(core.Declaration(
+                    core.TypeDef("x", data_type, pointer=pointer, const=const)))
+                writer._str_open()  # pylint: disable=protected-access
+                writer._write_struct_member(  # pylint: disable=protected-access
+                    core.StructMember("x", data_type, pointer=pointer, const=const))
+                member = writer._str_close()  # pylint: disable=protected-access
+                self.assertEqual(variable, typedef.removeprefix("typedef "))
+                self.assertEqual(variable, member)
+
+
+class TestIndentation(unittest.TestCase):
+
+    def test_indentation_strings_are_shared_between_writers(self):
+        writer1 = cfile.Writer(cfile.StyleOptions(indent_width=3, indent_char="."))
+        writer2 = cfile.Writer(cfile.StyleOptions(indent_width=3, indent_char="."))
+        writer3 = cfile.Writer(cfile.StyleOptions(indent_width=2, indent_char="."))
+        self.assertIs(writer1._indent_table, writer2._indent_table)  # pylint: disable=protected-access
+        self.assertIsNot(writer1._indent_table, writer3._indent_table)  # pylint: disable=protected-access
+        self.assertEqual("......", writer1._indentation(2))  # pylint: disable=protected-access
+        self.assertIs(writer1._indentation(2), writer2._indentation(2))  # pylint: disable=protected-access
+
+    def test_indentation_beyond_cached_levels(self):
+        writer = cfile.Writer(cfile.StyleOptions(indent_width=1))
+        level = cfile.writer.INDENT_CACHE_LEVELS + 10
+        self.assertEqual(" " * level, writer._indentation(level))  # pylint: disable=protected-access
+        table = writer._indent_table  # pylint: disable=protected-access
+        self.assertLessEqual(len(table), cfile.writer.INDENT_CACHE_LEVELS)
+
+
+class TestWriteIfChanged(unittest.TestCase):
+
+    def test_unchanged_file_is_not_written(self):
+        seq = _make_variable_sequence(100)
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            self.assertTrue(writer.write_file(seq, file_path, only_if_changed=True))
+            os.utime(file_path, (1000000000, 1000000000))
+            self.assertFalse(writer.write_file(seq, file_path, only_if_changed=True))
+            self.assertEqual(1000000000, os.stat(file_path).st_mtime)
+            self.assertEqual(["file.c"], os.listdir(tmp_dir))
+
+    def test_changed_file_is_replaced(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.flush_threshold = 8
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(_make_variable_sequence(100), file_path)
+            os.chmod(file_path, 0o640)
+            for num_variables in (100, 120, 50, 0):
+                seq = _make_variable_sequence(num_variables)
+                seq.append(core.LineComment(" changed"))
+                self.assertTrue(writer.write_file(seq, file_path, only_if_changed=True))
+                self.assertEqual(writer.write_str(seq), _read_text(file_path))
+                self.assertEqual(0o640, os.stat(file_path).st_mode & 0o777)
+            self.assertEqual(["file.c"], os.listdir(tmp_dir))
+
+    def test_truncated_output_is_a_change(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(_make_variable_sequence(10), file_path)
+            self.assertTrue(writer.write_file(_make_variable_sequence(9), file_path, only_if_changed=True))
+            self.assertEqual(writer.write_str(_make_variable_sequence(9)), _read_text(file_path))
+            self.assertTrue(writer.write_file(core.Sequence(), file_path, only_if_changed=True))
+            self.assertEqual("", _read_text(file_path))
+
+    def test_write_files_reports_changed_files(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = {os.path.join(tmp_dir, f"file{i}.c"): _make_variable_sequence(i + 1) for i in range(3)}
+            results = writer.write_files(files, workers=2, only_if_changed=True)
+            self.assertEqual([True, True, True], [result.changed for result in results])
+            files[os.path.join(tmp_dir, "file1.c")].append(core.Blank())
+            results = writer.write_files(files, workers=2, only_if_changed=True)
+            self.assertEqual([False, True, False], [result.changed for result in results])
+
+
+class TestIncremental(unittest.TestCase):
+
+    def test_unchanged_blocks_are_reused(self):
+        for iterative in (False, True):
+            with self.subTest(iterative=iterative):
+                seq = _make_function_sequence(3)
+                writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative, incremental=True)
+                expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+                self.assertEqual(expected, writer.write_str(seq))
+                self.assertEqual(0, writer.stats.fragment_hits)
+                self.assertEqual(expected, writer.write_str(seq))
+                self.assertEqual(3, writer.stats.fragment_hits)
+
+    def test_changed_blocks_are_written_again(self):
+        for iterative in (False, True):
+            with self.subTest(iterative=iterative):
+                seq = _make_function_sequence(3)
+                writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative, incremental=True)
+                writer.write_str(seq)
+                inner = seq.elements[4].elements[1]
+                inner.append(core.Statement(core.FunctionCall("g")))
+                hits = writer.stats.fragment_hits
+                output = writer.write_str(seq)
+                self.assertEqual(cfile.Writer(cfile.StyleOptions()).write_str(seq), output)
+                self.assertIn("        g();", output)
+                self.assertEqual(hits + 2, writer.stats.fragment_hits)  # Other two functions
+                statement = seq.elements[1].elements[0]
+                statement.parts[0].init_value = 10  # Modified in place, not tracked until touched
+                self.assertNotIn("int a = 10;", writer.write_str(seq))
+                seq.elements[1].touch()
+                self.assertIn("int a = 10;", writer.write_str(seq))
+
+    def test_fragments_depend_on_context(self):
+        block = core.Block()
+        block.append(core.Statement(core.FunctionReturn(0)))
+        seq = core.Sequence()
+        seq.append(block)
+        seq.append(core.Declaration(core.Function("f", "int")))
+        seq.append(block)
+        nested = core.Block()
+        nested.append(block)
+        seq.append(nested)
+        writer = cfile.Writer(cfile.StyleOptions(), incremental=True)
+        expected = cfile.Writer(cfile.StyleOptions()).write_str(seq)
+        self.assertEqual(expected, writer.write_str(seq))
+        self.assertEqual(expected, writer.write_str(seq))
+
+    def test_lazy_sequences_are_always_written(self):
+        counter = iter(range(10))
+
+        def produce():
+            return [core.Statement(core.FunctionReturn(next(counter)))]
+        block = core.Block()
+        block.append(core.LazySequence(produce))
+        seq = core.Sequence()
+        seq.append(block)
+        for iterative in (False, True):
+            with self.subTest(iterative=iterative):
+                writer = cfile.Writer(cfile.StyleOptions(), iterative=iterative, incremental=True)
+                first = writer.write_str(seq)
+                self.assertNotEqual(first, writer.write_str(seq))
+                self.assertEqual(0, writer.stats.fragment_hits)
+
+    def test_lazy_sequences_in_chains_and_views_are_always_written(self):
+        for kind in ("chain", "view"):
+            for mode in ("recursive", "iterative", "chunks"):
+                with self.subTest(kind=kind, mode=mode):
+                    rows = [1]
+
+                    def produce(rows=rows):
+                        return [core.Statement(core.Assignment(core.Variable("x", "int"), row)) for row in rows]
+                    lazy = core.LazySequence(produce)
+                    block = core.Block()
+                    block.append(core.SequenceChain(lazy) if kind == "chain" else core.SequenceView(lazy))
+                    seq = core.Sequence()
+                    seq.append(block)
+                    writer = cfile.Writer(cfile.StyleOptions(), iterative=mode == "iterative", incremental=True)
+
+                    def write(seq=seq, writer=writer, mode=mode):
+                        return "".join(writer.iter_chunks(seq)) if mode == "chunks" else writer.write_str(seq)
+                    self.assertEqual("{\n    x = 1;\n}\n", write())
+                    rows.append(2)
+                    self.assertEqual("{\n    x = 1;\n    x = 2;\n}\n", write())
+                    self.assertEqual(0, writer.stats.fragment_hits)
+
+    def test_modified_style_drops_fragments(self):
+        seq = _make_function_sequence(1)
+        seq.elements[1].append(core.Statement(core.Declaration(core.Variable("p", "int", pointer=True))))
+        options = cfile.StyleOptions()
+        writer = cfile.Writer(options, incremental=True)
+        self.assertIn("int* p;", writer.write_str(seq))
+        options.pointer_alignment = cfile.Alignment.RIGHT
+        self.assertIn("int *p;", writer.write_str(seq))
+
+
+class TestRegions(unittest.TestCase):
+
+    def _strip_markers(self, text: str) -> str:
+        return "".join(line for line in text.splitlines(keepends=True) if not line.startswith("/* cfile:"))
+
+    def _counting_writer(self) -> tuple[cfile.Writer, list[str]]:
+        written: list[str] = []
+
+        def write_statement(writer, elem):
+            written.append(elem.parts[0].element.name)
+            cfile.Writer._write_statement(writer, elem)  # pylint: disable=protected-access
+        writer = cfile.Writer(cfile.StyleOptions())
+        writer.register(core.Statement, write_statement)
+        return writer, written
+
+    def test_regions_contain_output(self):
+        seq = _make_variable_sequence(100, blanks=True)
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            text = _read_text(file_path)
+            self.assertTrue(text.startswith("/* cfile:begin "))
+            self.assertGreater(text.count("/* cfile:begin "), 2)
+            self.assertEqual(text.count("/* cfile:begin "), text.count("/* cfile:end "))
+            self.assertEqual(writer.write_str(seq), self._strip_markers(text))
+
+    def test_unchanged_regions_are_copied(self):
+        seq = _make_variable_sequence(100, blanks=True)
+        writer, written = self._counting_writer()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path, regions=True)
+            self.assertEqual(100, len(written))
+            written.clear()
+            self.assertFalse(writer.write_file(seq, file_path, regions=True))
+            self.assertEqual([], written)
+            seq[100] = core.Statement(core.Declaration(core.Variable("b", "int"), 1))
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            self.assertIn("b", written)
+            self.assertLess(len(written), 50)
+            self.assertEqual(writer.write_str(seq), self._strip_markers(_read_text(file_path)))
+
+    def test_edited_region_is_written_again(self):
+        seq = _make_variable_sequence(20, blanks=True)
+        writer, written = self._counting_writer()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path, regions=True)
+            text = _read_text(file_path)
+            with open(file_path, "w", encoding="utf-8") as fh:  # pylint: disable=invalid-name
+                fh.write(text.replace("int var5 = 5;", "int var5 = 6;"))
+            written.clear()
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            self.assertIn("var5", written)
+            self.assertLess(len(written), 20)
+            self.assertEqual(text, _read_text(file_path))
+
+    def test_damaged_layout_is_written_again(self):
+        seq = _make_variable_sequence(20, blanks=True)
+        writer, written = self._counting_writer()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path, regions=True)
+            text = _read_text(file_path)
+            for damaged in ["// Added by hand\n" + text, text + "\n", text.replace("/* cfile:end", "/* end", 1)]:
+                with open(file_path, "w", encoding="utf-8") as fh:  # pylint: disable=invalid-name
+                    fh.write(damaged)
+                written.clear()
+                self.assertTrue(writer.write_file(seq, file_path, regions=True))
+                self.assertEqual(20, len(written))
+                self.assertEqual(text, _read_text(file_path))
+
+    def test_file_without_regions_is_replaced(self):
+        seq = _make_variable_sequence(5, blanks=True)
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path)
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            self.assertEqual(writer.write_str(seq), self._strip_markers(_read_text(file_path)))
+            self.assertFalse(writer.write_file(seq, file_path, regions=True))
+            self.assertTrue(writer.write_file(core.Sequence(), file_path, regions=True))
+            self.assertEqual("", _read_text(file_path))
+            self.assertEqual(["file.c"], os.listdir(tmp_dir))
+
+    def test_modified_file_initializer_is_written_again(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            blob_path = os.path.join(tmp_dir, "blob.bin")
+            with open(blob_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x03")
+            seq = _make_variable_sequence(20, blanks=True)
+            seq.append(core.Statement(core.Declaration(core.Variable("blob", "uint8_t", array=3),
+                                                       core.FileInitializer(blob_path))))
+            writer = cfile.Writer(cfile.StyleOptions())
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path, regions=True)
+            with open(blob_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x04")
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            text = self._strip_markers(_read_text(file_path))
+            self.assertIn("0x04", text)
+            self.assertEqual(writer.write_str(seq), text)
+
+    def test_regions_with_volatile_elements_are_written_again(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            blob_path = os.path.join(tmp_dir, "blob.bin")
+            with open(blob_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x03")
+            seq = _make_variable_sequence(20, blanks=True)
+            body = core.Block()
+            body.append(core.Statement(core.Declaration(core.Variable("blob", "uint8_t", array=3, static=True),
+                                                        core.FileInitializer(blob_path))))
+            seq.append(body)
+            writer = cfile.Writer(cfile.StyleOptions(), incremental=True)
+            file_path = os.path.join(tmp_dir, "file.c")
+            writer.write_file(seq, file_path, regions=True)
+            self.assertIn("/* cfile:begin - */", _read_text(file_path))
+            with open(blob_path, "wb") as fh:  # pylint: disable=invalid-name
+                fh.write(b"\x01\x02\x04")
+            self.assertTrue(writer.write_file(seq, file_path, regions=True))
+            text = self._strip_markers(_read_text(file_path))
+            self.assertIn("0x04", text)
+            self.assertEqual(writer.write_str(seq), text)
+
+    def test_appending_after_unterminated_line_gives_same_layout_as_new_file(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.c")
+            new_file_path = os.path.join(tmp_dir, "new.c")
+            # Different names give different region boundaries, some of them right after the declaration
+            for i in range(40):
+                seq = _make_variable_sequence(5, blanks=True)
+                seq.append(core.Declaration(core.Variable(f"b{i}", "int")))
+                writer.write_file(seq, file_path, regions=True)
+                seq.append(core.Declaration(core.Variable("c", "int")))
+                seq.append(core.Blank())
+                self.assertTrue(writer.write_file(seq, file_path, regions=True))
+                writer.write_file(seq, new_file_path, regions=True)
+                self.assertEqual(_read_text(new_file_path), _read_text(file_path))
+
+    def test_source_map_is_not_supported(self):
+        writer = cfile.Writer(cfile.StyleOptions(), source_map=True)
+        seq = _make_variable_sequence(1, blanks=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                writer.write_file(seq, os.path.join(tmp_dir, "file.c"), regions=True)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_writer_can_be_shared_between_threads(self):
+        sequences = [_make_function_sequence(50, f"f{i}_") for i in range(16)]
+        expected = [cfile.Writer(cfile.StyleOptions()).write_str(seq) for seq in sequences]
+        writer = cfile.Writer(cfile.StyleOptions(), profiling=True)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outputs = list(executor.map(writer.write_str, sequences * 4))
+            chunks = list(executor.map(lambda seq: "".join(writer.iter_chunks(seq, 100)), sequences))
+        self.assertEqual(expected * 4, outputs)
+        self.assertEqual(expected, chunks)
+        self.assertEqual(16 * 5 * 100, writer.stats.type_cache_hits + writer.stats.type_cache_misses)
+        self.assertEqual(16 * 5 * 100, writer.profile.elements["Block"].calls)
+
+    def test_writer_can_be_used_while_writing(self):
+        writer = cfile.Writer(cfile.StyleOptions(), profiling=True)
+
+        def write_function_call(writer, elem):
+            comment = writer.write_str_elem(core.BlockComment(elem.name))
+            cfile.Writer._write_func_call(writer, elem)  # pylint: disable=protected-access
+            writer._write(" " + comment)  # pylint: disable=protected-access
+        writer.register(core.FunctionCall, write_function_call)
+        seq = core.Sequence()
+        seq.append(core.Declaration(core.Function("f", "void")))
+        body = core.Block()
+        body.append(core.Statement(core.FunctionCall("g")))
+        seq.append(body)
+        self.assertEqual("void f(void)\n{\n    g() /*g*/;\n}\n", writer.write_str(seq))
+        self.assertEqual(1, writer.profile.elements["BlockComment"].calls)
+        self.assertEqual(1, writer.profile.elements["FunctionCall"].calls)
+
+    def test_writer_copies_can_be_used_while_writing(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        copies = []
+
+        def write_function_call(writer, elem):
+            if elem.name == "g":
+                text = writer.write_str_elem(core.FunctionCall("h"))
+            else:
+                copies.append(writer)
+                text = elem.name + "()" + writer.write_str_elem(core.BlockComment(elem.name))
+            writer._write(text)  # pylint: disable=protected-access
+        writer.register(core.FunctionCall, write_function_call)
+        self.assertEqual("h()/*h*/;", writer.write_str_elem(core.Statement(core.FunctionCall("g"))))
+        self.assertIsNot(writer, copies[0])
+        self.assertEqual("h()/*h*/;", writer.write_str_elem(core.Statement(core.FunctionCall("g"))))
+
+    def test_writer_without_concurrent_use_writes_itself(self):
+        class BoundMethodWriter(cfile.Writer):
+            def __init__(self, style: cfile.StyleOptions) -> None:
+                super().__init__(style)
+                self.write_statement = self._write_statement
+
+            def _write_element(self, elem):
+                if isinstance(elem, core.Statement):
+                    self.write_statement(elem)
+                else:
+                    super()._write_element(elem)
+        writer = BoundMethodWriter(cfile.StyleOptions())
+        elem = core.Statement(core.Declaration(core.Variable("a", "int")))
+        self.assertEqual("int a;", writer.write_str_elem(elem))
+        self.assertEqual(["int a;"], writer.write_str_elems([elem]))
+
+    def test_generators_can_be_interleaved(self):
+        writer = cfile.Writer(cfile.StyleOptions())
+        elements = [core.Statement(core.Declaration(core.Variable(f"a{i}", "int"))) for i in range(3)]
+        values = writer.iter_str_elems(elements)
+        first = next(values)
+        self.assertEqual("int b;", writer.write_str_elem(core.Statement(core.Declaration(core.Variable("b", "int")))))
+        self.assertEqual(["int a0;", "int a1;", "int a2;"], [first] + list(values))
+
+
 if __name__ == '__main__':
     unittest.main()